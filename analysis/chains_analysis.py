@@ -51,7 +51,7 @@ class Analyzer:
             chain_info['Raw chains'] = pd.concat(raw_chains,ignore_index=True)
 
 
-        elif info['sampler'] == 'Nautilus':
+        elif info['sampler'] in ['Nautilus','Ensemble','Grid']:
 
             chain_info['params'] = read(info['path']+'.params.yaml', file_type='yaml')
 
@@ -97,8 +97,10 @@ class Analyzer:
                 else:
                     print('Single chain, no R-1 computed. Trust Cobaya and hope for the best')
 
-        elif info['sampler'] == 'Nautilus':
+        elif info['sampler'] in ['Nautilus','Ensemble','Grid']:
+            #Grid cells have different weights
             sample    = MCSamples(samples=chain_info['Raw chains'][list(chain_info['Nautilus pars'].keys())].values,
+                                  weights=chain_info['Raw chains']['weight'].values,
                                   names=list(chain_info['Nautilus pars'].keys()),
                                   labels=list(chain_info['Nautilus pars'].values()),label=name)
 
@@ -19,37 +19,81 @@ class BAOLike(Likelihood):
             self.z_vec = data_table['z'].values
 
             if self.observables == 'distances':
-                distance_covs = self.get_covmats(data_table)
-                self.single_data = single_obs[['z','DV_rd','DV_rd_err']]
-                self.datavectors = [np.array([row['DV_rd'],row['DM_DH']]) for ind,row in data_table.iterrows()]
-                self.inv_covmats = [pd.DataFrame(np.linalg.inv(covmat.values),
-                                                 columns=covmat.columns,index=covmat.index) for covmat in distance_covs]
+                self.binned_obs  = ['DV_rd','DM_DH']
+                self.single_obs  = 'DV_rd'
+                covmats          = self.get_covmats(data_table)
             elif self.observables == 'alphas':
-                self.single_data = single_obs[['z','alpha_iso','alpha_iso_err']]
-                self.datavectors = [np.array([row['alpha_iso'],row['alpha_AP']]) for ind,row in data_table.iterrows()]
-                alpha_covs = self.transform_covmat(data_table)
-                self.inv_covmats = [pd.DataFrame(np.linalg.inv(covmat.values),
-                                                 columns=covmat.columns,index=covmat.index) for covmat in alpha_covs]
+                self.binned_obs  = ['alpha_iso','alpha_AP']
+                self.single_obs  = 'alpha_iso'
+                covmats          = self.transform_covmat(data_table)
+            else:
+                sys.exit('Unknown BAO observables: {}'.format(self.observables))
+
+            self.single_data = single_obs[['z',self.single_obs,self.single_obs+'_err']]
+
         elif self.data_format == 'SKA':
             data_table = pd.read_csv(self.BAO_data_path+'.txt',sep='\t',header=0)
             self.z_vec = data_table['z'].values
-            self.datavectors = [np.array([row['DM_rd'],row['DH_rd']]) for ind,row in data_table.iterrows()]
-            self.inv_covmats = []
-            for ind,row in data_table.iterrows():
-
-                cov = pd.DataFrame([[row['DM_rd_err']**2,row['r_MH']*row['DM_rd_err']*row['DH_rd_err']],
-                                    [row['r_MH']*row['DM_rd_err']*row['DH_rd_err'],row['DH_rd_err']**2]],
-                                    columns=['DM_rd_{}'.format(ind),'DH_rd_{}'.format(ind)],
-                                    index=['DM_rd_{}'.format(ind),'DH_rd_{}'.format(ind)])
 
-                self.inv_covmats.append(pd.DataFrame(np.linalg.inv(cov.values),columns=cov.columns,index=cov.index))
+            self.binned_obs  = ['DM_rd','DH_rd']
+            self.single_obs  = None
+            self.single_data = None
+            covmats          = self.get_SKA_covmats(data_table)
 
         else:
             sys.exit('Unknown data format: {}'.format(self.data_format))
 
+        self.datavectors = [np.array([row[obs] for obs in self.binned_obs]) for ind,row in data_table.iterrows()]
+        self.inv_covmats = [pd.DataFrame(np.linalg.inv(covmat.values),
+                                         columns=covmat.columns,index=covmat.index) for covmat in covmats]
+
         zmax = 4.
         self.z_camb = np.linspace(0.001, zmax, 10000)
 
+        self.stack_data(data_table)
+
+    def stack_data(self,data_table):
+        #Builds a single data vector and precision matrix, so that logp
+        #only needs one theory array per observable and one quadratic form.
+        #The data vector is ordered observable by observable, each observable
+        #at the redshifts in self.theory_z[obs] (binned points, then single points)
+
+        self.z_vec = np.array(self.z_vec,dtype=float)
+        Nbins      = len(self.z_vec)
+
+        self.theory_z = {obs: self.z_vec for obs in self.binned_obs}
+        if self.single_data is not None:
+            self.z_single = np.array(self.single_data['z'].values,dtype=float)
+            if self.single_obs in self.theory_z:
+                self.theory_z[self.single_obs] = np.concatenate([self.z_vec,self.z_single])
+            else:
+                self.theory_z[self.single_obs] = self.z_single
+
+        offsets = {}
+        datavec = []
+        Ntot    = 0
+        for obs,z in self.theory_z.items():
+            offsets[obs] = Ntot
+            if obs in self.binned_obs:
+                datavec.append(data_table[obs].values)
+            if self.single_data is not None and obs == self.single_obs:
+                datavec.append(self.single_data[obs].values)
+            Ntot += len(z)
+
+        self.datavector = np.concatenate(datavec).astype(float)
+
+        #Block-diagonal precision: one block for each redshift bin,
+        #plus the diagonal terms of the single points
+        self.precision = np.zeros((Ntot,Ntot))
+        positions = np.array([offsets[obs]+np.arange(Nbins) for obs in self.binned_obs]).T
+        self.precision[positions[:,:,None],positions[:,None,:]] = np.array([invcov.values for invcov in self.inv_covmats])
+
+        if self.single_data is not None:
+            single_pos = offsets[self.single_obs]+len(self.theory_z[self.single_obs])-len(self.z_single)+np.arange(len(self.z_single))
+            self.precision[single_pos,single_pos] = 1/self.single_data[self.single_obs+'_err'].values**2
+
+        return None
+
     def transform_covmat(self,data):
         #MM to be changed
 
@@ -76,6 +120,15 @@ class BAOLike(Likelihood):
 
         return z_covs
 
+    def get_SKA_covmats(self,data):
+
+        z_covs = [pd.DataFrame([[row['DM_rd_err']**2,row['r_MH']*row['DM_rd_err']*row['DH_rd_err']],
+                                [row['r_MH']*row['DM_rd_err']*row['DH_rd_err'],row['DH_rd_err']**2]],
+                  columns=['DM_rd_{}'.format(ind),'DH_rd_{}'.format(ind)],
+                  index=['DM_rd_{}'.format(ind),'DH_rd_{}'.format(ind)]) for ind,row in data.iterrows()]
+
+        return z_covs
+
     def get_covmats(self,data):
 
         z_covs = [pd.DataFrame([[row['DV_rd_err']**2,row['r_VMH']*row['DV_rd_err']*row['DM_DH_err']],
@@ -87,40 +140,33 @@ class BAOLike(Likelihood):
 
     def get_requirements(self):
         # Requirements are the output of the theory code that you are using
-        requirements = {'DM_DH': None,
-                        'DV_rd': None,
-                        'DM_rd': None,
-                        'DH_rd': None,
-                        #'DV': None,
-                        'alpha_iso': None,
-                        'alpha_AP': None,
-                        'rdrag': None}
+        #Observables are requested only at the redshifts of the data
+        requirements = {obs: {'z': z} for obs,z in self.theory_z.items()}
+        requirements['rdrag'] = None
 
         return requirements
     
     def logp(self, **params_values): 
 
-        if self.data_format == 'DESI':
-
-            if self.observables == 'distances':
-                obs = 'DV_rd'
-            elif self.observables == 'alphas':
-                obs = 'alpha_iso'
-            chi2_single = sum([(row[obs]-self.provider.get_result(obs)(row['z']))**2/row[obs+'_err']**2 for ind,row in self.single_data.iterrows()])
-
-        else:
-            chi2_single = 0.
+        return self.get_loglike(self.provider)
 
-        chi2_vec = []
-        for z,data,invcov in zip(self.z_vec,self.datavectors,self.inv_covmats):
-            obs = ['_'.join(item for item in col.split('_')[:2]) for col in invcov.columns]
-            theoryvec = np.array([self.provider.get_result(o)(z) for o in obs])
-            chi2_vec.append(np.dot(theoryvec-data,np.dot(invcov,theoryvec-data)))
+    def get_loglike(self,provider):
+        #Theory arrays can also have one row per point (e.g. from
+        #BatchTheoryCalcs), one loglike per row is then returned
 
-        chi2_binned = sum(chi2_vec)
+        theoryvec = np.concatenate([provider.get_result(obs,z=z) for obs,z in self.theory_z.items()],axis=-1)
+        diffvec   = theoryvec-self.datavector
 
-        chi2 = chi2_binned+chi2_single
+        chi2 = np.sum(diffvec*np.dot(diffvec,self.precision),axis=-1)
 
         loglike = -0.5*chi2
 
         return loglike
+
+    def get_fisher(self,derivatives):
+        #Fisher matrix from the derivatives of the observables, one row
+        #per parameter (see samplers/fisher.py)
+
+        jacobian = np.concatenate([derivatives.get_result(obs,z=z) for obs,z in self.theory_z.items()],axis=-1)
+
+        return np.dot(jacobian,np.dot(self.precision,jacobian.T))
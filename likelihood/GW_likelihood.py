@@ -2,27 +2,222 @@ import numpy as np
 import pandas as pd
 from scipy.integrate import quad
 from scipy.interpolate import interp1d
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.linalg import cholesky,solve_triangular,cholesky_banded,cho_solve_banded
 from cobaya.likelihood import Likelihood
 
+import sys,os
+from time import time
+
+
+class GWCovariance:
+    #Covariance of the GW events stored according to its structure,
+    #with the matching chi2 kernel:
+    # - diagonal: variances, O(N)
+    # - banded: banded Cholesky factor, O(N*bandwidth)
+    # - block: sparse (block diagonal) inverse, O(sum of block sizes^2)
+    # - dense: Cholesky factor, O(N^2)
+    #The structure is found from the nonzero elements, the cheapest one is
+    #used unless given. C can be a dense array or a scipy.sparse matrix
+
+    #Order of preference for the same cost (sparse products are faster
+    #than banded triangular solves)
+    structures = ['diagonal','block','banded','dense']
+
+    def __init__(self,C,structure=None):
+
+        tini = time()
+
+        C = sparse.coo_array(C)
+        C.sum_duplicates()
+        C.eliminate_zeros()
+        self.N = C.shape[0]
+        off = C.row != C.col
+
+        self.variances = np.zeros(self.N)
+        self.variances[C.row[~off]] = C.data[~off]
+        if np.any(self.variances <= 0):
+            sys.exit('GW covariance matrix has non positive variances!')
+
+        #Bandwidth and blocks (connected groups of events) of the covariance
+        self.bandwidth = int(np.max(abs(C.row-C.col))) if C.nnz > 0 else 0
+        self.nblocks,self.block_labels = connected_components(C,directed=False)
+        block_sizes = np.bincount(self.block_labels)
+
+        #Operations per chi2 of each structure
+        costs = {'diagonal': self.N if self.bandwidth == 0 else np.inf,
+                 'banded': self.N*(self.bandwidth+1),
+                 'block': np.sum(block_sizes**2) if self.nblocks > 1 else np.inf,
+                 'dense': self.N**2/2}
+
+        if structure == None:
+            structure = min(self.structures,key=lambda s: costs[s])
+        elif structure not in self.structures:
+            sys.exit('Unknown GW covariance structure: {}'.format(structure))
+        elif costs[structure] == np.inf:
+            sys.exit('GW covariance matrix has no {} structure'.format(structure))
+        self.structure = structure
+
+        try:
+            if structure == 'diagonal':
+                self.inv_variances = 1/self.variances
+            elif structure == 'banded':
+                #Lower banded storage, band[i-j,j] = C[i,j]
+                lower = C.row >= C.col
+                band  = np.zeros((self.bandwidth+1,self.N))
+                band[C.row[lower]-C.col[lower],C.col[lower]] = C.data[lower]
+                self.band_cholesky = cholesky_banded(band,lower=True)
+            elif structure == 'block':
+                #Blocks of the same size are inverted together, with the
+                #position of each event inside its block
+                order  = np.argsort(self.block_labels,kind='stable')
+                starts = np.cumsum(block_sizes)-block_sizes
+                pos    = np.empty(self.N,dtype=int)
+                pos[order] = np.arange(self.N)-starts[self.block_labels[order]]
+                sizes  = block_sizes[self.block_labels]
+                rows,cols,vals = [],[],[]
+                for m in np.unique(block_sizes):
+                    group = np.full(self.nblocks,-1)
+                    group[block_sizes == m] = np.arange(np.sum(block_sizes == m))
+                    events  = np.where(sizes == m)[0]
+                    members = np.empty((np.sum(block_sizes == m),m),dtype=int)
+                    members[group[self.block_labels[events]],pos[events]] = events
+                    sel    = sizes[C.row] == m
+                    blocks = np.zeros((len(members),m,m))
+                    blocks[group[self.block_labels[C.row[sel]]],pos[C.row[sel]],pos[C.col[sel]]] = C.data[sel]
+                    #Raises LinAlgError if a block is not positive definite
+                    np.linalg.cholesky(blocks)
+                    rows.append(np.broadcast_to(members[:,:,None],blocks.shape).ravel())
+                    cols.append(np.broadcast_to(members[:,None,:],blocks.shape).ravel())
+                    vals.append(np.linalg.inv(blocks).ravel())
+                self.inverse = sparse.csr_array((np.concatenate(vals),(np.concatenate(rows),np.concatenate(cols))),shape=(self.N,self.N))
+            else:
+                self.cholesky = cholesky(C.toarray(),lower=True)
+        except np.linalg.LinAlgError as e:
+            sys.exit('GW covariance matrix is not positive definite!\n {}'.format(e))
+
+        self.setup_time = time()-tini
+
+    @property
+    def nbytes(self):
+
+        if self.structure == 'diagonal':
+            return self.inv_variances.nbytes
+        elif self.structure == 'banded':
+            return self.band_cholesky.nbytes
+        elif self.structure == 'block':
+            return self.inverse.data.nbytes+self.inverse.indices.nbytes+self.inverse.indptr.nbytes
+        else:
+            return self.cholesky.nbytes
+
+    def chi2(self,diff):
+
+        #diff can also have one row per point, one chi2 per row
+        if self.structure == 'diagonal':
+            return np.sum(diff**2*self.inv_variances,axis=-1)
+
+        diff = diff.T
+        if self.structure == 'banded':
+            return np.sum(diff*cho_solve_banded((self.band_cholesky,True),diff,check_finite=False),axis=0)
+        elif self.structure == 'block':
+            return np.sum(diff*(self.inverse@diff),axis=0)
+        else:
+            whitened = solve_triangular(self.cholesky,diff,lower=True,check_finite=False)
+            return np.sum(whitened**2,axis=0)
+
+    def fisher(self,jacobian):
+
+        #jacobian C^-1 jacobian^T, one row of the jacobian per parameter
+        if self.structure == 'diagonal':
+            return np.dot(jacobian*self.inv_variances,jacobian.T)
+
+        jacobian = jacobian.T
+        if self.structure == 'banded':
+            return np.dot(jacobian.T,cho_solve_banded((self.band_cholesky,True),jacobian,check_finite=False))
+        elif self.structure == 'block':
+            return jacobian.T@(self.inverse@jacobian)
+        else:
+            whitened = solve_triangular(self.cholesky,jacobian,lower=True,check_finite=False)
+            return np.dot(whitened.T,whitened)
+
+    def get_report(self,ncalls=100):
+
+        diff = np.random.default_rng(0).normal(size=self.N)*np.sqrt(self.variances)
+        tini = time()
+        for i in range(ncalls):
+            self.chi2(diff)
+        call_time = (time()-tini)/ncalls
+
+        if self.structure == 'banded':
+            details = ' (bandwidth {})'.format(self.bandwidth)
+        elif self.structure == 'block':
+            details = ' ({} blocks)'.format(self.nblocks)
+        else:
+            details = ''
+
+        return 'GW covariance: {} events, {}{}, set up in {:.3f} s, {:.2f} MB (dense inverse {:.2f} MB), {:.1f} us per chi2'.format(self.N,
+                                                                                                                                  self.structure,
+                                                                                                                                  details,
+                                                                                                                                  self.setup_time,
+                                                                                                                                  self.nbytes/1024**2,
+                                                                                                                                  8*self.N**2/1024**2,
+                                                                                                                                  1.e6*call_time)
+
+
 class GWLike(Likelihood):
-    
+
     def initialize(self):
 
+        tini = time()
+
         self.dataset_GW = pd.read_csv(self.GW_data_path+'_data.txt',sep='\s+',header=0)
-        covmat          = pd.read_csv(self.GW_data_path+'_covmat.txt',sep='\s+',header=0)
-        self.invcovmat  = np.linalg.inv(covmat)
+
+        #Large catalogues can give the covariance as a scipy.sparse matrix
+        #(_covmat.npz, see scipy.sparse.save_npz) or, if diagonal, as the
+        #err_dL column of the data, instead of the dense _covmat.txt
+        if os.path.exists(self.GW_data_path+'_covmat.npz'):
+            covmat = sparse.load_npz(self.GW_data_path+'_covmat.npz')
+        elif os.path.exists(self.GW_data_path+'_covmat.txt'):
+            covmat = pd.read_csv(self.GW_data_path+'_covmat.txt',sep='\s+',header=0).values
+        elif 'err_dL' in self.dataset_GW:
+            covmat = sparse.diags_array(np.array(self.dataset_GW['err_dL'].values,dtype=float)**2)
+        else:
+            sys.exit('No GW covariance found at the following path: {}'.format(self.GW_data_path))
+        load_time = time()-tini
+
+        self.covmat = GWCovariance(covmat,self.covmat_structure)
+        print('GW data loaded in {:.3f} s'.format(load_time))
+        print(self.covmat.get_report())
+
+        #Diagonal of the covariance, e.g. for error bars
+        self.variances = self.covmat.variances
+
+        self.z_GW  = np.array(self.dataset_GW['z'].values,dtype=float)
+        self.dL_GW = np.array(self.dataset_GW['dL'].values,dtype=float)
 
     def get_requirements(self):
         # Requirements are the output of the theory code that you are using
-        requirements = {'DL_GW': None}
+        requirements = {'DL_GW': {'z': self.z_GW}}
 
         return requirements
-    
-    def logp(self, **params_values): 
-        
-        diffvec_GW = (self.provider.get_result('DL_GW')(self.dataset_GW['z'].values))-(self.dataset_GW['dL'].values)
-        
 
-        loglike = -0.5*np.dot((diffvec_GW),np.dot(self.invcovmat,(diffvec_GW)))
+    def logp(self, **params_values):
+
+        return self.get_loglike(self.provider)
+
+    def get_loglike(self,provider):
+        #Theory arrays can also have one row per point (e.g. from
+        #BatchTheoryCalcs), one loglike per row is then returned
+
+        diffvec_GW = provider.get_result('DL_GW',z=self.z_GW)-self.dL_GW
+
+        loglike = -0.5*self.covmat.chi2(diffvec_GW)
 
         return loglike
+
+    def get_fisher(self,derivatives):
+        #Fisher matrix from the derivatives of the observables, one row
+        #per parameter (see samplers/fisher.py)
+
+        return self.covmat.fisher(np.atleast_2d(derivatives.get_result('DL_GW',z=self.z_GW)))
@@ -2,9 +2,146 @@ import numpy as np
 import pandas as pd
 from scipy.integrate import quad
 from scipy.interpolate import interp1d
+from scipy.linalg import cholesky,solve_triangular,cho_solve,eigh,qr
+from scipy.sparse.linalg import cg,LinearOperator
 from cobaya.likelihood import Likelihood
 
-import sys
+import sys,os
+import hashlib
+import glob
+from time import time
+
+
+class LowRankCovariance:
+    #Covariance approximated as diagonal plus low rank, C ~ D + U diag(lam) U^T,
+    #with chi2 from the Woodbury identity in O(N*rank):
+    #  C^-1 = D^-1 - W M^-1 W^T,  W = D^-1 U,  M = diag(1/lam) + U^T D^-1 U
+    #D and U are found by iterating eigendecompositions of C-D (principal
+    #axis factoring), starting from D = diag(C)/2. The rank is doubled
+    #until the chi2 of the test vectors (draws C g, whose exact chi2 is g^T C g,
+    #plus the given ones, rescaled to chi2 = N) is within tolerance of the exact one.
+    #rank is None if the tolerance cannot be reached below max_rank.
+    #C is only multiplied by blocks of vectors: the largest eigenvectors of C-D
+    #come from a randomized subspace iteration started from those of the
+    #previous iteration, and the exact chi2 of the given vectors from conjugate
+    #gradients. Apart from C itself, the setup then needs O(N*rank) memory and
+    #no Cholesky factor or other N^2 arrays. C still has to be given as a dense
+    #matrix, so for tens of thousands of objects it has to fit in memory once
+
+    iterations       = 10
+    oversampling     = 10
+    power_iterations = 2
+
+    def __init__(self,C,tolerance,max_rank=None,test_vectors=[],ndraws=20):
+
+        tini = time()
+
+        N = len(C)
+        self.N = N
+        self.tolerance = tolerance
+        self.max_rank  = max_rank if max_rank != None else N//4
+        self.rng       = np.random.default_rng(0)
+
+        diagC = np.diag(C).copy()
+
+        #Test vectors and their exact chi2. For the draws C g it is g^T C g,
+        #the given vectors need C^-1 vec (conjugate gradients)
+        gauss   = self.rng.normal(size=(N,ndraws))
+        vectors = C@gauss
+        exact   = np.sum(gauss*vectors,axis=0)
+        for vec in test_vectors:
+            sol,info = cg(C,vec,rtol=1.e-10,atol=0.,M=LinearOperator((N,N),matvec=lambda x: x/diagC))
+            if info != 0:
+                sys.exit('Conjugate gradients for the SN test vectors did not converge')
+            vectors = np.c_[vectors,vec]
+            exact   = np.append(exact,np.dot(vec,sol))
+        vectors *= np.sqrt(N/exact)
+        exact    = np.full(len(exact),float(N))
+
+        #Each rank starts from the diagonal and the eigenvectors
+        #found with the previous one
+        self.rank  = None
+        self.basis = None
+        rank = 1
+        D = diagC/2
+        while rank <= self.max_rank:
+            for i in range(self.iterations):
+                lam,U = self.get_eigen(C,D,rank)
+                keep  = lam > 0
+                lam,U = lam[keep],U[:,keep]
+                #Diagonal kept positive
+                newD = np.maximum(diagC-np.sum(U**2*lam,axis=1),1.e-3*diagC)
+                converged = np.max(abs(newD/D-1)) < 1.e-4
+                D = newD
+                if converged:
+                    break
+            self.set_factors(D,U,lam)
+            self.error = np.max(abs(self.chi2(vectors)-exact))
+            if self.error < tolerance:
+                self.rank = len(lam)
+                break
+            rank *= 2
+
+        del self.basis
+        self.setup_time = time()-tini
+
+    def get_eigen(self,C,D,rank):
+
+        #Largest eigenvalues of C-D from a randomized subspace iteration
+        #(Halko, Martinsson & Tropp 2011) with a few more vectors than the rank,
+        #started from the basis of the last call (random vectors added if the
+        #rank grows). Only products of C with N x (rank+oversampling) blocks
+        size = rank+self.oversampling
+        if self.basis is None:
+            self.basis = self.rng.normal(size=(len(C),size))
+        elif self.basis.shape[1] < size:
+            self.basis = np.c_[self.basis,self.rng.normal(size=(len(C),size-self.basis.shape[1]))]
+
+        Q = self.basis
+        for i in range(self.power_iterations):
+            Q,_ = qr(C@Q-D[:,None]*Q,mode='economic')
+
+        lam,V = eigh(Q.T@(C@Q)-(Q*D[:,None]).T@Q)
+        self.basis = Q@V
+
+        return lam[-rank:],self.basis[:,-rank:]
+
+    def set_factors(self,D,U,lam):
+
+        self.inv_diag = 1/D
+        self.W        = U*self.inv_diag[:,None]
+        M = np.diag(1/lam)+U.T@self.W
+        self.M_cholesky = cholesky(M,lower=True)
+
+    @property
+    def nbytes(self):
+
+        return self.inv_diag.nbytes+self.W.nbytes+self.M_cholesky.nbytes
+
+    def chi2(self,vec):
+
+        #vec can also be a (N,nvec) array, one chi2 per column
+        w = solve_triangular(self.M_cholesky,self.W.T@vec,lower=True,check_finite=False)
+        return np.sum(vec**2*(self.inv_diag if vec.ndim == 1 else self.inv_diag[:,None]),axis=0)-np.sum(w**2,axis=0)
+
+    def solve(self,vec):
+
+        #C^-1 vec
+        return vec*self.inv_diag-self.W@cho_solve((self.M_cholesky,True),self.W.T@vec)
+
+    def get_report(self):
+
+        if self.rank == None:
+            return 'SN covariance not compressed: chi2 error above {} up to rank {} (error {:.2e}), set up in {:.2f} s'.format(self.tolerance,
+                                                                                                                              self.max_rank,
+                                                                                                                              self.error,
+                                                                                                                              self.setup_time)
+
+        return 'SN covariance compressed to diagonal + rank {}: chi2 error {:.2e}, {:.2f} MB (dense {:.2f} MB), set up in {:.2f} s'.format(self.rank,
+                                                                                                                                       self.error,
+                                                                                                                                       self.nbytes/1024**2,
+                                                                                                                                       8*self.N**2/1024**2,
+                                                                                                                                       self.setup_time)
 
 class SNLike(Likelihood):
     
@@ -26,7 +163,59 @@ class SNLike(Likelihood):
                 print("SN dataset and covariance matrix files not found at the following path: {}".format(self.SN_data_path))
                 sys.exit(1)
 
-        self.invcovmat  = np.linalg.inv(covmat)
+        self.covmat = np.array(covmat,dtype=float)
+
+        self.z_SN  = np.array(self.dataset_SN['z'].values,dtype=float)
+        self.mB_SN = np.array(self.dataset_SN['mB'].values,dtype=float)
+
+        #Optional diagonal plus low rank covariance (see LowRankCovariance),
+        #e.g. covmat_compression: {tolerance: 0.01, max_rank: 200}.
+        #Test vectors include a constant and smooth functions of z,
+        #as the differences of magnitudes between models
+        self.lowrank = None
+        if self.covmat_compression != None:
+            trends  = [np.ones(len(self.z_SN)),np.log(self.z_SN),self.z_SN]
+            lowrank = LowRankCovariance(self.covmat,test_vectors=trends,**self.covmat_compression)
+            print(lowrank.get_report())
+            if lowrank.rank != None:
+                self.lowrank = lowrank
+                del self.covmat
+
+        #Otherwise the chi2 is computed with the Cholesky factor C = L L^T,
+        #chi2 = |L^-1 d|^2, i.e. one triangular solve per call
+        if self.lowrank == None:
+            try:
+                self.cholesky = cholesky(self.covmat,lower=True)
+            except np.linalg.LinAlgError as e:
+                sys.exit('SN covariance matrix is not positive definite!\n {}'.format(e))
+
+        if self.calibration == 'Marginalized':
+            #Constant terms of the marginalized chi2, C^-1 1 and 1^T C^-1 1
+            unit = np.ones(len(self.z_SN))
+            if self.lowrank != None:
+                self.precision_unit = self.lowrank.solve(unit)
+            else:
+                self.precision_unit = cho_solve((self.cholesky,True),unit)
+            self.e_marg      = np.sum(self.precision_unit)
+            self.chi2_marg_0 = np.log(self.e_marg/(2*np.pi))
+        elif self.calibration == 'SH0ES':
+            self.calibrator_idx       = np.where(self.is_calibrator)[0]
+            self.z_calibrators        = self.z_SN[self.calibrator_idx]
+            self.cepheid_calibrators  = self.cepheid_distance[self.calibrator_idx]
+
+    def whiten(self,vec):
+
+        return solve_triangular(self.cholesky,vec,lower=True,check_finite=False)
+
+    def chi2(self,vec):
+
+        #vec^T C^-1 vec, one triangular solve or the Woodbury identity.
+        #vec can also have one row per point, one chi2 per row
+        if self.lowrank != None:
+            return self.lowrank.chi2(vec.T)
+
+        wvec = self.whiten(vec.T)
+        return np.sum(wvec**2,axis=0)
 
     def build_data(self):
         
@@ -53,32 +242,56 @@ class SNLike(Likelihood):
         filename = self.SN_data_path+'_covmat.txt' 
         print("Loading covariance from {}".format(filename))
 
+        ww = np.array(self.ww,dtype=bool)
+
+        #The trimmed covariance is stored in a .npy file next to the original one.
+        #Its name contains a hash of the covariance file and one of the selection
+        #mask, so changing either of them points to a new cache file
+        if self.covmat_cache:
+            key = hashlib.sha256()
+            with open(filename,'rb') as f:
+                for chunk in iter(lambda: f.read(2**24),b''):
+                    key.update(chunk)
+            filekey   = key.hexdigest()[:16]
+            maskkey   = hashlib.sha256(np.packbits(ww).tobytes()).hexdigest()[:8]
+            cachename = filename[:-4]+'.{}.{}.npy'.format(filekey,maskkey)
+
+            if os.path.exists(cachename):
+                print('Using cached covariance {}'.format(cachename))
+                return np.load(cachename)
+
         # The file format for the covariance has the first line as an integer
         # indicating the number of covariance elements, and the the subsequent
         # lines being the elements.
-        # This function reads in the file and the nasty for loops trim down the covariance
-        # to match the only rows of data that are used for cosmology
-
-        f = open(filename)
-        line = f.readline()
-        n = int(len(self.zCMB))
-        C = np.zeros((n,n))
-        ii = -1
-        jj = -1
-        mine = 999
-        maxe = -999
-        for i in range(self.origlen):
-            jj = -1
-            if self.ww[i]:
-                ii += 1
-            for j in range(self.origlen):
-                if self.ww[j]:
-                    jj += 1
-                val = float(f.readline())
-                if self.ww[i]:
-                    if self.ww[j]:
-                        C[ii,jj] = val
-        f.close()
+        # The file is read in one go and trimmed down to match the only rows
+        # of data that are used for cosmology
+
+        with open(filename) as f:
+            n = int(f.readline())
+        if n != self.origlen:
+            sys.exit('SN covariance size ({}) does not match the data ({})'.format(n,self.origlen))
+
+        C = pd.read_csv(filename,header=None,skiprows=1,dtype=float).values.reshape(n,n)
+        C = C[np.ix_(ww,ww)]
+
+        if self.covmat_cache:
+            #Written to a temporary file first, so that other processes
+            #never read a partially written cache
+            try:
+                tmpname = cachename+'.{}.tmp'.format(os.getpid())
+                with open(tmpname,'wb') as f:
+                    np.save(f,C)
+                os.replace(tmpname,cachename)
+                print('Covariance cached in {}'.format(cachename))
+                #Caches of older versions of the file are removed, those of
+                #other masks are kept (names with a single hash are older caches)
+                prefix = filename[:-4]+'.'
+                for stale in glob.glob(glob.escape(prefix)+'[0-9a-f]'*16+'*.npy'):
+                    if not stale[len(prefix):].startswith(filekey+'.'):
+                        os.remove(stale)
+                        print('Removed stale covariance cache {}'.format(stale))
+            except OSError as e:
+                print('Could not cache the covariance: {}'.format(e))
 
         print('Done')
 
@@ -87,30 +300,32 @@ class SNLike(Likelihood):
 
     def get_requirements(self):
         # Requirements are the output of the theory code that you are using
-        requirements = {'mB': None,'abs_mag': None}
+        requirements = {'mB': {'z': self.z_SN}}
+        if self.calibration == 'SH0ES':
+            requirements['abs_mag'] = {'z': self.z_calibrators}
 
         return requirements
     
     def logp(self, **params_values): 
 
+        return self.get_loglike(self.provider)
+
+    def get_loglike(self,provider):
+        #Theory arrays can also have one row per point (e.g. from
+        #BatchTheoryCalcs), one loglike per row is then returned
+
         if self.calibration != None:
             if self.calibration == 'SH0ES':
-                z = self.dataset_SN['z'].values
-                mB_theory = np.zeros_like(z)
-                mB_theory[self.is_calibrator] = self.cepheid_distance[self.is_calibrator]+self.provider.get_result('abs_mag')(z[self.is_calibrator])
-                mB_theory[~self.is_calibrator] = self.provider.get_result('mB')(z[~self.is_calibrator])
-                diffvec_SN = mB_theory - self.dataset_SN['mB'].values
-                loglike = -0.5*np.dot(diffvec_SN,np.dot(self.invcovmat,diffvec_SN))
+                mB_theory = np.array(provider.get_result('mB',z=self.z_SN))
+                mB_theory[...,self.calibrator_idx] = self.cepheid_calibrators+provider.get_result('abs_mag',z=self.z_calibrators)
+                loglike = -0.5*self.chi2(mB_theory-self.mB_SN)
             elif self.calibration == 'Marginalized':
-                diffvec_SN = (self.provider.get_result('mB')(self.dataset_SN['z'].values))-(self.dataset_SN['mB'].values)
-
-                unit = np.ones(len(diffvec_SN))
+                diffvec_SN = provider.get_result('mB',z=self.z_SN)-self.mB_SN
 
-                a = np.dot(diffvec_SN,np.dot(self.invcovmat,diffvec_SN))
-                b = np.dot(diffvec_SN,np.dot(self.invcovmat,unit))
-                e = np.dot(unit,np.dot(self.invcovmat,unit))
+                a = self.chi2(diffvec_SN)
+                b = np.dot(diffvec_SN,self.precision_unit)
 
-                chi2_marg = a+ np.log(e/(2*np.pi)) - b**2/e
+                chi2_marg = a+self.chi2_marg_0-b**2/self.e_marg
 
                 loglike = -0.5 * chi2_marg
             else:
@@ -118,8 +333,29 @@ class SNLike(Likelihood):
 
         else:
             
-            diffvec_SN = self.provider.get_result('mB')(self.dataset_SN['z'].values)-self.dataset_SN['mB'].values
-            loglike = -0.5*np.dot(diffvec_SN,np.dot(self.invcovmat,diffvec_SN))
+            loglike = -0.5*self.chi2(provider.get_result('mB',z=self.z_SN)-self.mB_SN)
+
+
+        return loglike
+
+    def get_fisher(self,derivatives):
+        #Fisher matrix from the derivatives of the observables, one row
+        #per parameter (see samplers/fisher.py). The calibrators depend
+        #on abs_mag as in get_loglike
+
+        jacobian = np.array(derivatives.get_result('mB',z=self.z_SN))
+        if self.calibration == 'SH0ES':
+            jacobian[:,self.calibrator_idx] = derivatives.get_result('abs_mag',z=self.z_calibrators)
+
+        if self.lowrank != None:
+            fisher = np.dot(jacobian,self.lowrank.solve(jacobian.T))
+        else:
+            whitened = self.whiten(jacobian.T)
+            fisher   = np.dot(whitened.T,whitened)
 
+        #The marginalized chi2 does not depend on a constant shift of mB
+        if self.calibration == 'Marginalized':
+            b = np.dot(jacobian,self.precision_unit)
+            fisher -= np.outer(b,b)/self.e_marg
 
-        return loglike
\ No newline at end of file
+        return fisher
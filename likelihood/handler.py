@@ -78,6 +78,11 @@ class LikelihoodHandler:
                     'use_Pantheon': SNinfo['use_Pantheon'],
                     'calibration': calibration}
 
+        if 'covmat_cache' in SNinfo:
+            sn_dict['covmat_cache'] = SNinfo['covmat_cache']
+        if 'covmat_compression' in SNinfo:
+            sn_dict['covmat_compression'] = SNinfo['covmat_compression']
+
         return sn_dict
 
     def setup_GW(self,GWinfo):
@@ -90,6 +95,9 @@ class LikelihoodHandler:
         gw_dict = {'external': GWLike,
                    'GW_data_path': GWinfo['path']}
 
+        if 'covmat_structure' in GWinfo:
+            gw_dict['covmat_structure'] = GWinfo['covmat_structure']
+
         return gw_dict
 
 
@@ -15,12 +15,25 @@ threshold             = 1     #Percentage of difference from reference within wh
 get_plot              = False #Set to True if you want a plot
 observables_reference = pd.read_csv('testing/reference_results.txt',sep='\t',header=0)
 test_likelihood_value = False
+emulator_file         = None  #Emulator to be checked against CAMB (see theory_code/emulator.py)
 
 
 print('')
 print('TESTING THEORY CODE')
 print('')
 obs_test = test_observables(observables_reference,threshold,get_plot)
+int_test = test_comoving_integrator(1.e-6)
+ana_test = test_analytic_expansion(threshold)
+ode_test = test_ode_expansion(1.e-4)
+grid_test = find_minimum_Nz(1.e-4)
+ddr_test = test_DDR_parametrizations(1.e-5)
+gw_test  = test_GW_covariance(1.e-8)
+sn_test  = test_SN_compression(1.e-2)
+ens_test = test_batch_posterior(1.e-8)
+evid_test = test_grid_evidence(1.e-2)
+fish_test = test_fisher(1.e-6)
+if emulator_file != None:
+    emu_test = test_emulator(threshold,emulator_file)
 
 print('')
 print('TESTING RUNNING SETTINGS')
@@ -0,0 +1,228 @@
+import sys,os
+import yaml
+import numpy  as np
+import pandas as pd
+
+from time import time
+
+from samplers.nautilus import set_num_threads,start_pool,close_run
+from theory_code.distance_theory import BatchTheoryCalcs
+
+
+class BatchPosterior:
+    #Log-posterior of many points with one call of the theory
+    #(BatchTheoryCalcs) and of each likelihood (get_loglike) for all of them.
+    #The Cobaya model is used for the data, the priors and the parameterization
+    #(fixed and derived input parameters), never for the theory.
+    #Vectorized expansion modules (e.g. Custom) are computed for all points
+    #together, the others on the pool of processes, if given.
+    #Points where the background fails have zero posterior
+
+    def __init__(self,info,pool=None):
+
+        from cobaya.model import get_model
+
+        #Only the blocks of the model, the others are for CANDI
+        self.model  = get_model({block: info[block] for block in ['params','likelihood','theory','prior'] if block in info})
+        self.pool   = pool
+
+        calcdist  = self.model.theory['CalcDist']
+        self.cosmology = calcdist.cosmology
+        self.settings  = calcdist.settings
+        #Built by CalcDist only if the alphas are requested
+        self.fiducial  = calcdist.fiducial
+        self.DDR       = self.model.theory['CalcDDR'].DDR_options
+
+        self.sampled = list(self.model.parameterization.sampled_params())
+        self.ndim    = len(self.sampled)
+
+        #Derived parameters written in the chains: outputs of the expansion
+        #module and functions of the parameters (e.g. omch2), as in Cobaya
+        self.output  = list(self.model.parameterization.output_params())
+        self.derived = list(self.model.parameterization.derived_params())
+
+        self.nevals  = 0
+        self.nfailed = 0
+        self.time    = 0.
+
+    def get_theory(self,points):
+
+        #Cobaya reuses the dictionary of the input parameters,
+        #so values are copied point by point
+        inputs = []
+        for point in points:
+            inp = self.model.parameterization.to_input(dict(zip(self.sampled,point)))
+            inputs.append([inp[par] for par in inp])
+
+        return BatchTheoryCalcs(self.settings,self.cosmology,list(inp.keys()),inputs,
+                                DDR=self.DDR,pool=self.pool,fiducial=self.fiducial)
+
+    def get_derived(self,points,theory):
+
+        #Cobaya evaluates the derived parameters of the last input point,
+        #so each point is set again before
+        derived = np.full((len(points),len(self.derived)),np.nan)
+        for j,point in enumerate(points):
+            self.model.parameterization.to_input(dict(zip(self.sampled,point)))
+            values = self.model.parameterization.to_derived({par: getattr(theory,par)[j] for par in self.output})
+            derived[j] = [values[par] for par in self.derived]
+
+        return derived
+
+    def evaluate(self,points):
+
+        #Log-prior, log-likelihood and derived parameters of the points,
+        #the likelihood is not computed outside the prior (-inf)
+        tini = time()
+
+        points  = np.atleast_2d(points)
+        npoints = len(points)
+        loglike = np.full(npoints,-np.inf)
+        derived = np.full((npoints,len(self.derived)),np.nan)
+
+        logprior = np.array([self.model.prior.logp(point) for point in points])
+        inside   = np.where(np.isfinite(logprior))[0]
+
+        if len(inside) > 0:
+            theory = self.get_theory(points[inside])
+
+            #Failed points have NaN observables, their loglike is discarded
+            like_inside = np.zeros(len(inside))
+            with np.errstate(invalid='ignore'):
+                for like in self.model.likelihood.values():
+                    like_inside += like.get_loglike(theory)
+            like_inside[~theory.valid] = -np.inf
+
+            if not np.all(theory.valid):
+                if self.nfailed == 0:
+                    error = next(iter(theory.errors.values()),'expansion history is not finite')
+                    print('Background failed, these points have zero posterior:\n {}'.format(error))
+                self.nfailed += np.sum(~theory.valid)
+
+            loglike[inside] = np.where(np.isfinite(like_inside),like_inside,-np.inf)
+            derived[inside] = self.get_derived(points[inside],theory)
+
+        self.nevals += npoints
+        self.time   += time()-tini
+
+        return logprior,loglike,derived
+
+    def __call__(self,points):
+
+        logprior,loglike,derived = self.evaluate(points)
+        logpost = np.where(np.isfinite(loglike),logprior+loglike,-np.inf)
+
+        return logpost,derived
+
+
+def stretch_move(walkers,others,rng,a):
+
+    #Affine-invariant stretch move of Goodman & Weare (2010)
+    n,ndim = walkers.shape
+    zz = ((a-1)*rng.uniform(size=n)+1)**2/a
+    partners = others[rng.integers(len(others),size=n)]
+
+    return partners+zz[:,None]*(walkers-partners),(ndim-1)*np.log(zz)
+
+def DE_move(walkers,others,rng,a):
+
+    #Differential evolution move (ter Braak 2006), a is not used
+    n,ndim = walkers.shape
+    gamma  = 2.38/np.sqrt(2*ndim)
+    first  = rng.integers(len(others),size=n)
+    second = (first+rng.integers(1,len(others),size=n)) % len(others)
+    jitter = 1.e-5*np.std(others,axis=0)*rng.normal(size=(n,ndim))
+
+    return walkers+gamma*(others[first]-others[second])+jitter,np.zeros(n)
+
+ensemble_moves = {'stretch': stretch_move,
+                  'DE': DE_move}
+
+
+def get_pool(sets):
+
+    #Processes compute the backgrounds that are not vectorized (e.g. CAMB),
+    #so they are forked before the model is built
+    if sets['pool'] != None and sets['pool'] > 1:
+        return start_pool(sets['pool'],sets['num_threads'],initargs=(sets['num_threads'],))
+    else:
+        set_num_threads(sets['num_threads'])
+        return None
+
+
+def ensemble_interface(info):
+
+    sets = info['sampler']['ensemble']
+
+    print('')
+    print('RUNNING WITH ENSEMBLE SAMPLER')
+    print('')
+
+    pool      = get_pool(sets)
+    posterior = BatchPosterior(info,pool=pool)
+    ndim      = posterior.ndim
+
+    nwalkers = sets['nwalkers'] if sets['nwalkers'] != None else max(16,4*ndim)
+    nwalkers += nwalkers % 2
+    if sets['move'] not in ensemble_moves:
+        sys.exit('Unknown ensemble move: {}'.format(sets['move']))
+    move = ensemble_moves[sets['move']]
+
+    rng = np.random.default_rng(sets['seed'])
+
+    #Walkers start from the reference distributions of the parameters
+    walkers = np.array([posterior.model.prior.reference(random_state=rng) for i in range(nwalkers)])
+    logpost,derived = posterior(walkers)
+    if not np.all(np.isfinite(logpost)):
+        sys.exit('Some walkers start where the posterior is zero, check the ref of the parameters')
+
+    print('Sampling {} parameters with {} walkers, {} steps, {} move'.format(ndim,nwalkers,sets['nsteps'],sets['move']))
+
+    half     = nwalkers//2
+    nburn    = int(sets['burn_in']*sets['nsteps'])
+    chain    = []
+    accepted = 0
+
+    tini = time()
+    for step in range(sets['nsteps']):
+        #Each half moves with respect to the other one, all its walkers together
+        for first,second in [(slice(0,half),slice(half,None)),(slice(half,None),slice(0,half))]:
+            proposal,logjac = move(walkers[first],walkers[second],rng,sets['a'])
+            newpost,newder  = posterior(proposal)
+
+            accept = np.log(rng.uniform(size=half)) < logjac+newpost-logpost[first]
+            walkers[first][accept] = proposal[accept]
+            logpost[first][accept] = newpost[accept]
+            derived[first][accept] = newder[accept]
+            accepted += np.sum(accept)
+
+        if step >= nburn and (step-nburn) % sets['thin'] == 0:
+            chain.append(np.c_[np.ones(nwalkers),-logpost,walkers,derived])
+
+        if (step+1) % max(1,sets['nsteps']//10) == 0:
+            print('Step {}/{}: acceptance {:.2f}, max log-posterior {:.3f}'.format(step+1,sets['nsteps'],
+                                                                              accepted/((step+1)*nwalkers),np.max(logpost)))
+    tend = time()
+
+    close_run(posterior.model,pool,sets['pool'])
+
+    print('Likelihood evaluations: {} in {:.1f} s ({:.1f} points/s)'.format(posterior.nevals,tend-tini,posterior.nevals/(tend-tini)))
+    if posterior.nfailed > 0:
+        print('Background failed for {} points'.format(posterior.nfailed))
+    print('Acceptance fraction: {:.3f}'.format(accepted/(sets['nsteps']*nwalkers)))
+
+    #Same outputs as the Nautilus interface, read by Analyzer
+    ensemble_dict = {par: info['params'][par].get('latex',par) for par in posterior.sampled+posterior.derived}
+
+    if 'output' in info and info['output'] != '':
+        with open(info['output']+'.params.yaml', 'w') as outfile:
+            yaml.dump(ensemble_dict, outfile, default_flow_style=False)
+
+    results = pd.DataFrame(np.concatenate(chain),columns=['weight','minuslogpost']+list(ensemble_dict.keys()))
+
+    if 'output' in info:
+        results.to_csv(info['output']+'_chain.txt',sep='\t',header=False,index=False)
+
+    print('ENSEMBLE SAMPLING FINISHED')
+
+    return results,ensemble_dict
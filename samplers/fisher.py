@@ -0,0 +1,168 @@
+import sys,os
+import yaml
+import numpy  as np
+import pandas as pd
+
+from time import time
+
+from samplers.ensemble import BatchPosterior,get_pool
+from samplers.nautilus import close_run
+
+
+#Five point central stencil, f' = sum(coefficients*f(x+offsets*h))/h
+stencil_offsets      = np.array([-2.,-1.,1.,2.])
+stencil_coefficients = np.array([1.,-8.,8.,-1.])/12.
+
+
+class StencilDerivatives:
+    #Derivatives of the observables of BatchTheoryCalcs (theory) computed on
+    #the stencils of each parameter for each step in steps (nsteps x nparams,
+    #halved from one to the next). For each observable and parameter the step
+    #where the derivative changes less from the previous one is used, which
+    #balances the truncation error of the large steps and the numerical noise
+    #of the small ones. Steps with failed stencil points are skipped.
+    #get_result has the same names as BatchTheoryCalcs and gives one row per
+    #parameter, as needed by the get_fisher methods of the likelihoods
+
+    def __init__(self,theory,steps):
+
+        self.theory = theory
+        self.steps  = steps
+        self.nsteps,self.nparams = steps.shape
+        self.chosen = {}
+
+        #Steps where all the points of the stencil have a background
+        self.valid = theory.valid.reshape(self.nsteps,self.nparams,len(stencil_offsets)).all(axis=2)
+
+    def get_result(self,name,z=None):
+
+        values  = np.array(self.theory.get_result(name,z))
+        stencil = values.reshape((self.nsteps,self.nparams,len(stencil_offsets))+values.shape[1:])
+        derivs  = np.tensordot(stencil,stencil_coefficients,axes=([2],[0]))
+        derivs  = derivs/self.steps.reshape(self.steps.shape+(1,)*(derivs.ndim-2))
+
+        if self.nsteps == 1:
+            best = np.zeros(self.nparams,dtype=int)
+        else:
+            flat   = derivs.reshape(self.nsteps,self.nparams,-1)
+            change = np.max(np.abs(np.diff(flat,axis=0)),axis=-1)
+            change = np.where(self.valid[1:] & self.valid[:-1],change,np.inf)
+            best   = 1+np.argmin(change,axis=0)
+            #Without two consecutive valid steps, the first valid one
+            single = np.all(np.isinf(change),axis=0)
+            best[single] = np.argmax(self.valid[:,single],axis=0)
+        self.chosen[name] = self.steps[best,np.arange(self.nparams)]
+
+        return derivs[best,np.arange(self.nparams)]
+
+
+def fisher_interface(info):
+
+    sets = info['sampler']['fisher']
+
+    print('')
+    print('COMPUTING FISHER MATRIX')
+    print('')
+
+    pool      = get_pool(sets)
+    posterior = BatchPosterior(info,pool=pool)
+    params    = posterior.sampled
+
+    #Fiducial from the options or the reference of the parameters,
+    #first step from the options, the proposal or the reference width
+    fiducial = []
+    steps    = []
+    for par in params:
+        pinfo = info['params'][par]
+        ref   = pinfo.get('ref',{})
+        if par in sets['fiducial']:
+            fiducial.append(sets['fiducial'][par])
+        elif type(ref) == dict and 'loc' in ref:
+            fiducial.append(ref['loc'])
+        elif type(ref) in [int,float]:
+            fiducial.append(ref)
+        else:
+            sys.exit('No fiducial value for {}, give it in the fiducial option'.format(par))
+
+        if par in sets['step']:
+            steps.append(sets['step'][par])
+        elif 'proposal' in pinfo:
+            steps.append(pinfo['proposal'])
+        elif type(ref) == dict and 'scale' in ref:
+            steps.append(ref['scale'])
+        else:
+            steps.append(0.01*max(abs(fiducial[-1]),1.))
+    fiducial = np.array(fiducial,dtype=float)
+    steps    = np.array(steps,dtype=float)[None,:]/2.**np.arange(sets['nsteps'])[:,None]
+
+    #All the stencil points are computed together (on the pool of processes
+    #for backgrounds that are not vectorized). The fiducial point itself is
+    #not needed by the central stencil
+    shifts = np.zeros((sets['nsteps'],len(params),len(stencil_offsets),len(params)))
+    for i in range(len(params)):
+        shifts[:,i,:,i] = steps[:,i,None]*stencil_offsets[None,:]
+    points = fiducial+shifts.reshape(-1,len(params))
+
+    print('Derivatives of {} parameters with {} steps: {} theory points'.format(len(params),sets['nsteps'],len(points)))
+
+    tini   = time()
+    theory = posterior.get_theory(points)
+    derivatives = StencilDerivatives(theory,steps)
+
+    failed = [par for par,valid in zip(params,np.any(derivatives.valid,axis=0)) if not valid]
+    if len(failed) > 0:
+        sys.exit('Background failed on the stencil points of {} for all the steps, change the fiducial or the steps'.format(', '.join(failed)))
+
+    fisher = np.zeros((len(params),len(params)))
+    for name,like in posterior.model.likelihood.items():
+        like_fisher = like.get_fisher(derivatives)
+        with np.errstate(divide='ignore'):
+            errors = 1/np.sqrt(np.diag(like_fisher))
+        print('{}: errors with the other parameters fixed {}'.format(name,', '.join(['{} {:.3g}'.format(par,err) for par,err in zip(params,errors)])))
+        fisher += like_fisher
+    tend = time()
+
+    close_run(posterior.model,pool,sets['pool'])
+
+    #Gaussian priors are added to the Fisher matrix
+    if sets['add_priors']:
+        for i,par in enumerate(params):
+            prior = info['params'][par]['prior']
+            if prior.get('dist',None) == 'norm':
+                fisher[i,i] += 1/prior['scale']**2
+
+    print('Fisher matrix computed in {:.2f} s'.format(tend-tini))
+    for name,chosen in derivatives.chosen.items():
+        print('Steps used for {}: {}'.format(name,', '.join(['{} {:.3g}'.format(par,step) for par,step in zip(params,chosen)])))
+
+    try:
+        np.linalg.cholesky(fisher)
+    except np.linalg.LinAlgError:
+        sys.exit('Fisher matrix is not positive definite, some parameters are not constrained: fix them or add priors')
+    covmat = np.linalg.inv(fisher)
+    sigmas = np.sqrt(np.diag(covmat))
+
+    for par,val,sigma in zip(params,fiducial,sigmas):
+        print('{} = {:.5g} +/- {:.2g}'.format(par,val,sigma))
+
+    fisher_dict = {par: info['params'][par].get('latex',par) for par in params}
+    results     = pd.DataFrame(fisher,columns=params,index=params)
+
+    if 'output' in info and info['output'] != '':
+        np.savetxt(info['output']+'_fisher.txt',fisher,header=' '.join(params))
+        #Same format as the Cobaya and getdist .covmat files, usable as proposal
+        np.savetxt(info['output']+'.covmat',covmat,header=' '.join(params))
+
+        summary = {'fiducial': {par: float(val) for par,val in zip(params,fiducial)},
+                   'sigma': {par: float(val) for par,val in zip(params,sigmas)},
+                   'correlation': (covmat/np.outer(sigmas,sigmas)).tolist(),
+                   'steps': {name: {par: float(val) for par,val in zip(params,chosen)} for name,chosen in derivatives.chosen.items()}}
+        with open(info['output']+'_fisher.yaml', 'w') as outfile:
+            yaml.dump(summary, outfile, default_flow_style=False)
+
+        with open(info['output']+'.params.yaml', 'w') as outfile:
+            yaml.dump(fisher_dict, outfile, default_flow_style=False)
+
+    print('FISHER FORECAST FINISHED')
+
+    return results,fisher_dict
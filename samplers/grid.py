@@ -0,0 +1,205 @@
+import sys,os
+import yaml
+import numpy  as np
+import pandas as pd
+
+from time import time
+from itertools import product
+from scipy.special import logsumexp
+
+from samplers.ensemble import BatchPosterior,get_pool
+from samplers.nautilus import close_run
+
+
+def evaluate_grid(logpost_function,ranges,npoints,refine=0,threshold=1.e-3,chunk_size=256,stream=None):
+    #Posterior on a regular grid of cells in ranges (ndim x 2), with npoints
+    #cells per parameter, evaluated at the cell centers in chunks of chunk_size
+    #points with one call of logpost_function (returning logpost and derived
+    #for all the points, e.g. BatchPosterior). Each refinement level splits
+    #in 2^ndim the cells holding more than threshold of the posterior mass
+    #and their neighbours, so that narrow peaks are resolved in a few levels.
+    #stream(level,centers,widths,logpost,derived) is called after each chunk,
+    #e.g. to write it to disk.
+    #Returns centers, widths, logpost and derived of the final cells
+
+    ranges  = np.array(ranges,dtype=float)
+    npoints = np.array(npoints,dtype=int)
+    ndim    = len(ranges)
+
+    widths  = (ranges[:,1]-ranges[:,0])/npoints
+    axes    = [lo+(np.arange(n)+0.5)*w for (lo,hi),n,w in zip(ranges,npoints,widths)]
+    new_centers = np.array(list(product(*axes)))
+    new_widths  = np.broadcast_to(widths,new_centers.shape)
+
+    #Corners of the children of a cell, in units of its width
+    offsets = 0.25*np.array(list(product([-1,1],repeat=ndim)))
+
+    centers,cell_widths,logpost,derived = [],[],[],[]
+    for level in range(refine+1):
+        for start in range(0,len(new_centers),chunk_size):
+            chunk = new_centers[start:start+chunk_size]
+            chunk_widths = new_widths[start:start+chunk_size]
+            lp,der = logpost_function(chunk)
+            if stream != None:
+                stream(level,chunk,chunk_widths,lp,der)
+            centers.append(chunk)
+            cell_widths.append(chunk_widths)
+            logpost.append(lp)
+            derived.append(der)
+
+        centers     = [np.concatenate(centers)]
+        cell_widths = [np.concatenate(cell_widths)]
+        logpost     = [np.concatenate(logpost)]
+        derived     = [np.concatenate(derived)]
+
+        if not np.any(np.isfinite(logpost[0])):
+            sys.exit('Posterior is zero on the whole grid, check the ranges')
+
+        if level == refine:
+            break
+
+        #Cells with more than threshold of the posterior mass are replaced by their children
+        logmass = logpost[0]+np.sum(np.log(cell_widths[0]),axis=1)
+        split   = logmass > logsumexp(logmass)+np.log(threshold)
+        #and so are the cells touching them, where the mass can be underestimated
+        #if the posterior changes fast inside them
+        split   = split | touching(centers[0],cell_widths[0],split)
+        new_centers = (centers[0][split][:,None,:]+offsets[None,:,:]*cell_widths[0][split][:,None,:]).reshape(-1,ndim)
+        new_widths  = np.repeat(0.5*cell_widths[0][split],len(offsets),axis=0)
+        centers,cell_widths,logpost,derived = [[arr[0][~split]] for arr in [centers,cell_widths,logpost,derived]]
+        print('Refinement level {}: {} cells split, {} new points'.format(level+1,np.sum(split),len(new_centers)))
+
+    return centers[0],cell_widths[0],logpost[0],derived[0]
+
+def touching(centers,widths,selected,chunk_size=256):
+
+    #Cells sharing a face, an edge or a corner with one of the selected cells
+    result = np.zeros(len(centers),dtype=bool)
+    sel    = np.where(selected)[0]
+    for start in range(0,len(sel),chunk_size):
+        idx  = sel[start:start+chunk_size]
+        dist = np.abs(centers[None,:,:]-centers[idx,None,:])
+        size = 0.5*(widths[None,:,:]+widths[idx,None,:])
+        result |= np.any(np.all(dist <= size*(1+1.e-8),axis=2),axis=0)
+
+    return result
+
+def grid_evidence(widths,logpost):
+
+    #Integral of the (normalized prior times likelihood) over the cells
+    return logsumexp(logpost+np.sum(np.log(widths),axis=1))
+
+def grid_marginals(centers,widths,weights,ranges,nbins):
+
+    #1D marginals on nbins bins in the ranges, normalized to unit integral.
+    #The weight of each cell is spread uniformly over the bins it overlaps
+    marginals = []
+    for i,(lo,hi) in enumerate(ranges):
+        edges = np.linspace(lo,hi,nbins[i]+1)
+        left  = centers[:,i]-0.5*widths[:,i]
+        cumul = np.clip((edges[None,:]-left[:,None])/widths[:,i,None],0.,1.)
+        mass  = np.dot(weights,np.diff(cumul,axis=1))
+        marginals.append((0.5*(edges[1:]+edges[:-1]),mass/(np.sum(mass)*np.diff(edges))))
+
+    return marginals
+
+
+def grid_interface(info):
+
+    sets = info['sampler']['evaluate_grid']
+
+    print('')
+    print('RUNNING WITH GRID EVALUATION')
+    print('')
+
+    pool      = get_pool(sets)
+    posterior = BatchPosterior(info,pool=pool)
+
+    #Ranges from the options, or the prior (uniform bounds or nsigma for Gaussians)
+    ranges = []
+    for par in posterior.sampled:
+        prior = info['params'][par]['prior']
+        if par in sets['ranges']:
+            ranges.append(sets['ranges'][par])
+        elif 'min' in prior and 'max' in prior:
+            ranges.append([prior['min'],prior['max']])
+        elif prior.get('dist',None) == 'norm':
+            ranges.append([prior['loc']-sets['nsigma']*prior['scale'],prior['loc']+sets['nsigma']*prior['scale']])
+        else:
+            sys.exit('No grid range for {}, give it in the ranges option'.format(par))
+    ranges = np.array(ranges,dtype=float)
+
+    if type(sets['npoints']) == dict:
+        npoints = np.array([sets['npoints'][par] for par in posterior.sampled])
+    else:
+        npoints = np.full(posterior.ndim,sets['npoints'])
+
+    print('Grid of {} points over {}, {} refinement level(s)'.format(np.prod(npoints),posterior.sampled,sets['refine']))
+
+    columns = ['weight','minuslogpost']+posterior.sampled+posterior.derived
+    output  = info['output'] if 'output' in info and info['output'] != '' else None
+
+    #All evaluated points are written as they come, with their level and cell volume
+    if output != None:
+        stream_file = open(output+'_grid.txt','w')
+        stream_file.write('# '+' '.join(['level','volume','minuslogpost']+posterior.sampled+posterior.derived)+'\n')
+        def stream(level,chunk,widths,logpost,derived):
+            np.savetxt(stream_file,np.c_[np.full(len(chunk),level),np.prod(widths,axis=1),-logpost,chunk,derived])
+            stream_file.flush()
+    else:
+        stream = None
+
+    tini = time()
+    centers,widths,logpost,derived = evaluate_grid(posterior,ranges,npoints,sets['refine'],sets['threshold'],
+                                                   sets['chunk_size'],stream)
+    tend = time()
+
+    if output != None:
+        stream_file.close()
+    close_run(posterior.model,pool,sets['pool'])
+
+    print('Likelihood evaluations: {} in {:.1f} s ({:.1f} points/s)'.format(posterior.nevals,tend-tini,posterior.nevals/(tend-tini)))
+    if posterior.nfailed > 0:
+        print('Background failed for {} points'.format(posterior.nfailed))
+
+    log_z   = grid_evidence(widths,logpost)
+    weights = np.exp(logpost-np.max(logpost))*np.prod(widths,axis=1)
+    weights /= np.sum(weights)
+    best    = np.argmax(logpost)
+    print('log(evidence) = {:.3f} (prior mass outside the ranges is neglected)'.format(log_z))
+
+    marginals = grid_marginals(centers,widths,weights,ranges,npoints*2**sets['refine'])
+    for par,(x,pdf) in zip(posterior.sampled,marginals):
+        mean = np.sum(weights*centers[:,posterior.sampled.index(par)])
+        std  = np.sqrt(np.sum(weights*centers[:,posterior.sampled.index(par)]**2)-mean**2)
+        print('{} = {:.5g} +/- {:.2g} (best grid point {:.5g})'.format(par,mean,std,centers[best,posterior.sampled.index(par)]))
+
+    #Same outputs as the Nautilus interface, read by Analyzer, with the
+    #cells as weighted samples
+    grid_dict = {par: info['params'][par].get('latex',par) for par in posterior.sampled+posterior.derived}
+    results   = pd.DataFrame(np.c_[weights,-logpost,centers,derived],columns=columns)
+    results   = results[results['weight'] > 0]
+
+    if output != None:
+        with open(output+'.params.yaml', 'w') as outfile:
+            yaml.dump(grid_dict, outfile, default_flow_style=False)
+
+        results.to_csv(output+'_chain.txt',sep='\t',header=False,index=False)
+
+        #Columns have different lengths if npoints is different for each parameter
+        pd.concat([pd.DataFrame({par: x,'P('+par+')': pdf}) for par,(x,pdf) in zip(posterior.sampled,marginals)],
+                  axis=1).to_csv(output+'_marginals.txt',sep='\t',index=False)
+
+        summary = {'log_evidence': float(log_z),
+                   'evaluations': int(posterior.nevals),
+                   'failed': int(posterior.nfailed),
+                   'cells': int(len(logpost)),
+                   'max_logpost': float(logpost[best]),
+                   'best_fit': {par: float(val) for par,val in zip(posterior.sampled,centers[best])},
+                   'ranges': {par: [float(lo),float(hi)] for par,(lo,hi) in zip(posterior.sampled,ranges)}}
+        with open(output+'_grid.yaml', 'w') as outfile:
+            yaml.dump(summary, outfile, default_flow_style=False)
+
+    print('GRID EVALUATION FINISHED')
+
+    return results,grid_dict
@@ -1,5 +1,7 @@
 import sys,os
 
+from copy import deepcopy
+
 
 
 class SamplingHandler:
@@ -14,6 +16,18 @@ class SamplingHandler:
             print('Running with Nautilus')
             self.sampling_dictionary,self.run = self.nautilus_setup(info['sampler'])
 
+        elif info['sampler']['name'] == 'ensemble':
+            print('Running with the ensemble sampler')
+            self.sampling_dictionary,self.run = self.ensemble_setup(info['sampler'])
+
+        elif info['sampler']['name'] == 'evaluate_grid':
+            print('Running on a grid')
+            self.sampling_dictionary,self.run = self.grid_setup(info['sampler'])
+
+        elif info['sampler']['name'] == 'fisher':
+            print('Running Fisher forecast')
+            self.sampling_dictionary,self.run = self.fisher_setup(info['sampler'])
+
         else:
             sys.exit('Unknown sampler: {}'.format(info['sampler']))
 
@@ -31,20 +45,139 @@ class SamplingHandler:
 
         from samplers.nautilus import nautilus_interface
 
-        if samp_info['options'] == 'poor':
-            sets = {'num_threads': 1,
-                    'pool': 1,
-                    'n_live': 500,
-                    'n_batch': 64,
-                    'n_networks': 2}
-        elif samp_info['options'] == 'good':
-            sets = {'num_threads': 1,
-                    'pool': 1,
-                    'n_live': 4000,
-                    'n_batch': 512,
-                    'n_networks': 16}
+        presets = {'poor': {'num_threads': 1,
+                            'pool': 1,
+                            'n_live': 500,
+                            'n_batch': 64,
+                            'n_networks': 2,
+                            'vectorized': False},
+                   'good': {'num_threads': 1,
+                            'pool': 1,
+                            'n_live': 4000,
+                            'n_batch': 512,
+                            'n_networks': 16,
+                            'vectorized': False}}
+
+        #Options can be one of the presets, or a dictionary starting
+        #from a preset (default poor) and changing some of its entries, e.g.
+        #options: {preset: good, pool: 8, num_threads: 1, n_batch: 256}
+        options = samp_info['options']
+        if type(options) == str:
+            options = {'preset': options}
+
+        preset = options.get('preset','poor')
+        if preset not in presets:
+            sys.exit('Unknown Nautilus preset: {}'.format(preset))
+
+        sets = deepcopy(presets[preset])
+        for k,v in options.items():
+            if k != 'preset':
+                sets[k] = v
+
+        if sets['pool'] != None and sets['pool'] > 1 and sets['n_batch'] % sets['pool'] != 0:
+            print('WARNING! n_batch ({}) is not a multiple of the number of processes ({})'.format(sets['n_batch'],sets['pool']))
 
         samp_dict        = {'nautilus': sets}
         running_function = nautilus_interface
 
         return samp_dict,running_function
+
+    def ensemble_setup(self,samp_info):
+
+        from samplers.ensemble import ensemble_interface
+
+        #Walkers move together, each half of them with one call of the
+        #theory and of the likelihoods (see samplers/ensemble.py).
+        #move: stretch (affine invariant) or DE (differential evolution),
+        #a: scale of the stretch move, burn_in: fraction of the steps discarded,
+        #pool: processes for backgrounds that are not vectorized (e.g. CAMB)
+        defaults = {'nwalkers': None,
+                    'nsteps': 2000,
+                    'move': 'stretch',
+                    'a': 2.,
+                    'burn_in': 0.3,
+                    'thin': 1,
+                    'seed': None,
+                    'pool': 1,
+                    'num_threads': 1}
+
+        options = samp_info.get('options',None)
+        if options == None:
+            options = {}
+
+        unknown = [k for k in options if k not in defaults]
+        if unknown != []:
+            sys.exit('Unknown ensemble sampler options: {}'.format(unknown))
+
+        sets = deepcopy(defaults)
+        sets.update(options)
+
+        samp_dict        = {'ensemble': sets}
+        running_function = ensemble_interface
+
+        return samp_dict,running_function
+
+    def grid_setup(self,samp_info):
+
+        from samplers.grid import grid_interface
+
+        #Posterior on a grid of npoints per parameter (a number or a dictionary
+        #with one for each parameter) in ranges (default from the priors, nsigma
+        #for Gaussian ones), evaluated in chunks with one call of the theory and
+        #of the likelihoods (see samplers/grid.py). refine: levels splitting the
+        #cells with more than threshold of the posterior mass
+        defaults = {'npoints': 20,
+                    'ranges': {},
+                    'nsigma': 5.,
+                    'refine': 0,
+                    'threshold': 1.e-3,
+                    'chunk_size': 256,
+                    'pool': 1,
+                    'num_threads': 1}
+
+        options = samp_info.get('options',None)
+        if options == None:
+            options = {}
+
+        unknown = [k for k in options if k not in defaults]
+        if unknown != []:
+            sys.exit('Unknown grid options: {}'.format(unknown))
+
+        sets = deepcopy(defaults)
+        sets.update(options)
+
+        samp_dict        = {'evaluate_grid': sets}
+        running_function = grid_interface
+
+        return samp_dict,running_function
+
+    def fisher_setup(self,samp_info):
+
+        from samplers.fisher import fisher_interface
+
+        #Fisher matrix at fiducial (default the ref of the parameters) from the
+        #derivatives of the observables (see samplers/fisher.py). step: first
+        #step of each parameter (default its proposal), halved nsteps times.
+        #add_priors: Gaussian priors added to the Fisher matrix
+        defaults = {'fiducial': {},
+                    'step': {},
+                    'nsteps': 4,
+                    'add_priors': True,
+                    'pool': 1,
+                    'num_threads': 1}
+
+        options = samp_info.get('options',None)
+        if options == None:
+            options = {}
+
+        unknown = [k for k in options if k not in defaults]
+        if unknown != []:
+            sys.exit('Unknown Fisher options: {}'.format(unknown))
+
+        sets = deepcopy(defaults)
+        sets.update(options)
+
+        samp_dict        = {'fisher': sets}
+        running_function = fisher_interface
+
+        return samp_dict,running_function
@@ -3,6 +3,128 @@ import yaml
 import numpy  as np
 import pandas as pd
 
+from time      import time
+from functools import partial
+
+#Cobaya model (or BatchPosterior) of each worker process, see initialize_worker
+worker_model = {}
+
+def set_num_threads(num_threads):
+
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    os.environ['OPENBLAS_NUM_THREADS'] = str(num_threads)
+
+    #Environment variables are not read anymore once numpy is loaded,
+    #threadpoolctl changes the limit of the BLAS already in use
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=num_threads)
+    except ImportError:
+        print('threadpoolctl not available, BLAS threads set through environment only')
+
+def initialize_pool(num_threads,barrier):
+
+    #Initializer of the workers of all the samplers. The barrier is
+    #shared by all of them, see worker_stats
+    set_num_threads(num_threads)
+    worker_model['barrier'] = barrier
+
+def initialize_worker(info,num_threads,vectorized,barrier):
+
+    #Each worker builds its own model (and loads its own data) only once
+    from cobaya.model import get_model
+    from samplers.ensemble import BatchPosterior
+
+    initialize_pool(num_threads,barrier)
+    if vectorized:
+        worker_model['model']    = BatchPosterior(info)
+        worker_model['calcdist'] = worker_model['model'].model.theory['CalcDist']
+    else:
+        worker_model['model']    = get_model(info)
+        worker_model['calcdist'] = worker_model['model'].theory['CalcDist']
+
+def worker_stats(cosmology):
+
+    #Every worker waits here for the others, so that each of the pool_size
+    #calls of close_run goes to a different worker. If the barrier breaks
+    #(timeout) a worker may get two calls, and returns zero counters the second time
+    from threading import BrokenBarrierError
+    from theory_code.cobaya_theory_wrapper import get_run_stats
+
+    try:
+        worker_model['barrier'].wait(timeout=60)
+    except BrokenBarrierError:
+        pass
+
+    calcdist = worker_model.get('calcdist')
+    if calcdist != None:
+        cosmology = calcdist.cosmology
+
+    return get_run_stats(cosmology,calcdist)
+
+def start_pool(pool_size,num_threads,initializer=initialize_pool,initargs=()):
+
+    #Forked workers, the last argument of the initializer is the barrier of worker_stats
+    import multiprocessing
+
+    print('Starting {} workers with {} BLAS thread(s) each'.format(pool_size,num_threads))
+    context = multiprocessing.get_context('fork')
+
+    return context.Pool(pool_size,initializer=initializer,initargs=initargs+(context.Barrier(pool_size),))
+
+def close_run(model,pool=None,pool_size=None):
+
+    #Cobaya closes the model (where CalcDist prints its counters) only in
+    #cobaya.run, so the samplers here do it at the end of the run. The counters
+    #of the workers (cache and ODE solver) are collected before and added up
+    #with those of this process. Without model (pooled Nautilus) the workers
+    #know the cosmology from their own model
+    from theory_code.cobaya_theory_wrapper import get_run_stats,print_run_stats
+
+    cosmology = model.theory['CalcDist'].cosmology if model != None else None
+
+    stats = []
+    if pool != None:
+        stats += pool.map(worker_stats,[cosmology]*pool_size,chunksize=1)
+        pool.close()
+        pool.join()
+
+    if model != None:
+        stats.append(get_run_stats(cosmology,model.theory['CalcDist']))
+        #Counters are reset once read, so close prints nothing again
+        model.close()
+
+    print_run_stats(stats)
+
+def point_likelihood(model,param_dict):
+
+    #The posterior is evaluated once per point, and both loglike
+    #and derived parameters are taken from the same result
+    logpost = model.logposterior(param_dict)
+
+    like_tuple    = [logpost.loglike]+[par for par in logpost.derived]
+    full_tuple    = tuple(like_tuple)
+
+    return full_tuple 
+
+def batch_likelihood(posterior,param_dict):
+
+    #Vectorized version: param_dict contains arrays with one entry per point,
+    #which are computed together by BatchPosterior (see samplers/ensemble.py).
+    #Derived parameters are in the same order as in point_likelihood
+    points = np.column_stack([param_dict[par] for par in posterior.sampled])
+    logprior,loglike,derived = posterior.evaluate(points)
+
+    return (loglike,)+tuple(derived.T)
+
+def worker_point_likelihood(param_dict):
+
+    return point_likelihood(worker_model['model'],param_dict)
+
+def worker_batch_likelihood(param_dict):
+
+    return batch_likelihood(worker_model['model'],param_dict)
+
 def nautilus_interface(info):
 
     #We thank Guadalupe Cañas-Herrera for the contribution to this script.
@@ -13,20 +135,43 @@ def nautilus_interface(info):
     from nautilus     import Sampler
 
     num_threads = info['sampler']['nautilus']['num_threads']
-
-    os.environ["OMP_NUM_THREADS"] = str(num_threads)
-    os.environ['OPENBLAS_NUM_THREADS'] = str(num_threads)
+    pool_size   = info['sampler']['nautilus']['pool']
+    vectorized  = info['sampler']['nautilus'].get('vectorized',False)
 
     print('')
     print('RUNNING WITH NAUTILUS SAMPLER')
     print('')
 
-    print('Loading model wrapper of Cobaya')
-    model = get_model(info)
-    print('model loaded')
-    point = dict(zip(model.parameterization.sampled_params(),
-                     model.prior.sample(ignore_external=True)[0]))
-    logposterior = model.logposterior(point)
+    if pool_size == None or pool_size <= 1:
+        set_num_threads(num_threads)
+
+        print('Loading model wrapper of Cobaya')
+        if vectorized:
+            from samplers.ensemble import BatchPosterior
+            posterior = BatchPosterior(info)
+            model     = posterior.model
+        else:
+            model = get_model(info)
+        print('model loaded')
+        point = dict(zip(model.parameterization.sampled_params(),
+                         model.prior.sample(ignore_external=True)[0]))
+        logposterior = model.logposterior(point)
+
+        pool = None
+        if vectorized:
+            likelihood_nautilus = partial(batch_likelihood,posterior)
+        else:
+            likelihood_nautilus = partial(point_likelihood,model)
+    else:
+        #Workers are forked and build their model in the initializer,
+        #the model is never created (or pickled) in the main process
+        pool  = start_pool(pool_size,num_threads,initializer=initialize_worker,
+                           initargs=(info,num_threads,vectorized))
+        model = None
+        if vectorized:
+            likelihood_nautilus = worker_batch_likelihood
+        else:
+            likelihood_nautilus = worker_point_likelihood
 
     print('Preparing the prior...')
     prior = Prior()
@@ -50,25 +195,27 @@ def nautilus_interface(info):
     derived_pars = [k for k in info['params'].keys() if type(info['params'][k]) == dict and 'prior' not in info['params'][k]]
     blob_vec     = [(par, float) for par in derived_pars]
 
-    ## Likelihood
-    def likelihood_nautilus(param_dict):
-
-        derived_params = model.logposterior(param_dict).derived
-
-        like_tuple    = [model.logposterior(param_dict).loglike]+[par for par in derived_params]
-        full_tuple    = tuple(like_tuple)
-
-        return full_tuple 
-
-
     print('Starting to sample with Nautilus...')
-    nautilus_options = {k:v for k,v in info['sampler']['nautilus'].items() if k != 'num_threads'}
+    nautilus_options = {k:v for k,v in info['sampler']['nautilus'].items() if k not in ['num_threads','pool']}
     if 'output' in info and info['output'] != '':
         nautilus_options['filepath'] = info['output']+'.hdf5'
 
-    sampler = Sampler(prior,likelihood_nautilus,**nautilus_options,blobs_dtype=blob_vec)
+    if vectorized:
+        print('Using vectorized likelihood with batches of {} points'.format(nautilus_options['n_batch']))
 
+    #Only likelihood calls go to the pool, sampler calculations stay here
+    sampler = Sampler(prior,likelihood_nautilus,**nautilus_options,pool=(pool,None),blobs_dtype=blob_vec)
+
+    tini = time()
     sampler.run(verbose=True)
+    tend = time()
+
+    close_run(model,pool,pool_size)
+
+    ncores = 1 if pool == None else pool_size
+    print('Likelihood evaluations: {} in {:.1f} s ({:.1f} points/s, {:.1f} points/s per process)'.format(sampler.n_like,tend-tini,
+                                                                                                           sampler.n_like/(tend-tini),
+                                                                                                           sampler.n_like/(tend-tini)/ncores))
     log_z = sampler.evidence()
     points, log_w, log_l, derived = sampler.posterior(equal_weight=True,return_blobs=True)
     derived_array = np.array([np.array(list(der)) for der in derived])
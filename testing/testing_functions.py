@@ -10,7 +10,9 @@ from yaml import dump
 
 from contextlib import redirect_stdout
 
-from theory_code.distance_theory import TheoryCalcs
+from scipy.integrate import quad
+
+from theory_code.distance_theory import TheoryCalcs,cumulative_integral
 
 from cobaya.run import run
 
@@ -165,3 +167,560 @@ def test_observables(reference,threshold,save_comparison):
         plt.savefig('testing/test_results.pdf',dpi=500)
 
     return None
+
+def test_comoving_integrator(threshold):
+
+    #Checks the cumulative comoving distance integrator against
+    #point-by-point quad integration. Threshold is a relative difference
+
+    settings = {'zmin': 0.001,
+                'zmax': 5.,
+                'Nz': 10000}
+
+    custom_params = {'cosmology': 'Custom',
+                     'parameters': {'H0': 67.36,
+                                    'omegam': 0.3153,
+                                    'Delta': 0.1,
+                                    'Gamma': 0.,
+                                    'ombh2': 0.02237}}
+
+    fiducial = {'H0': 67.36,
+                'omch2': 0.1200,
+                'ombh2': 0.02237,
+                'omk': 0.,
+                'omnuh2': 0.0006442,
+                'nnu': 3.}
+
+    SNmodel = {'model': 'constant',
+               'MB': -19.2435}
+
+    custom_results = TheoryCalcs(settings,custom_params,SNmodel,fiducial)
+
+    zcalc     = custom_results.zcalc
+    integrand = lambda x: 1/custom_results.H_Mpc(x)
+    ztest     = zcalc[1::100]
+
+    comov_cumul = cumulative_integral(integrand,zcalc)[1::100]
+    comov_quad  = np.array([quad(integrand,zcalc[0],z)[0] for z in ztest])
+
+    reldiff = np.max(abs(comov_cumul/comov_quad-1))
+    if reldiff < threshold:
+        print('\033[0;32m'+'Comoving integrator matches quad (max relative difference {:.1e})'.format(reldiff)+'\033[0m')
+    else:
+        print('\033[1;31m'+'Comoving integrator mismatch with quad (max relative difference {:.1e})'.format(reldiff)+'\033[0m')
+
+    return None
+
+def test_analytic_expansion(threshold,npoints=50):
+
+    #Compares the Analytic expansion module with CAMB (Standard module)
+    #on random points of the prior box. Threshold is a percentage
+
+    from time import time
+    from theory_code.distance_theory import get_expansion_module
+
+    settings = {'zmin': 0.001,
+                'zmax': 5.,
+                'Nz': 1000}
+
+    zcalc = np.linspace(settings['zmin'],settings['zmax'],settings['Nz'])
+
+    analytic = get_expansion_module('Analytic')
+    standard = get_expansion_module('Standard')
+
+    rng = np.random.default_rng(42)
+
+    maxdiff = {'H': 0., 'comoving': 0., 'rdrag': 0.}
+    times   = {'Analytic': 0., 'Standard': 0.}
+    for i in range(npoints):
+        params = {'H0': rng.uniform(55.,85.),
+                  'ombh2': rng.uniform(0.019,0.025),
+                  'omch2': rng.uniform(0.08,0.16),
+                  'omk': rng.uniform(-0.1,0.1),
+                  'w': rng.uniform(-1.5,-0.5),
+                  'wa': rng.uniform(-1.,0.5),
+                  'omnuh2': rng.choice([0.,0.0006442,0.002]),
+                  'nnu': rng.uniform(2.8,3.6)}
+        #CAMB fluid dark energy cannot cross w = -1
+        if params['w'] < -1:
+            params['wa'] = 0.
+        elif params['w']+params['wa'] < -1:
+            params['wa'] = -1-params['w']
+
+        results = {}
+        for label,module in [('Analytic',analytic),('Standard',standard)]:
+            tini = time()
+            results[label] = module.get_cosmology(deepcopy(params),settings)
+            results[label]['H_zcalc']        = results[label]['H_Mpc'](zcalc)
+            results[label]['comoving_zcalc'] = results[label]['comoving'](zcalc)
+            times[label] += time()-tini
+
+        maxdiff['H']        = max(maxdiff['H'],np.max(abs(results['Analytic']['H_zcalc']/results['Standard']['H_zcalc']-1)))
+        maxdiff['comoving'] = max(maxdiff['comoving'],np.max(abs(results['Analytic']['comoving_zcalc']/results['Standard']['comoving_zcalc']-1)))
+        maxdiff['rdrag']    = max(maxdiff['rdrag'],abs(results['Analytic']['rdrag']/results['Standard']['rdrag']-1))
+
+    for obs,diff in maxdiff.items():
+        if 100*diff < threshold:
+            print('\033[0;32m'+'Analytic {} matches CAMB (max relative difference {:.1e})'.format(obs,diff)+'\033[0m')
+        else:
+            print('\033[1;31m'+'Analytic {} mismatch with CAMB (max relative difference {:.1e})'.format(obs,diff)+'\033[0m')
+    print('Analytic module {:.1f} times faster than CAMB'.format(times['Standard']/times['Analytic']))
+
+    return None
+
+def fit_rdrag_calibration(npoints=120):
+
+    #Fits the correction to the rdrag integral of the Analytic module on
+    #CAMB points covering a wide box. The coefficients are printed, to be
+    #copied in rdrag_calibration (theory_code/expansion_models/analytic_cosmology.py)
+
+    import camb
+    from theory_code.distance_theory import get_expansion_module
+    from theory_code.expansion_models.analytic_cosmology import rdrag_calibration
+
+    analytic = get_expansion_module('Analytic')
+
+    rng = np.random.default_rng(0)
+    features = []
+    ratios   = []
+    for i in range(npoints):
+        pars = {'H0': 67.36,
+                'ombh2': rng.uniform(0.017,0.027),
+                'omch2': rng.uniform(0.06,0.2),
+                'omk': 0.,
+                'w': -1.,
+                'wa': 0.,
+                'omnuh2': rng.uniform(0.,0.003),
+                'nnu': rng.uniform(2.5,4.)}
+        camb_rdrag = camb.get_background(camb.set_params(**pars)).get_derived_params()['rdrag']
+        features.append(analytic.get_rdrag_features(pars))
+        ratios.append(np.log(camb_rdrag/analytic.get_rdrag(pars,analytic.get_densities(pars))))
+
+    coefficients = np.linalg.lstsq(np.array(features),np.array(ratios),rcond=None)[0]
+
+    print('rdrag calibration coefficients:')
+    print(repr(coefficients.tolist()))
+    print('Max relative difference of rdrag with the current coefficients {:.1e}'.format(np.max(abs(np.dot(np.array(features),coefficients-rdrag_calibration)))))
+
+    return coefficients
+
+def test_ode_expansion(threshold,npoints=10):
+
+    #Checks the ODE background (DCDM module): without decay against the
+    #Analytic module, with decay against a tighter Radau integration.
+    #Threshold is a percentage
+
+    from theory_code.distance_theory import get_expansion_module
+
+    settings = {'zmin': 0.001,
+                'zmax': 5.,
+                'Nz': 1000}
+
+    zcalc = np.linspace(settings['zmin'],settings['zmax'],settings['Nz'])
+
+    dcdm     = get_expansion_module('DCDM')
+    analytic = get_expansion_module('Analytic')
+    #Reference with the stiff Radau solver and tighter tolerances
+    tight = type('TightDCDM',(type(dcdm),),{'method': 'Radau', 'rtol': 1.e-11, 'atol': 1.e-15})('DCDM')
+
+    rng = np.random.default_rng(42)
+
+    maxdiff = {'no decay': 0., 'decay': 0.}
+    dcdm.reset_stats()
+    for i in range(npoints):
+        params = {'H0': rng.uniform(55.,85.),
+                  'ombh2': rng.uniform(0.019,0.025),
+                  'omdcdmh2': rng.uniform(0.08,0.16),
+                  'nnu': rng.uniform(2.8,3.6)}
+
+        ode = dcdm.get_cosmology(deepcopy(params),settings)
+        ana = analytic.get_cosmology({'H0': params['H0'],'ombh2': params['ombh2'],'omch2': params['omdcdmh2'],
+                                      'omnuh2': 0.,'nnu': params['nnu']},settings)
+        for obs in ['H_Mpc','comoving']:
+            maxdiff['no decay'] = max(maxdiff['no decay'],np.max(abs(ode[obs](zcalc)/ana[obs](zcalc)-1)))
+
+        params['Gamma_dcdm'] = 10**rng.uniform(0.,5.)
+        ode = dcdm.get_cosmology(deepcopy(params),settings)
+        ref   = tight.get_cosmology(deepcopy(params),settings)
+        for obs in ['H_Mpc','comoving']:
+            maxdiff['decay'] = max(maxdiff['decay'],np.max(abs(ode[obs](zcalc)/ref[obs](zcalc)-1)))
+
+    for case,diff in maxdiff.items():
+        if 100*diff < threshold:
+            print('\033[0;32m'+'DCDM background with {} matches (max relative difference {:.1e})'.format(case,diff)+'\033[0m')
+        else:
+            print('\033[1;31m'+'DCDM background with {} mismatch (max relative difference {:.1e})'.format(case,diff)+'\033[0m')
+    #Tight reference points are not counted
+    print(dcdm.get_report())
+
+    return None
+
+def test_GW_covariance(threshold,N=2000):
+
+    #Chi2 of the compact GW covariance representations against the dense
+    #inverse, on mock covariances of each structure. Load time, memory and
+    #time per call of each representation are printed. Threshold is a percentage
+
+    from scipy import sparse
+    from likelihood.GW_likelihood import GWCovariance
+
+    rng = np.random.default_rng(42)
+    var = rng.uniform(1.,4.,N)
+    off = 0.3*np.sqrt(var[1:]*var[:-1])
+
+    blocks = []
+    for i in range(0,N,4):
+        A = rng.normal(size=(4,4))
+        blocks.append(A@A.T+4*np.eye(4))
+
+    mocks = {'diagonal': sparse.diags_array(var),
+             'banded': sparse.diags_array([var,off,off],offsets=[0,1,-1]),
+             'block': sparse.block_diag(blocks)}
+
+    diff = rng.normal(size=N)
+    for structure,C in mocks.items():
+        dense  = C.toarray()
+        chi2   = diff@np.linalg.inv(dense)@diff
+        covmat = GWCovariance(C)
+        reldiff = abs(covmat.chi2(diff)/chi2-1)
+        if covmat.structure == structure and 100*reldiff < threshold:
+            print('\033[0;32m'+'{} GW covariance found and chi2 matches (relative difference {:.1e})'.format(structure,reldiff)+'\033[0m')
+        else:
+            print('\033[1;31m'+'{} GW covariance: found {}, chi2 relative difference {:.1e}'.format(structure,covmat.structure,reldiff)+'\033[0m')
+        print(covmat.get_report())
+        print(GWCovariance(dense,'dense').get_report())
+
+    return None
+
+def test_SN_compression(tolerance,N=3000,ncalls=200):
+
+    #Diagonal plus low rank SN covariance (see LowRankCovariance) on a mock
+    #with varying statistical errors, a smooth systematic in z and a few
+    #calibration modes. The chi2 of a change of cosmology is compared with
+    #the dense Cholesky one, with the time per call of both
+
+    from time import time
+    from scipy.linalg import cholesky,solve_triangular
+    from likelihood.SN_likelihood import LowRankCovariance
+
+    rng = np.random.default_rng(42)
+    z   = np.sort(rng.uniform(0.01,1.5,N))
+
+    C = np.diag(rng.uniform(0.08,0.15,N)**2)
+    C += 0.02**2*np.exp(-0.5*(z[:,None]-z[None,:])**2/0.3**2)
+    modes = rng.normal(0.,0.01,(N,5))
+    C += modes@modes.T
+
+    chol    = cholesky(C,lower=True)
+    lowrank = LowRankCovariance(C,tolerance,test_vectors=[np.ones(N),np.log(z),z])
+    print(lowrank.get_report())
+
+    #Difference of magnitudes between omegam = 0.3 and 0.32
+    diff = 5*np.log10(1+0.0075*z*(1+z)**0.5)+rng.normal(0.,0.1,N)
+
+    tini = time()
+    for i in range(ncalls):
+        wdiff = solve_triangular(chol,diff,lower=True,check_finite=False)
+        exact = np.dot(wdiff,wdiff)
+    dense_time = (time()-tini)/ncalls
+
+    if lowrank.rank == None:
+        print('\033[1;31m'+'SN covariance compression failed'+'\033[0m')
+        return None
+
+    tini = time()
+    for i in range(ncalls):
+        chi2 = lowrank.chi2(diff)
+    lowrank_time = (time()-tini)/ncalls
+
+    if abs(chi2-exact) < tolerance:
+        print('\033[0;32m'+'Compressed SN chi2 matches (difference {:.1e})'.format(chi2-exact)+'\033[0m')
+    else:
+        print('\033[1;31m'+'Compressed SN chi2 mismatch (difference {:.1e})'.format(chi2-exact)+'\033[0m')
+    print('SN chi2 of {} objects: dense {:.1f} us, compressed {:.1f} us per call'.format(N,1.e6*dense_time,1.e6*lowrank_time))
+
+    return None
+
+def test_batch_posterior(threshold,settings_file='settings/DCDM/DCDM_BAO.yaml',npoints=20):
+
+    #Log-posterior of BatchPosterior (used by the ensemble sampler) against
+    #the Cobaya model on points drawn from the reference distributions.
+    #Both interpolate from the same grid nodes, so only round-off differences
+    #are expected
+
+    from time import time
+    from cobaya.model import get_model
+    from samplers.ensemble import BatchPosterior
+
+    info = read(settings_file)
+    info['likelihood'] = LikelihoodHandler(info).like_dict
+    info['theory']     = TheoryHandler(info).theory_dict
+
+    with redirect_stdout(open(os.devnull,'w')):
+        posterior = BatchPosterior(info)
+        model     = get_model({block: info[block] for block in ['params','likelihood','theory','prior'] if block in info})
+    os.remove('theory_code/CalcDist.yaml')
+
+    rng    = np.random.default_rng(42)
+    points = np.array([model.prior.reference(random_state=rng) for i in range(npoints)])
+
+    tini = time()
+    single = np.array([model.logposterior(point).logpost for point in points])
+    single_time = (time()-tini)/npoints
+
+    tini = time()
+    batch,derived = posterior(points)
+    batch_time = (time()-tini)/npoints
+
+    maxdiff = np.max(abs(batch-single))
+    if maxdiff < threshold:
+        print('\033[0;32m'+'Batch log-posterior matches Cobaya for {} (max difference {:.1e})'.format(settings_file,maxdiff)+'\033[0m')
+    else:
+        print('\033[1;31m'+'Batch log-posterior mismatch for {} (max difference {:.1e})'.format(settings_file,maxdiff)+'\033[0m')
+    print('Log-posterior of {} points: Cobaya {:.2f} ms, batch {:.2f} ms per point'.format(npoints,1.e3*single_time,1.e3*batch_time))
+
+    return None
+
+def test_grid_evidence(threshold,npoints=16,refine=6):
+
+    #Adaptive grid (see samplers/grid.py) on a correlated Gaussian likelihood,
+    #much narrower than the uniform prior, against its exact evidence and
+    #standard deviations. Threshold is on log(evidence)
+
+    from samplers.grid import evaluate_grid,grid_evidence
+
+    mean   = np.array([0.1,-0.2])
+    cov    = np.array([[1.,0.8],[0.8,1.]])*0.01**2
+    invcov = np.linalg.inv(cov)
+    ranges = np.array([[-1.,1.],[-1.,1.]])
+    logprior = -np.log(np.prod(ranges[:,1]-ranges[:,0]))
+
+    def logpost(points):
+        diff = points-mean
+        return logprior-0.5*np.sum(diff*np.dot(diff,invcov),axis=1),np.zeros((len(points),0))
+
+    with redirect_stdout(open(os.devnull,'w')):
+        centers,widths,lp,der = evaluate_grid(logpost,ranges,[npoints,npoints],refine=refine)
+
+    exact   = logprior+np.log(2*np.pi*np.sqrt(np.linalg.det(cov)))
+    log_z   = grid_evidence(widths,lp)
+    weights = np.exp(lp-np.max(lp))*np.prod(widths,axis=1)
+    weights /= np.sum(weights)
+    std     = np.sqrt(np.dot(weights,(centers-np.dot(weights,centers))**2))
+
+    if abs(log_z-exact) < threshold:
+        print('\033[0;32m'+'Grid evidence matches (difference {:.1e}, {} points)'.format(log_z-exact,len(lp))+'\033[0m')
+    else:
+        print('\033[1;31m'+'Grid evidence mismatch (difference {:.1e}, {} points)'.format(log_z-exact,len(lp))+'\033[0m')
+    print('Grid standard deviations {} (exact {})'.format(std,np.sqrt(np.diag(cov))))
+
+    return None
+
+def test_fisher(threshold,N=500):
+
+    #Stencil derivatives of the Fisher mode (see samplers/fisher.py) on
+    #f(z) = A*exp(-b*z), with a relative noise of 1e-10 as from numerical
+    #backgrounds, and J C^-1 J^T of the GW covariance structures against
+    #the dense inverse, also with failed points on the largest step.
+    #Threshold is a relative difference
+
+    from samplers.fisher import StencilDerivatives,stencil_offsets
+    from likelihood.GW_likelihood import GWCovariance
+
+    rng = np.random.default_rng(42)
+    z   = np.linspace(0.,3.,N)
+
+    class ToyTheory:
+        def __init__(self,points,valid):
+            self.points = points
+            self.valid  = valid
+        def get_result(self,name,z):
+            values = self.points[:,:1]*np.exp(-self.points[:,1:]*z)
+            return values*(1+1.e-10*rng.normal(size=values.shape))
+
+    fiducial = np.array([1.,0.5])
+    steps    = np.array([0.1,0.1])[None,:]/2.**np.arange(4)[:,None]
+    shifts   = np.zeros((4,2,len(stencil_offsets),2))
+    for i in range(2):
+        shifts[:,i,:,i] = steps[:,i,None]*stencil_offsets[None,:]
+    points = fiducial+shifts.reshape(-1,2)
+
+    exact  = np.array([np.exp(-fiducial[1]*z),-z*fiducial[0]*np.exp(-fiducial[1]*z)])
+    failed = np.zeros(len(points),dtype=bool)
+    failed[np.arange(2)*len(stencil_offsets)] = True
+    for label,valid in zip(['all points','failed points'],[~np.zeros(len(points),dtype=bool),~failed]):
+        derivs  = StencilDerivatives(ToyTheory(points,valid),steps).get_result('f',z)
+        maxdiff = np.max(abs(derivs-exact))/np.max(abs(exact))
+        if maxdiff < threshold:
+            print('\033[0;32m'+'Stencil derivatives with {} match (relative difference {:.1e})'.format(label,maxdiff)+'\033[0m')
+        else:
+            print('\033[1;31m'+'Stencil derivatives with {} mismatch (relative difference {:.1e})'.format(label,maxdiff)+'\033[0m')
+
+    #Blocks of 4 events, also banded
+    blocks = rng.normal(0.,1.,(N//4,4,4))
+    C = np.zeros((N,N))
+    for i,block in enumerate(blocks):
+        C[4*i:4*i+4,4*i:4*i+4] = block@block.T+4*np.eye(4)
+    jacobian = rng.normal(size=(3,N))
+    exact = jacobian@np.linalg.inv(C)@jacobian.T
+    for structure in ['block','banded','dense']:
+        fisher  = GWCovariance(C,structure).fisher(jacobian)
+        maxdiff = np.max(abs(fisher-exact))/np.max(abs(exact))
+        if maxdiff < threshold:
+            print('\033[0;32m'+'GW Fisher matrix with {} covariance matches (relative difference {:.1e})'.format(structure,maxdiff)+'\033[0m')
+        else:
+            print('\033[1;31m'+'GW Fisher matrix with {} covariance mismatch (relative difference {:.1e})'.format(structure,maxdiff)+'\033[0m')
+
+    return None
+
+def test_emulator(threshold,filename,npoints=50):
+
+    #Compares the emulator of the Standard module (see theory_code/emulator.py)
+    #with CAMB on random points inside its training hull. Threshold is a percentage
+
+    from theory_code.emulator import BackgroundEmulator
+    from theory_code.expansion_models.standard_cosmology import StandardExpansion
+
+    emulator = BackgroundEmulator(filename)
+    standard = StandardExpansion('Standard')
+
+    settings = deepcopy(emulator.grid_settings)
+
+    rng = np.random.default_rng(42)
+
+    maxdiff = {'H_Mpc': 0., 'comoving': 0., 'rdrag': 0.}
+    ntest   = 0
+    while ntest < npoints:
+        params = emulator.get_params(rng.uniform(size=len(emulator.features)))
+        if not emulator.covers(params,settings):
+            continue
+        ntest += 1
+
+        emulated = emulator.predict(params)
+        camb_res = standard.get_cosmology(deepcopy(params),settings)
+
+        maxdiff['H_Mpc']    = max(maxdiff['H_Mpc'],np.max(abs(emulated['H_Mpc']/camb_res['H_Mpc'](emulator.zcalc)-1)))
+        maxdiff['comoving'] = max(maxdiff['comoving'],np.max(abs(emulated['comoving']/camb_res['comoving'](emulator.zcalc)-1)))
+        maxdiff['rdrag']    = max(maxdiff['rdrag'],abs(emulated['rdrag']/camb_res['rdrag']-1))
+
+    for obs,diff in maxdiff.items():
+        if 100*diff < threshold:
+            print('\033[0;32m'+'Emulator {} matches CAMB (max relative difference {:.1e})'.format(obs,diff)+'\033[0m')
+        else:
+            print('\033[1;31m'+'Emulator {} mismatch with CAMB (max relative difference {:.1e})'.format(obs,diff)+'\033[0m')
+
+    return None
+
+def find_minimum_Nz(tolerance,zmin=1.e-4,zmax=5.,zlow=1.e-3,spacings=['linear','log','sinh'],zscale=0.001,Nz_max=20000):
+
+    #Minimum number of grid nodes for each grid spacing (see get_zgrid) such that
+    #DM, DH and DL_EM are within tolerance (relative) of a log grid with Nz_max
+    #nodes, for the Standard and Custom test cosmologies. mB is checked as
+    #a relative error on DL (ln(10)/5 times the error in magnitudes).
+    #Redshifts from zlow (lowest in the data, e.g. 0.001 for Pantheon+) to zmax
+
+    standard_params = {'cosmology': 'Standard',
+                       'parameters':{'H0': 67.36,
+                                     'omch2': 0.1200,
+                                     'ombh2': 0.02237,
+                                     'omk': 0.,
+                                     'omnuh2': 0.0006442,
+                                     'nnu': 3.}}
+
+    custom_params = {'cosmology': 'Custom',
+                     'parameters': {'H0': 67.36,
+                                    'omegam': 0.3153,
+                                    'Delta': 0.1,
+                                    'Gamma': 0.,
+                                    'ombh2': 0.02237}}
+
+    SNmodel = {'model': 'constant',
+               'MB': -19.2435}
+
+    observables = ['DM','DH','DL_EM','mB']
+    ztest = np.geomspace(max(zlow,zmin),zmax,300)
+
+    def get_observables(settings):
+        results = []
+        for cosmo in [standard_params,custom_params]:
+            theory = TheoryCalcs(settings,deepcopy(cosmo),SNmodel,None,observables=observables)
+            results.append({obs: getattr(theory,obs)(ztest) for obs in observables})
+        return results
+
+    def get_error(settings):
+        error = 0.
+        for res,ref in zip(get_observables(settings),reference):
+            for obs in ['DM','DH','DL_EM']:
+                error = max(error,np.max(abs(res[obs]/ref[obs]-1)))
+            error = max(error,np.log(10)/5*np.max(abs(res['mB']-ref['mB'])))
+        return error
+
+    #Log grid reference, accurate also for the magnitudes at low z
+    reference = get_observables({'zmin': zmin, 'zmax': zmax, 'Nz': Nz_max, 'spacing': 'log'})
+
+    minimum_Nz = {}
+    for spacing in spacings:
+        settings = {'zmin': zmin, 'zmax': zmax, 'spacing': spacing, 'zscale': zscale}
+
+        #Doubling and then bisection, the error decreases with Nz
+        low,high = 10,20
+        while get_error(dict(settings,Nz=high)) > tolerance:
+            low,high = high,2*high
+            if high > Nz_max:
+                break
+        if high > Nz_max:
+            print('\033[1;31m'+'{} grid: tolerance {:.1e} not reached with Nz <= {}'.format(spacing,tolerance,Nz_max)+'\033[0m')
+            minimum_Nz[spacing] = None
+            continue
+        while high-low > 1:
+            mid = (low+high)//2
+            if get_error(dict(settings,Nz=mid)) > tolerance:
+                low = mid
+            else:
+                high = mid
+
+        minimum_Nz[spacing] = high
+        print('\033[0;32m'+'{} grid: Nz = {} for relative errors below {:.1e}'.format(spacing,high,tolerance)+'\033[0m')
+
+    return minimum_Nz
+
+def test_DDR_parametrizations(threshold):
+
+    #Checks the analytic derivatives of the DDR parametrizations against
+    #finite differences, and the evaluation for a batch of points against
+    #the one point at a time. Threshold is a relative difference
+
+    from theory_code.DDR_parametrizations import DDR_models
+
+    z = np.linspace(0.001,5.,500)
+    options = {'bins': [0.,0.5,1.,2.,5.]}
+    values  = {'epsilon0': 0.1, 'a': 1., 'n': 1.}
+
+    rng = np.random.default_rng(42)
+
+    for label,model_class in DDR_models.items():
+        model = model_class(options)
+        p = {par: values.get(par,0.05*(i+1)) for i,par in enumerate(model.params)}
+
+        maxdiff = 0.
+        for par,der in model.derivatives(z,p).items():
+            if label == 'pade' and par == 'n':
+                continue
+            step = 1.e-6*max(abs(p[par]),1.)
+            numerical = (model.eta(z,dict(p,**{par: p[par]+step}))-model.eta(z,dict(p,**{par: p[par]-step})))/(2*step)
+            maxdiff = max(maxdiff,np.max(abs(der-numerical))/np.max(abs(numerical)+1.e-30))
+
+        #Batch of points as (Npoints,1) columns
+        batch = {par: val+np.zeros((10,1)) for par,val in p.items()}
+        for par in batch:
+            if not (label == 'pade' and par == 'n'):
+                batch[par] = batch[par]*(1+0.1*rng.normal(size=(10,1)))
+        rows = np.array([model.eta(z,{par: val[i,0] for par,val in batch.items()}) for i in range(10)])
+        batchdiff = np.max(abs(model.eta(z,batch)/rows-1))
+
+        if maxdiff < threshold and batchdiff < threshold:
+            print('\033[0;32m'+'DDR {}: derivatives and batch evaluation fine (max relative difference {:.1e})'.format(label,max(maxdiff,batchdiff))+'\033[0m')
+        else:
+            print('\033[1;31m'+'DDR {}: mismatch in derivatives ({:.1e}) or batch evaluation ({:.1e})'.format(label,maxdiff,batchdiff)+'\033[0m')
+
+    return None
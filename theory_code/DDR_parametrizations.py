@@ -1,37 +1,168 @@
-#MM: this module is currently empty and sad :(
-#Here we could add fancy ways to obtain eta(z) given specific theories
+#Here we could add fancy ways to obtain eta(z) given specific theories.
+#Each parametrization is a class with a label, the names of its parameters
+#(without the _EM/_GW suffix), eta(z,params) and derivatives(z,params)
+#giving d eta/d parameter. Parameters can be numbers or arrays of shape
+#(Npoints,1), the results are then (Npoints,Nz) arrays, one row per point
+#(derivatives not depending on the parameters are returned as (Nz,) arrays).
+#New parametrizations are added to DDR_models at the end of the file
 
 import sys
 import numpy  as np
 import pandas as pd
 
 from copy import deepcopy
-from scipy.interpolate import interp1d
+
+
+def no_breaking(z):
+    #eta = 1 with the same shape as z
+
+    return np.ones(np.shape(z))
+
+
+class PolynomialDDR:
+    #eta(z) = (1+a*z^n)^epsilon0
+
+    label  = 'polynomial'
+    params = ['epsilon0','a','n']
+
+    def __init__(self,options):
+        pass
+
+    def eta(self,z,p):
+
+        return (1+p['a']*z**p['n'])**p['epsilon0']
+
+    def derivatives(self,z,p):
+
+        base = 1+p['a']*z**p['n']
+        #z^n*log(z) goes to 0 at z=0
+        logz = np.log(np.where(z > 0,z,1.))
+        dbase = p['epsilon0']*base**(p['epsilon0']-1)
+
+        return {'epsilon0': base**p['epsilon0']*np.log(base),
+                'a': dbase*z**p['n'],
+                'n': dbase*p['a']*z**p['n']*logz}
+
+
+class PadeDDR:
+    #Pade approximant of the polynomial model with n=1 that keeps
+    #eta finite up to the last scattering surface
+
+    label  = 'pade'
+    params = ['epsilon0','n']
+
+    z_LSS = 1100
+
+    def __init__(self,options):
+        pass
+
+    def eta(self,z,p):
+
+        if np.any(p['n'] != 1):
+            sys.exit('Pade approximant implemented only for n=1')
+
+        return 1+p['epsilon0']*self.derivatives(z,p)['epsilon0']
+
+    def derivatives(self,z,p):
+
+        #n is fixed to 1
+        return {'epsilon0': (2*z*(z-self.z_LSS))/(2*(z-self.z_LSS)-z*self.z_LSS),
+                'n': np.zeros(np.shape(z))}
+
+
+class LogarithmicDDR:
+    #eta(z) = 1+epsilon0*log(1+z)
+
+    label  = 'logarithmic'
+    params = ['epsilon0']
+
+    def __init__(self,options):
+        pass
+
+    def eta(self,z,p):
+
+        return 1+p['epsilon0']*np.log(1+z)
+
+    def derivatives(self,z,p):
+
+        return {'epsilon0': np.log(1+z)}
+
+
+class BinnedDDR:
+    #eta(z) = 1+epsilon_i in the redshift bin i, with the bin edges given
+    #in the DDR options (e.g. bins: [0.,0.5,1.,2.,5.]). Redshifts outside
+    #the edges belong to the first or last bin. Parameters epsilon1, epsilon2, ...
+
+    label = 'binned'
+
+    def __init__(self,options):
+
+        if 'bins' not in options:
+            sys.exit('Binned DDR needs the bin edges (bins: [z0,z1,...])')
+
+        self.edges  = np.array(options['bins'],dtype=float)
+        self.params = ['epsilon{}'.format(i+1) for i in range(len(self.edges)-1)]
+
+    def eta(self,z,p):
+
+        eta = no_breaking(z)
+        for par,mask in self.derivatives(z,p).items():
+            eta = eta+p[par]*mask
+
+        return eta
+
+    def derivatives(self,z,p):
+
+        idx = np.searchsorted(self.edges[1:-1],z,side='right')
+
+        return {par: 1.*(idx == i) for i,par in enumerate(self.params)}
+
+
+#Registry of the parametrizations: eta_model in the DDR options -> class
+DDR_models = {model.label: model for model in [PolynomialDDR,PadeDDR,LogarithmicDDR,BinnedDDR]}
+
+def get_DDR_model(DDR_info):
+
+    eta_model = DDR_info['eta_model']
+    #Old settings ask for the Pade approximant of the polynomial model
+    if eta_model == 'polynomial' and DDR_info.get('use_pade',False) == True:
+        eta_model = 'pade'
+
+    if eta_model not in DDR_models:
+        sys.exit('Unknown DDR breaking model: {}'.format(eta_model))
+
+    return DDR_models[eta_model](DDR_info)
 
 
 class DDRCalcs:
+    #eta_EM(z) and eta_GW(z) of a parametrization, evaluated directly at any z.
+    #The parameters are those of the model with the _EM and _GW suffixes,
+    #the model can be passed if already built (see get_DDR_model)
 
-    def __init__(self,DDR_info,zcalc):
+    def __init__(self,DDR_info,zcalc,model=None):
 
         self.zcalc = zcalc
-        self.settings = {'eta_model': DDR_info['eta_model'], 'pade': DDR_info['use_pade']}
-        params = DDR_info['parameters'] 
-        self.z_LSS = 1100
-
-        if self.settings['eta_model'] == 'polynomial':
-            self.eta_EM = self.get_eta(params['epsilon0_EM'],params['n_EM'], params['a_EM'])
-            self.eta_GW = self.get_eta(params['epsilon0_GW'], params['n_GW'], params['a_GW'])    
-        else:
-            sys.exit('Unknown DDR breaking model: {}'.format(settings['epsilon_model']))
-
-    def get_eta(self,epsilon, n, a):
-        if self.settings['pade'] == True:
-            if n != 1:
-                sys.exit('Pade approximant implemented only for n=1')
-            else:
-                eta_pade = 1+ (2*self.zcalc*(self.zcalc-self.z_LSS)*epsilon)/(2*(self.zcalc-self.z_LSS)-self.zcalc*self.z_LSS)
-                eta = interp1d(self.zcalc, eta_pade)
-        else:
-            eta = interp1d(self.zcalc,(1+(a*self.zcalc**n))**epsilon)
+        self.model = model if model != None else get_DDR_model(DDR_info)
+        params = DDR_info['parameters']
 
-        return eta
+        try:
+            self.params = {tracer: {par: params[par+'_'+tracer] for par in self.model.params} for tracer in ['EM','GW']}
+        except KeyError as e:
+            sys.exit('Missing parameter for the {} DDR model: {}'.format(self.model.label,e))
+
+    def eta_EM(self,z):
+
+        return self.model.eta(z,self.params['EM'])
+
+    def eta_GW(self,z):
+
+        return self.model.eta(z,self.params['GW'])
+
+    def get_derivatives(self,z):
+
+        derivs = {}
+        for tracer in ['EM','GW']:
+            for par,der in self.model.derivatives(z,self.params[tracer]).items():
+                derivs[par+'_'+tracer] = der
+
+        return derivs
@@ -3,18 +3,165 @@ import numpy  as np
 import pandas as pd
 
 from copy import deepcopy
-from scipy.interpolate import interp1d
+from collections import OrderedDict
 
-from theory_code.distance_theory import TheoryCalcs
+from theory_code.distance_theory import TheoryCalcs,TheoryResults,FiducialCosmology,get_expansion_module,get_zgrid,interpolation_weights
+from theory_code.DDR_parametrizations import DDRCalcs,get_DDR_model
 
 from cobaya.theory import Theory
 
-class CalcDist(Theory):
+
+def get_run_stats(cosmology,calcdist=None):
+
+    #Counters of this process (see print_run_stats): those of CalcDist if
+    #the process has a model, and the solver statistics of the expansion
+    #module (ODE-based ones only), which also count the points computed
+    #outside CalcDist (BatchTheoryCalcs). Both are reset once read
+    stats = calcdist.get_stats() if calcdist != None else {}
+
+    cosmo_module = get_expansion_module(cosmology)
+    if hasattr(cosmo_module,'get_report'):
+        stats['solver'] = dict(cosmo_module.stats)
+        cosmo_module.reset_stats()
+
+    stats['cosmology'] = cosmology
+
+    return stats
+
+def print_run_stats(stats):
+
+    #Counters of get_run_stats, added up over the processes of the run
+    caches = [proc['cache'] for proc in stats if 'cache' in proc]
+    cache  = {key: sum([proc[key] for proc in caches]) for key in ['hits','misses','evictions','entries','MB']}
+    calls  = cache['hits']+cache['misses']
+    if calls > 0:
+        print('CalcDist cache{}: {} hits, {} misses ({:.1f}% hits), {} evictions, {} entries using {:.2f} MB'.format(' of {} processes'.format(len(caches)) if len(caches) > 1 else '',
+                                                                                                               cache['hits'],cache['misses'],
+                                                                                                               100*cache['hits']/calls,
+                                                                                                               cache['evictions'],cache['entries'],
+                                                                                                               cache['MB']))
+
+    solvers = [proc for proc in stats if 'solver' in proc]
+    if solvers != []:
+        solver = {key: sum([proc['solver'][key] for proc in solvers]) for key in solvers[0]['solver']}
+        if solver['points'] > 0:
+            print(get_expansion_module(solvers[0]['cosmology']).get_report(solver))
+
+
+class RedshiftTheory(Theory):
+    #Common machinery of the theory components below.
+    #Likelihoods can ask for an observable at given redshifts,
+    #e.g. {'mB': {'z': zarray}}. Requests for the same observable
+    #are merged, and the observable is then stored in the state as
+    #an array on the merged redshifts instead of a function of z.
+    #Observables nobody requested are not stored at all
+
+    def initialize(self):
+
+        self.requested  = set()
+        self.z_requests = {}
+        self.z_weights  = {}
+        self.z_indices  = {}
+
+    def initialize_with_provider(self, provider):
+        """
+        Initialization after other components initialized, using Provider class
+        instance which is used to return any dependencies (see calculate below).
+        """
+        self.provider = provider
+
+    def must_provide(self, **requirements):
+
+        super().must_provide(**requirements)
+
+        self.requested.update(requirements.keys())
+
+        for obs,options in requirements.items():
+            if not options or 'z' not in options:
+                continue
+
+            z = np.atleast_1d(np.array(options['z'],dtype=float))
+            self.check_redshifts(obs,z)
+            if obs in self.z_requests:
+                z = np.concatenate([self.z_requests[obs],z])
+            self.z_requests[obs] = np.unique(z)
+            self.z_indices[obs]  = {}
+            self.z_weights[obs]  = None
+
+    def get_zgrid(self):
+
+        #Redshift grid of the component, if known before calculate.
+        #CalcDDR and CalcMagnitude get theirs from the background of CalcDist,
+        #so they pass their redshifts on to it to be checked there
+        return None
+
+    def check_redshifts(self,obs,z):
+
+        #Done in must_provide, so that a wrong request stops the run
+        #before CAMB and the likelihoods are set up
+        zgrid = self.get_zgrid()
+        if zgrid is not None and (z.min() < zgrid[0] or z.max() > zgrid[-1]):
+            sys.exit('Redshifts requested for {} ({:.4g} - {:.4g}) are outside the theory range ({} - {})'.format(obs,z.min(),z.max(),
+                                                                                                                 zgrid[0],zgrid[-1]))
+
+    def get_node_weights(self,obs,zgrid):
+
+        z = self.z_requests[obs]
+
+        #Only the grid nodes around the requested redshifts are needed
+        idx,w = interpolation_weights(zgrid,z)
+        nodes = np.unique(np.concatenate([idx,idx+1]))
+
+        return zgrid[nodes],np.searchsorted(nodes,idx),w
+
+    def store_products(self,state,products,zgrid):
+        #Observables requested at given redshifts are interpolated there
+        #from the grid, the others are stored as functions of z
+
+        for obs,func in products.items():
+            if obs not in self.requested:
+                continue
+            elif obs in self.z_requests:
+                if self.z_weights[obs] is None:
+                    self.z_weights[obs] = self.get_node_weights(obs,zgrid)
+                znodes,idx,w = self.z_weights[obs]
+                values = np.broadcast_to(func(znodes),znodes.shape)
+                state[obs] = values[idx]*(1-w)+values[idx+1]*w
+            else:
+                state[obs] = func
+
+    def get_result(self, result_name, **kwargs):
+
+        result = self.current_state[result_name]
+        if 'z' not in kwargs:
+            return result
+        elif callable(result):
+            return result(kwargs['z'])
+
+        #Position of the requested redshifts among the merged ones,
+        #stored for the arrays the likelihoods keep passing
+        z       = kwargs['z']
+        indices = self.z_indices[result_name]
+        if id(z) not in indices:
+            if len(indices) > 16:
+                indices.clear()
+            idx = np.clip(np.searchsorted(self.z_requests[result_name],z),0,len(self.z_requests[result_name])-1)
+            if np.any(self.z_requests[result_name][idx] != z):
+                sys.exit('{} was not requested at some of these redshifts. Add them to get_requirements'.format(result_name))
+            indices[id(z)] = (z,idx)
+
+        return result[indices[id(z)][1]]
+
+
+class CalcDist(RedshiftTheory):
+    #Background component: expansion module, distances, rdrag
+    #and BAO observables. Depends only on the cosmological parameters
 
     
     def initialize(self):
         """called from __init__ to initialize"""
         
+        super().initialize()
 
         if self.fiducial == None:
             self.fiducial = {'H0': 67.36,
@@ -25,21 +172,88 @@ class CalcDist(Theory):
                              'nnu': 3.}
 
 
-        self.zcalc = np.linspace(self.settings['zmin'],self.settings['zmax'],self.settings['Nz'])
+        self.zcalc = get_zgrid(self.settings)
 
-    def initialize_with_provider(self, provider):
-        """
-        Initialization after other components initialized, using Provider class
-        instance which is used to return any dependencies (see calculate below).
-        """
-        self.provider = provider
+        #Expansion module loaded once, then reused at every calculate
+        self.cosmo_module = get_expansion_module(self.cosmology)
+
+        #LRU cache of the results, for samplers revisiting the same points.
+        #max_size = 0 switches it off
+        cache_sets = self.cache if self.cache != None else {}
+        self.cache_size   = cache_sets.get('max_size',128)
+        self.cache_memory = cache_sets.get('max_memory_MB',100)*1024**2
+        self.cache        = OrderedDict()
+        self.cache_bytes  = 0
+        self.cache_stats  = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_zgrid(self):
+
+        return self.zcalc
+
+    def must_provide(self, **requirements):
+
+        #CalcDDR sends the redshifts of the luminosity distances with the
+        #background request, only to check them against zcalc
+        background = requirements.get('background')
+        if background and 'z' in background:
+            self.check_redshifts('DL_EM/DL_GW',np.atleast_1d(np.array(background['z'],dtype=float)))
+            requirements['background'] = None
+
+        super().must_provide(**requirements)
+
+        #Fiducial for the BAO alphas, computed once for the whole run
+        #and only if the alphas are requested
+        if ('alpha_iso' in self.requested or 'alpha_AP' in self.requested) and not isinstance(self.fiducial,FiducialCosmology):
+            self.fiducial = FiducialCosmology(self.fiducial,self.settings)
+
+    def cache_key(self,params_values_dict):
+
+        #MB and DDR parameters belong to the other components, so only
+        #cosmological parameters get here
+        return tuple((par,float(val)) for par,val in sorted(params_values_dict.items()))
+
+    def cache_store(self,key,results):
+
+        #Arrays are counted with their size, functions with the
+        #arrays of their TheoryResults (once, they share them)
+        nbytes  = 0
+        counted = []
+        for res in list(results.values())+list(results.get('background',{}).values()):
+            if isinstance(res,np.ndarray):
+                nbytes += res.nbytes
+            elif isinstance(getattr(res,'__self__',None),TheoryResults) and not any([res.__self__ is c for c in counted]):
+                nbytes += res.__self__.nbytes
+                counted.append(res.__self__)
+
+        self.cache[key]   = (results,nbytes)
+        self.cache_bytes += nbytes
+
+        while len(self.cache) > self.cache_size or (self.cache_bytes > self.cache_memory and len(self.cache) > 1):
+            _,(_,old_bytes) = self.cache.popitem(last=False)
+            self.cache_bytes -= old_bytes
+            self.cache_stats['evictions'] += 1
+
+    def get_stats(self):
+
+        #Counters since the last call, which resets them, so that the
+        #samplers add up those of their workers only once (see print_run_stats)
+        stats = {}
+        if self.cache_size > 0:
+            stats['cache'] = dict(self.cache_stats,entries=len(self.cache),MB=self.cache_bytes/1024**2)
+            self.cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+        return stats
+
+    def close(self, *args):
+
+        print_run_stats([get_run_stats(self.cosmology,self)])
 
     def get_can_provide(self):
 
-        return ['DM','DH','DV','DL_EM','DL_GW',
-                'mB','abs_mag',
+        return ['DM','DH','DV',
                 'DV_rd','DM_DH','DM_rd','DH_rd',
-                'alpha_iso','alpha_AP']
+                'alpha_iso','alpha_AP',
+                'background']
 
     def get_can_provide_params(self):
 
@@ -47,35 +261,147 @@ class CalcDist(Theory):
 
     def calculate(self, state, want_derived=True, **params_values_dict):
 
-        ##MM: to be improved!!!
+        if self.cache_size > 0:
+            key = self.cache_key(params_values_dict)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.cache_stats['hits'] += 1
+                state.update(self.cache[key][0])
+                return
+            self.cache_stats['misses'] += 1
 
-        DDRpars   = ['a_EM','n_EM','epsilon0_EM','a_GW','n_GW','epsilon0_GW']
-        
-        SNmodel   = {'model': 'constant', 'MB': params_values_dict.pop('MB')}
         cosmosets = {'cosmology': self.cosmology,
-                     'parameters': {k:v for k,v in params_values_dict.items() if k not in DDRpars}}
+                     'parameters': deepcopy(params_values_dict)}
 
         if params_values_dict['rd'] == 0.:
             del cosmosets['parameters']['rd']
 
-       
-        DDR = self.DDR_options
-        if DDR != None:
-            DDR['parameters'] = {k:v for k,v in params_values_dict.items() if k in DDRpars}
-
-        theory = TheoryCalcs(self.settings,cosmosets,SNmodel,self.fiducial,DDR=DDR)
-
-        state['DM']        = theory.DM 
-        state['DH']        = theory.DH
-        state['DV']        = theory.DV
-        state['DV_rd']     = theory.DV_rd
-        state['DM_rd']     = theory.DM_rd
-        state['DH_rd']     = theory.DH_rd
-        state['DM_DH']     = theory.DM_DH
-        state['alpha_iso'] = theory.alpha_iso
-        state['alpha_AP']  = theory.alpha_AP
-        state['DL_EM']     = theory.DL_EM
-        state['DL_GW']     = theory.DL_GW
-        state['mB']        = theory.mB
-        state['abs_mag']   = theory.MB
+        #DDR and SN magnitudes are computed by CalcDDR and CalcMagnitude.
+        #Only the requested observables are computed (e.g. with GW data only
+        #just the background for CalcDDR)
+        observables = [obs for obs in self.get_can_provide() if obs in self.requested and obs != 'background']
+        if 'background' in self.requested:
+            observables += ['DL_EM','DL_GW']
+
+        theory = TheoryCalcs(self.settings,cosmosets,None,self.fiducial,DDR=None,
+                             cosmo_module=self.cosmo_module,observables=observables,zcalc=self.zcalc)
+
+        #Only the grid arrays of theory.results are kept in the state,
+        #the observables not requested at given z are its methods
+        results  = theory.results
+        products = {obs: getattr(results,obs) for obs in ['DM','DH','DV',
+                                                          'DV_rd','DM_rd','DH_rd','DM_DH',
+                                                          'alpha_iso','alpha_AP']}
+
+        self.store_products(state,products,self.zcalc)
+
+        #Grid quantities needed by CalcDDR. If the expansion module
+        #breaks DDR itself, its eta(z) are passed along (None otherwise)
+        if 'background' in self.requested:
+            state['background'] = {'z': self.zcalc,
+                                   'comoving': results.comoving,
+                                   'eta_EM': results.eta_EM,
+                                   'eta_GW': results.eta_GW}
+
         state['derived']   = {par: getattr(theory,par) for par in self.derived_pars}
+
+        if self.cache_size > 0:
+            self.cache_store(key,{obs: state[obs] for obs in list(products.keys())+['background','derived'] if obs in state})
+
+
+class CalcDDR(RedshiftTheory):
+    #Luminosity distances from the background and eta(z).
+    #Depends only on the DDR parameters, so it is fast
+
+    def initialize(self):
+
+        super().initialize()
+
+        #The DDR parametrization (see DDR_parametrizations.py) is built once
+        self.DDR_model = get_DDR_model(self.DDR_options) if self.DDR_options != None else None
+
+    def get_can_support_params(self):
+
+        #Parameters of the parametrization, also those not in CalcDDR.yaml
+        #(e.g. epsilon1_EM, epsilon2_EM, ... of the binned model)
+        if self.DDR_model == None:
+            return []
+
+        return [par+'_'+tracer for tracer in ['EM','GW'] for par in self.DDR_model.params]
+
+    def must_provide(self, **requirements):
+
+        super().must_provide(**requirements)
+
+        #The background of CalcDist is needed only for the luminosity
+        #distances, e.g. not in BAO only runs
+        if 'DL_EM' in self.requested or 'DL_GW' in self.requested:
+            z = [self.z_requests[obs] for obs in ['DL_EM','DL_GW'] if obs in self.z_requests]
+            return {'background': {'z': np.concatenate(z)} if z != [] else None}
+
+    def get_can_provide(self):
+
+        return ['DL_EM','DL_GW']
+
+    def calculate(self, state, want_derived=True, **params_values_dict):
+
+        if 'DL_EM' not in self.requested and 'DL_GW' not in self.requested:
+            return
+
+        background = self.provider.get_result('background')
+        zcalc      = background['z']
+
+        if background['eta_EM'] is not None:
+            eta_EM = background['eta_EM']
+            eta_GW = background['eta_GW']
+        elif self.DDR_model != None:
+            try:
+                ddr_results = DDRCalcs({'parameters': params_values_dict},zcalc,model=self.DDR_model)
+                eta_EM = ddr_results.eta_EM(zcalc)
+                eta_GW = ddr_results.eta_GW(zcalc)
+            except Exception as e:
+                sys.exit('DDR FAILED!\n {}'.format(e))
+        else:
+            eta_EM = None
+            eta_GW = None
+
+        results  = TheoryResults(zcalc,background['comoving'],eta_EM=eta_EM,eta_GW=eta_GW)
+        products = {'DL_EM': results.DL_EM,
+                    'DL_GW': results.DL_GW}
+
+        self.store_products(state,products,zcalc)
+
+
+class CalcMagnitude(RedshiftTheory):
+    #SN magnitudes from DL_EM and the absolute magnitude.
+    #Depends only on MB, so it is fast
+
+    def must_provide(self, **requirements):
+
+        super().must_provide(**requirements)
+
+        if 'mB' in requirements:
+            return {'DL_EM': requirements['mB']}
+
+    def get_can_provide(self):
+
+        return ['mB','abs_mag']
+
+    def calculate(self, state, want_derived=True, **params_values_dict):
+
+        MB = params_values_dict['MB']
+
+        #MM: ugly fix to avoid log10(0). To be fixed
+        eps_dL = 1.e-6
+
+        if 'mB' in self.z_requests:
+            DL = self.provider.get_result('DL_EM',z=self.z_requests['mB'])
+            state['mB'] = 5*np.log10(DL+eps_dL)+MB+25
+        elif 'DL_EM' in self.provider.requirement_providers:
+            DL = self.provider.get_result('DL_EM')
+            state['mB'] = lambda x: 5*np.log10(DL(x)+eps_dL)+MB+25
+
+        if 'abs_mag' in self.z_requests:
+            state['abs_mag'] = np.full(len(self.z_requests['abs_mag']),MB)
+        else:
+            state['abs_mag'] = lambda x: MB
@@ -0,0 +1,143 @@
+import sys,os
+import json
+import hashlib
+import argparse
+
+import numpy  as np
+
+from time import time
+
+
+class DiskCache:
+    #Background results stored on disk, one .npz file per point, so that
+    #they can be shared by different runs and processes. Files are written
+    #to a temporary name and then renamed, so readers never see partial
+    #files and concurrent writers of the same point are harmless.
+    #Least recently used files are removed when the folder gets too big
+
+    def __init__(self,path,max_MB=500,check_every=50):
+
+        self.path        = path
+        self.max_bytes   = max_MB*1024**2
+        self.check_every = check_every
+        self.saved       = 0
+
+        os.makedirs(self.path,exist_ok=True)
+        self.prune()
+
+    def get_key(self,label,params,settings,version):
+
+        #Floats are dumped with their full repr, so only identical points match
+        keydict = {'label': label,
+                   'params': {par: float(val) for par,val in params.items()},
+                   'grid': [float(settings['zmin']),float(settings['zmax']),int(settings['Nz'])],
+                   'version': version}
+        #Non uniform grids (see get_zgrid), linear ones keep the same keys as before
+        if settings.get('spacing','linear') != 'linear':
+            keydict['spacing'] = [settings['spacing'],float(settings.get('zscale',0.001))]
+
+        return hashlib.sha256(json.dumps(keydict,sort_keys=True).encode()).hexdigest()
+
+    def load(self,key):
+
+        filename = os.path.join(self.path,key+'.npz')
+        try:
+            with np.load(filename) as f:
+                stored = {k: f[k] for k in f.files}
+            #Access time kept for the eviction
+            os.utime(filename)
+        except (OSError,ValueError):
+            return None
+
+        return stored
+
+    def save(self,key,results):
+
+        filename = os.path.join(self.path,key+'.npz')
+        tmpname  = filename+'.{}.tmp'.format(os.getpid())
+        try:
+            with open(tmpname,'wb') as f:
+                np.savez(f,**results)
+            os.replace(tmpname,filename)
+        except OSError as e:
+            print('Could not write in the theory cache: {}'.format(e))
+            return
+
+        #The folder is scanned only once in a while
+        self.saved += 1
+        if self.saved % self.check_every == 0:
+            self.prune()
+
+    def get_entries(self):
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime,stat.st_size,entry.path))
+                except FileNotFoundError:
+                    pass
+
+        return sorted(entries)
+
+    def prune(self,max_bytes=None,older_than=None):
+
+        if max_bytes == None:
+            max_bytes = self.max_bytes
+
+        entries = self.get_entries()
+        total   = sum([e[1] for e in entries])
+        removed = 0
+
+        for mtime,size,filename in entries:
+            too_old = older_than != None and time()-mtime > older_than
+            if total <= max_bytes and not too_old:
+                continue
+            #Other processes may be removing the same files
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total   -= size
+            removed += 1
+
+        return removed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Inspect or prune the on-disk theory cache')
+    parser.add_argument('path',help='cache folder (disk_cache: path in the settings)')
+    parser.add_argument('--max-MB',type=float,default=None,help='remove least recently used entries above this size')
+    parser.add_argument('--older-than',type=float,default=None,help='remove entries not used for this many days')
+    parser.add_argument('--clear',action='store_true',help='remove all entries')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        sys.exit('No theory cache in {}'.format(args.path))
+
+    cache = DiskCache(args.path,max_MB=np.inf)
+
+    if args.clear:
+        removed = cache.prune(max_bytes=0)
+    elif args.max_MB != None or args.older_than != None:
+        max_bytes  = np.inf if args.max_MB == None else args.max_MB*1024**2
+        older_than = None if args.older_than == None else args.older_than*86400
+        removed    = cache.prune(max_bytes=max_bytes,older_than=older_than)
+    else:
+        removed = 0
+
+    entries = cache.get_entries()
+    print('Theory cache in {}'.format(args.path))
+    if removed > 0:
+        print('Removed entries: {}'.format(removed))
+    print('Entries: {}'.format(len(entries)))
+    print('Size: {:.2f} MB'.format(sum([e[1] for e in entries])/1024**2))
+    if entries != []:
+        print('Least recently used: {:.1f} days ago'.format((time()-entries[0][0])/86400))
+        print('Most recently used: {:.1f} days ago'.format((time()-entries[-1][0])/86400))
+
+
+if __name__ == '__main__':
+    main()
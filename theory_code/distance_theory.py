@@ -9,42 +9,367 @@ from copy import deepcopy
 from time import time
 
 from scipy.interpolate import interp1d
-from scipy.integrate   import trapezoid,quad
+from scipy.integrate   import trapezoid
 
-from theory_code.DDR_parametrizations import DDRCalcs
+from theory_code.DDR_parametrizations import DDRCalcs,no_breaking
 
 clight = 299792.458
 
 
+#Gauss-Legendre nodes and weights, computed once per order
+legendre_nodes = {}
+
+def cumulative_integral(func,x,rtol=1.e-8,order=4,max_order=64):
+    #Cumulative integral of func from x[0] to every point of the grid x.
+    #Each panel [x_i,x_i+1] is integrated with Gauss-Legendre nodes, all panels
+    #at once. The order is doubled until the cumulative result changes by
+    #less than rtol (relative to the total) or max_order is reached.
+    #Tested against scipy quad: relative differences below 1e-9 on the
+    #piecewise linear H(z) interpolators of the expansion modules
+    #(see test_comoving_integrator in testing/testing_functions.py).
+    #func can also return one row per point (e.g. interp1d of a 2D array),
+    #the integrals of all the points are then computed together
+
+    half = 0.5*np.diff(x)
+    mid  = x[:-1]+half
+
+    def panels(n):
+        if n not in legendre_nodes:
+            legendre_nodes[n] = np.polynomial.legendre.leggauss(n)
+        nodes,weights = legendre_nodes[n]
+        values = func(mid[:,None]+half[:,None]*nodes[None,:])
+        return half*np.dot(values,weights)
+
+    old = panels(order)
+    while True:
+        order *= 2
+        new   = panels(order)
+        total = np.cumsum(new,axis=-1)
+        error = np.max(np.abs(np.cumsum(new-old,axis=-1))/np.max(np.abs(total),axis=-1,keepdims=True))
+        if error <= rtol or order >= max_order:
+            break
+        old = new
+
+    return np.concatenate([np.zeros(total.shape[:-1]+(1,)),total],axis=-1)
+
+
+def interpolation_weights(zgrid,z):
+    #Indices and weights for linear interpolation from zgrid to z.
+    #These depend only on the redshifts, so they can be computed once
+    #and applied to any function tabulated on zgrid as
+    #f[idx]*(1-w)+f[idx+1]*w
+
+    idx = np.clip(np.searchsorted(zgrid,z,side='right')-1,0,len(zgrid)-2)
+    w   = (z-zgrid[idx])/(zgrid[idx+1]-zgrid[idx])
+
+    return idx,w
+
+
+def get_zgrid(settings):
+    #Redshift grid of the theory calculation, from the settings (zmin, zmax, Nz).
+    #spacing (optional) can be
+    # - linear: uniform in z (default)
+    # - log:    uniform in log(z)
+    # - sinh:   uniform in asinh(z/zscale), i.e. linear below zscale
+    #           (default 0.001) and logarithmic above it
+    #Non uniform grids put more nodes at low z, where distances and SN
+    #magnitudes change faster, and fewer at high z. find_minimum_Nz in
+    #testing/testing_functions.py gives the nodes needed for a tolerance
+
+    zmin,zmax,Nz = settings['zmin'],settings['zmax'],int(settings['Nz'])
+    spacing = settings.get('spacing','linear')
+
+    if spacing == 'linear':
+        zgrid = np.linspace(zmin,zmax,Nz)
+    elif spacing == 'log':
+        zgrid = np.geomspace(zmin,zmax,Nz)
+    elif spacing == 'sinh':
+        zscale = settings.get('zscale',0.001)
+        zgrid  = zscale*np.sinh(np.linspace(np.arcsinh(zmin/zscale),np.arcsinh(zmax/zscale),Nz))
+    else:
+        sys.exit('Unknown redshift grid spacing: {}'.format(spacing))
+
+    #Ends exactly at zmin and zmax despite rounding
+    zgrid[0],zgrid[-1] = zmin,zmax
+
+    return zgrid
+
+
+def get_grid_key(settings):
+    #Everything defining the redshift grid, to check if two grids are the same
+
+    spacing = settings.get('spacing','linear')
+    zscale  = float(settings.get('zscale',0.001)) if spacing == 'sinh' else None
+
+    return (float(settings['zmin']),float(settings['zmax']),int(settings['Nz']),spacing,zscale)
+
+
+def import_classes_from_folder(folder_path):
+    #MM: this was done by Gemini
+    #Thank you, our Lord and Saviour!
+
+    if not os.path.isdir(folder_path):
+        print(f"Error: Folder '{folder_path}' not found.")
+        return {}
+
+    classes = {}
+    sys.path.insert(0, folder_path)
+
+    for filename in os.listdir(folder_path):
+        if filename.endswith(".py") and filename != "__init__.py":
+            module_name = filename[:-3]  # Remove .py extension
+            file_path = os.path.join(folder_path, filename)
+
+            try:
+                # Create a module spec
+                spec = importlib.util.spec_from_file_location(module_name, file_path)
+                if spec is None:
+                    print(f"Warning: Could not create spec for {file_path}")
+                    continue
+
+                # Load the module
+                module = importlib.util.module_from_spec(spec)
+                sys.modules[module_name] = module
+                spec.loader.exec_module(module)
+
+                # Inspect the module for classes
+                for name, obj in inspect.getmembers(module, inspect.isclass):
+                    # Ensure the class is defined in the current module, not an imported one
+                    if obj.__module__ == module_name:
+                        classes[name] = obj
+                        #print(f"Imported class: {name} from {filename}")
+
+            except Exception as e:
+                print(f"Error importing module {filename}: {e}")
+
+    # Clean up sys.path
+    if folder_path in sys.path:
+        sys.path.remove(folder_path)
+
+    return classes
+
+
+#Registry of the expansion modules: folder -> {cosmology label: model instance}
+expansion_registry = {}
+
+def get_expansion_module(cosmology,folder='theory_code/expansion_models',feedback=False):
+    #MM: this is a quite involved method to load
+    #all modules contained in the expansion_models folder.
+    #Files are executed and classes instantiated the first time
+    #this is called, after that the ready instance is returned
+
+    if folder not in expansion_registry:
+        imported_classes = import_classes_from_folder(folder)
+
+        modules = {}
+        for class_name, class_obj in imported_classes.items():
+            module = class_obj(None)
+            #Base classes (e.g. ODEExpansion) have no label
+            if module.label == None:
+                continue
+            if module.label in modules:
+                sys.exit('Error in importing possible expansion modules (probably same label for multiple modules)')
+            modules[module.label] = class_obj(module.label)
+
+        expansion_registry[folder] = modules
+
+    if cosmology not in expansion_registry[folder]:
+        sys.exit('UNKNOWN COSMOLOGY: {}'.format(cosmology))
+
+    cosmo_module = expansion_registry[folder][cosmology]
+    if feedback:
+        print('')
+        print('Selected cosmology: {}'.format(type(cosmo_module).__name__))
+
+    return cosmo_module
+
+
+class FiducialCosmology:
+    #Fiducial BAO quantities used for the alphas. The fiducial never changes
+    #during a run, so this is built once (CAMB call or table reading) and
+    #the values are stored for the redshift arrays they are requested at.
+    #Arrays are recognized by identity, so they must not be modified in place
+
+    def __init__(self,fiducial,settings):
+
+        if type(fiducial) == str:
+            fidtable = pd.read_csv(fiducial,header=0,sep='\t')
+            self.functions = {'DV_rd': interp1d(fidtable['z'],fidtable['DV_rd']),
+                              'DH_DM': interp1d(fidtable['z'],fidtable['DH_DM'])}
+
+        elif type(fiducial) == dict:
+            from theory_code.expansion_models.standard_cosmology import StandardExpansion
+            fidmodule = StandardExpansion('Standard')
+            fidcosmo  = fidmodule.get_cosmology(deepcopy(fiducial),settings)
+
+            zcalc = get_zgrid(settings)
+            DM = fidcosmo['comoving'](zcalc)
+            DH = 1/(fidcosmo['H_Mpc'](zcalc))
+            DV = (zcalc*DM**2*DH)**(1/3)
+
+            self.functions = {'DV_rd': interp1d(zcalc,DV/fidcosmo['rdrag']),
+                              'DH_DM': interp1d(zcalc,DH/DM)}
+
+        else:
+            sys.exit('Unknown fiducial: {}'.format(fiducial))
+
+        self.stored = {}
+
+    def get(self,name,z):
+
+        key = (name,id(z))
+        if key not in self.stored or self.stored[key][0] is not z:
+            if len(self.stored) > 32:
+                self.stored.clear()
+            self.stored[key] = (z,self.functions[name](z))
+
+        return self.stored[key][1]
+
+
+class TheoryResults:
+    #Results of one point as arrays on the z grid: comoving distance, H (in 1/Mpc),
+    #eta_EM and eta_GW (None means no DDR breaking), rdrag and MB.
+    #All the observables are methods computing the grid values only at the nodes
+    #around the requested redshifts, which are then linearly interpolated.
+    #Nodes and weights depend only on the redshifts, so they are shared by all
+    #the instances and stored for the arrays they are requested at
+    #(recognized by identity as in FiducialCosmology).
+    #Slots and no closures keep each instance small, samplers keep many alive
+
+    __slots__ = ('z','comoving','H','eta_EM','eta_GW','rdrag','MB','fiducial')
+
+    indices = {}
+
+    def __init__(self,z,comoving,H=None,rdrag=None,eta_EM=None,eta_GW=None,MB=None,fiducial=None):
+
+        self.z        = z
+        self.comoving = comoving
+        self.H        = H
+        self.rdrag    = rdrag
+        self.eta_EM   = eta_EM
+        self.eta_GW   = eta_GW
+        self.MB       = MB
+        self.fiducial = fiducial
+
+    @property
+    def nbytes(self):
+
+        return sum([arr.nbytes for arr in [self.comoving,self.H,self.eta_EM,self.eta_GW] if isinstance(arr,np.ndarray)])
+
+    def weights(self,z):
+
+        key = (id(self.z),id(z))
+        stored = TheoryResults.indices.get(key)
+        if stored is None or stored[0] is not self.z or stored[1] is not z:
+            zarr = np.asarray(z,dtype=float)
+            #Same behaviour as interp1d outside the grid
+            if np.any(zarr < self.z[0]) or np.any(zarr > self.z[-1]):
+                raise ValueError('Redshifts outside the theory range ({} - {})'.format(self.z[0],self.z[-1]))
+            if len(TheoryResults.indices) > 32:
+                TheoryResults.indices.clear()
+            idx,w  = interpolation_weights(self.z,zarr)
+            #Both nodes of each redshift, so that the grid values are computed in one go
+            stored = (self.z,z,np.stack([idx,idx+1]),np.stack([1-w,w]))
+            TheoryResults.indices[key] = stored
+
+        return stored[2],stored[3]
+
+    def interpolate(self,grid_values,z):
+
+        nodes,w = self.weights(z)
+        values  = grid_values(nodes)*w
+
+        return values[0]+values[1]
+
+    #Grid values at the nodes idx (any shape)
+    def DM_nodes(self,idx):
+        return self.comoving[idx]
+
+    def DH_nodes(self,idx):
+        return 1/self.H[idx]
+
+    def DV_nodes(self,idx):
+        return (self.z[idx]*self.comoving[idx]**2/self.H[idx])**(1/3)
+
+    def dA_nodes(self,idx):
+        return self.comoving[idx]/(1+self.z[idx])
+
+    def DL_EM_nodes(self,idx):
+        eta = 1. if self.eta_EM is None else self.eta_EM[idx]
+        return eta*(1+self.z[idx])*self.comoving[idx]
+
+    def DL_GW_nodes(self,idx):
+        eta = 1. if self.eta_GW is None else self.eta_GW[idx]
+        return eta*(1+self.z[idx])*self.comoving[idx]
+
+    def mB_nodes(self,idx):
+        #MM: ugly fix to avoid log10(0). To be fixed
+        eps_dL = 1.e-6
+        return 5*np.log10(self.DL_EM_nodes(idx)+eps_dL)+self.MB+25
+
+    #Observables
+    def DM(self,z):
+        return self.interpolate(self.DM_nodes,z)
+
+    def DH(self,z):
+        return self.interpolate(self.DH_nodes,z)
+
+    def DV(self,z):
+        return self.interpolate(self.DV_nodes,z)
+
+    def dA(self,z):
+        return self.interpolate(self.dA_nodes,z)
+
+    def DL_EM(self,z):
+        return self.interpolate(self.DL_EM_nodes,z)
+
+    def DL_GW(self,z):
+        return self.interpolate(self.DL_GW_nodes,z)
+
+    def mB(self,z):
+        return self.interpolate(self.mB_nodes,z)
+
+    def DV_rd(self,z):
+        return self.DV(z)/self.rdrag
+
+    def DM_rd(self,z):
+        return self.DM(z)/self.rdrag
+
+    def DH_rd(self,z):
+        return self.DH(z)/self.rdrag
+
+    def DM_DH(self,z):
+        return self.DM(z)/self.DH(z)
+
+    def alpha_iso(self,z):
+        return (self.DV(z)/self.rdrag)/self.fiducial.get('DV_rd',z)
+
+    def alpha_AP(self,z):
+        return (self.DH(z)/self.DM(z))/self.fiducial.get('DH_DM',z)
+
+
+#What each observable of TheoryCalcs needs besides the comoving distance
+observable_needs = {'DM': [], 'dA': [], 'DM_rd': [],
+                    'DH': ['H'], 'DV': ['H'], 'DV_rd': ['H'], 'DH_rd': ['H'], 'DM_DH': ['H'],
+                    'alpha_iso': ['H','fiducial'], 'alpha_AP': ['H','fiducial'],
+                    'DL_EM': ['DDR'], 'DL_GW': ['DDR'],
+                    'mB': ['DDR','SN']}
+
+
 class TheoryCalcs:
+    #observables selects what is computed (all by default), e.g. a run with GW
+    #only needs DL_GW, so the fiducial cosmology and the magnitudes are skipped.
+    #zcalc can be given (same for all the calls, as in CalcDist), so that the
+    #interpolation weights of TheoryResults are found again
 
-    def __init__(self,settings,cosmosets,SNmodel,fiducial,DDR=None,feedback=False,run_all=True):
+    def __init__(self,settings,cosmosets,SNmodel,fiducial,DDR=None,feedback=False,run_all=True,cosmo_module=None,observables=None,zcalc=None):
 
         self.feedback = feedback
         
-        #############################################
-        #MM: this is a quite involved method to load
-        #all modules contained in the expansion_models folder
-        folder = 'theory_code/expansion_models'
-        imported_classes = self.import_classes_from_folder(folder)
-
-        cosmo_module = []
-        if imported_classes:
-            for class_name, class_obj in imported_classes.items():
-                test = class_obj(cosmosets['cosmology'])
-                if test.used:
-                    cosmo_module.append(test)
-                    if self.feedback:
-                        print('')
-                        print('Selected cosmology: {}'.format(class_name))
-
-        if len(cosmo_module) > 1:
-            sys.exit('Error in importing possible expansion modules (probably same label for multiple modules)')
-        elif len(cosmo_module) == 0:
-            sys.exit('UNKNOWN COSMOLOGY: {}'.format(cosmosets['cosmology']))
-        else:
-            cosmo_module = cosmo_module[0]
-        ##############################################
+        #The expansion modules are imported and instantiated
+        #only once per process (see get_expansion_module)
+        if cosmo_module == None:
+            cosmo_module = get_expansion_module(cosmosets['cosmology'],feedback=self.feedback)
 
         if not run_all:
             self.recognized_params = cosmo_module.recognized_params
@@ -59,7 +384,15 @@ class TheoryCalcs:
         self.zmax      = settings['zmax']
         self.Nz        = settings['Nz']
 
-        self.zcalc = np.linspace(self.zmin,self.zmax,self.Nz)
+        self.zcalc = zcalc if zcalc is not None else get_zgrid(settings)
+
+        if observables == None:
+            observables = list(observable_needs.keys())
+        unknown = [obs for obs in observables if obs not in observable_needs]
+        if unknown != []:
+            sys.exit('Unknown observables: {}'.format(unknown))
+        self.observables = observables
+        self.needs = set(sum([observable_needs[obs] for obs in observables],[]))
 
         ############################
         #Getting baseline cosmology#
@@ -101,19 +434,19 @@ class TheoryCalcs:
         #for dA to be broken as well? It might be needed for some 
         #weird torsion thingy
 
-        if not hasattr(self,'eta_EM') or not hasattr(self,'eta_GW'):
-            if DDR != None:
+        #Keeps track of expansion modules providing their own DDR
+        self.module_DDR = hasattr(self,'eta_EM') and hasattr(self,'eta_GW')
+        self.broken_DDR = self.module_DDR or DDR != None
+
+        if not self.module_DDR:
+            if DDR != None and 'DDR' in self.needs:
                 try:
                     self.eta_EM,self.eta_GW = self.get_parameterized_DDR(DDR)
                 except Exception as e:
                     sys.exit('DDR FAILED!\n {}'.format(e))
             else:
-                self.eta_EM = lambda x: 1.
-                self.eta_GW = lambda x: 1.
-
-        self.dA     = interp1d(self.zcalc,self.comoving(self.zcalc)/(1+self.zcalc))
-        self.DL_EM  = self.get_dL(self.dA,self.eta_EM)
-        self.DL_GW  = self.get_dL(self.dA,self.eta_GW)
+                self.eta_EM = no_breaking
+                self.eta_GW = no_breaking
 
         if true_rdrag != None:
             self.rdrag  = true_rdrag
@@ -127,22 +460,23 @@ class TheoryCalcs:
         ########################
         #Computing SN magnitude#
         ########################
-        self.mB,self.MB = self.get_magnitudes(self.DL_EM,SNmodel)
+        if SNmodel != None and 'SN' in self.needs:
+            self.mB,self.MB = self.get_magnitudes(SNmodel)
 
     def get_comoving_distance(self):
         #MM: WARNING! Curvature to be added!!
 
         integrand = lambda x: 1/self.H_Mpc(x)
-        
-        comov_vec = [quad(integrand,self.zmin,z)[0] for z in self.zcalc]
+
+        #All the grid points are obtained in a single cumulative pass
+        #instead of one quad integration (from zmin) per point
+        comov_vec = cumulative_integral(integrand,self.zcalc)
         comoving = interp1d(self.zcalc,comov_vec)
 
         return comoving
 
     def get_parameterized_DDR(self,DDR):
 
-        from theory_code.DDR_parametrizations import DDRCalcs
-
         if self.feedback:
             print('Computing DDR functions...')
         tini = time()
@@ -158,97 +492,261 @@ class TheoryCalcs:
 
     def get_BAO_observables(self,fiducial):
 
-        self.DM = interp1d(self.zcalc,self.comoving(self.zcalc))
-        self.DH = interp1d(self.zcalc,1/(self.H_Mpc(self.zcalc)))
-        self.DV = interp1d(self.zcalc, (self.zcalc*self.comoving(self.zcalc)**2/self.H_Mpc(self.zcalc))**(1/3))
+        #Everything is stored as grid arrays in a TheoryResults,
+        #the observables below are its methods
+        self.results = TheoryResults(self.zcalc,self.comoving(self.zcalc),rdrag=self.rdrag)
 
-        if type(fiducial) == str:
-            fidtable = pd.read_csv(fiducial,header=0,sep='\t')
-            fidcosmo = {'DV_rd': interp1d(fidtable['z'],fidtable['DV_rd']),
-                        'DH_DM': interp1d(fidtable['z'],fidtable['DH_DM'])}
+        if 'H' in self.needs:
+            self.results.H = self.H_Mpc(self.zcalc)
 
-            self.alpha_iso = lambda x: (self.DV(x)/self.rdrag)/fidcosmo['DV_rd'](x)
-            self.alpha_AP  = lambda x: (self.DH(x)/self.DM(x))/fidcosmo['DH_DM'](x)
-
-        elif type(fiducial) == dict:
-            from theory_code.expansion_models.standard_cosmology import StandardExpansion
-            fidmodule = StandardExpansion('Standard')
-            fidcosmo = fidmodule.get_cosmology(fiducial,self.settings)
-            fidcosmo['DM'] = interp1d(self.zcalc,fidcosmo['comoving'](self.zcalc))
-            fidcosmo['DH'] = interp1d(self.zcalc,1/(fidcosmo['H_Mpc'](self.zcalc)))
-            fidcosmo['DV'] = interp1d(self.zcalc, (self.zcalc*fidcosmo['comoving'](self.zcalc)**2/fidcosmo['H_Mpc'](self.zcalc))**(1/3))
+        if 'DDR' in self.needs and self.broken_DDR:
+            self.results.eta_EM = np.broadcast_to(self.eta_EM(self.zcalc),self.zcalc.shape)
+            self.results.eta_GW = np.broadcast_to(self.eta_GW(self.zcalc),self.zcalc.shape)
 
-            self.alpha_iso = lambda x: (self.DV(x)/self.rdrag)/(fidcosmo['DV'](x)/fidcosmo['rdrag'])
-            self.alpha_AP  = lambda x: (self.DH(x)/self.DM(x))/(fidcosmo['DH'](x)/fidcosmo['DM'](x))
+        #The fiducial is computed here only if it was not done before
+        #(see FiducialCosmology), e.g. when TheoryCalcs is used on its own
+        if 'fiducial' in self.needs:
+            if not isinstance(fiducial,FiducialCosmology):
+                fiducial = FiducialCosmology(fiducial,self.settings)
+            self.results.fiducial = fiducial
 
-        self.DV_rd     = lambda x: self.DV(x)/self.rdrag
-        self.DM_DH     = lambda x: self.DM(x)/self.DH(x)
-        self.DM_rd     = lambda x: self.DM(x)/self.rdrag
-        self.DH_rd     = lambda x: self.DH(x)/self.rdrag
+        for obs in self.observables:
+            if obs != 'mB':
+                setattr(self,obs,getattr(self.results,obs))
 
         return None
 
-    def get_dL(self,dA,eta):
-
-        dL = interp1d(self.zcalc,eta(self.zcalc)*(1+self.zcalc)**2*dA(self.zcalc))
-
-        return dL
-
-    def get_magnitudes(self,dL,MBpars):
+    def get_magnitudes(self,MBpars):
 
         if MBpars['model'] == 'constant':
             MB = lambda x: MBpars['MB']
         else:
             sys.exit('UNKNOWN SN MODEL: {}'.format(MBpars['model']))
 
-        #MM: ugly fix to avoid log10(0). To be fixed
-        eps_dL = 1.e-6
-        mB = interp1d(self.zcalc,5*np.log10(dL(self.zcalc)+eps_dL)+MB(self.zcalc)+25,kind='linear')
+        self.results.MB = MBpars['MB']
 
-        return mB,MB
+        return self.results.mB,MB
 
-    def import_classes_from_folder(self,folder_path):
-        #MM: this was done by Gemini
-        #Thank you, our Lord and Saviour!
-    
-        if not os.path.isdir(folder_path):
-            print(f"Error: Folder '{folder_path}' not found.")
-            return {}
 
-        classes = {}
-        sys.path.insert(0, folder_path)
+def get_background_point(args):
+    #Background of a single point on the zcalc grid, used by BatchTheoryCalcs
+    #for the expansion modules that are not vectorized (e.g. CAMB).
+    #Failures (e.g. CAMB outside its range) give the error message instead,
+    #so that only that point is rejected by BatchTheoryCalcs
 
-        for filename in os.listdir(folder_path):
-            if filename.endswith(".py") and filename != "__init__.py":
-                module_name = filename[:-3]  # Remove .py extension
-                file_path = os.path.join(folder_path, filename)
+    cosmology,params,settings = args
 
-                try:
-                    # Create a module spec
-                    spec = importlib.util.spec_from_file_location(module_name, file_path)
-                    if spec is None:
-                        print(f"Warning: Could not create spec for {file_path}")
-                        continue
-
-                    # Load the module
-                    module = importlib.util.module_from_spec(spec)
-                    sys.modules[module_name] = module
-                    spec.loader.exec_module(module)
-
-                    # Inspect the module for classes
-                    for name, obj in inspect.getmembers(module, inspect.isclass):
-                        # Ensure the class is defined in the current module, not an imported one
-                        if obj.__module__ == module_name:
-                            classes[name] = obj
-                            #print(f"Imported class: {name} from {filename}")
+    cosmo_module  = get_expansion_module(cosmology)
+    try:
+        cosmo_results = cosmo_module.get_cosmology(params,settings)
+    except Exception as e:
+        return str(e)
 
-                except Exception as e:
-                    print(f"Error importing module {filename}: {e}")
+    zcalc = get_zgrid(settings)
+
+    if 'comoving' in cosmo_results:
+        comoving = cosmo_results['comoving'](zcalc)
+    else:
+        comoving = cumulative_integral(lambda x: 1/cosmo_results['H_Mpc'](x),zcalc)
+
+    background = {'H_Mpc': cosmo_results['H_Mpc'](zcalc),
+                  'comoving': comoving}
+    if 'eta_EM' in cosmo_results and 'eta_GW' in cosmo_results:
+        background['eta_EM'] = np.broadcast_to(cosmo_results['eta_EM'](zcalc),zcalc.shape)
+        background['eta_GW'] = np.broadcast_to(cosmo_results['eta_GW'](zcalc),zcalc.shape)
+    for par in cosmo_module.derived_params:
+        background[par] = cosmo_results[par]
+
+    return background
+
+
+class BatchTheoryCalcs:
+    #Same observables as TheoryCalcs for many points at once. points is an
+    #(Npoints x Nparams) array with columns named by param_names, which can
+    #contain the expansion module parameters, the DDR parameters, MB and rd.
+    #Results are (Npoints x Nz) arrays on the zcalc grid (DM, DH, DV, DL_EM,
+    #DL_GW and mB if the magnitudes are requested) and one value per point for
+    #rdrag and the other derived parameters.
+    #Vectorized expansion modules (vectorized = True, e.g. Custom) and the DDR
+    #are computed for all points together, the others point by point
+    #(on a pool of processes if pool > 1, or on a multiprocessing pool passed
+    #as pool, which is then reused). get_result gives the observables at any z
+    #with one row per point, as the Cobaya provider of TheoryCalcs, so that
+    #likelihoods can evaluate all the points together (see samplers/ensemble.py).
+    #Points where the background fails or is not finite are flagged in valid
+    #(with the error in errors) and their rows are NaN
+
+    def __init__(self,settings,cosmology,param_names,points,SNmodel=None,DDR=None,pool=None,fiducial=None,feedback=False):
+
+        self.settings = settings
+        self.zcalc    = get_zgrid(settings)
+        self.fiducial = fiducial
+
+        points  = np.atleast_2d(np.array(points,dtype=float))
+        columns = {par: points[:,i] for i,par in enumerate(param_names)}
+        self.Npoints = points.shape[0]
+
+        cosmo_module = get_expansion_module(cosmology,feedback=feedback)
+        cosmo_params = {par: val for par,val in columns.items() if par in cosmo_module.recognized_params}
+
+        tini = time()
+        if getattr(cosmo_module,'vectorized',False):
+            background = self.get_vectorized_background(cosmo_module,cosmo_params)
+        else:
+            background = self.get_pooled_background(cosmology,cosmo_params,pool)
+        tend = time()
+        if feedback:
+            print('Background of {} points done in {:.2f} s'.format(self.Npoints,tend-tini))
+
+        self.valid  = self.valid & np.all(np.isfinite(background['H_Mpc']),axis=1) & np.all(np.isfinite(background['comoving']),axis=1)
+        if feedback and not np.all(self.valid):
+            print('Background failed for {} of {} points'.format(np.sum(~self.valid),self.Npoints))
+
+        for par in cosmo_module.derived_params:
+            setattr(self,par,np.broadcast_to(background[par],(self.Npoints,)))
+
+        #rd overrides rdrag where it is given (and not 0, as in CalcDist)
+        if 'rd' in columns:
+            self.rdrag = np.where(columns['rd'] != 0.,columns['rd'],self.rdrag)
+
+        ###############
+        #Computing DDR#
+        ###############
+        if 'eta_EM' in background and 'eta_GW' in background:
+            eta_EM,eta_GW = background['eta_EM'],background['eta_GW']
+        elif DDR != None:
+            DDR = deepcopy(DDR)
+            DDR['parameters'] = {par: val[:,None] for par,val in columns.items()}
+            try:
+                ddr_results = DDRCalcs(DDR,self.zcalc)
+                eta_EM = np.broadcast_to(ddr_results.eta_EM(self.zcalc),(self.Npoints,len(self.zcalc)))
+                eta_GW = np.broadcast_to(ddr_results.eta_GW(self.zcalc),(self.Npoints,len(self.zcalc)))
+            except Exception as e:
+                sys.exit('DDR FAILED!\n {}'.format(e))
+        else:
+            eta_EM = 1.
+            eta_GW = 1.
+
+        ##########################
+        #Computing the observables#
+        ##########################
+        self.DM = background['comoving']
+        self.DH = 1/background['H_Mpc']
+        self.DV = (self.zcalc*self.DM**2*self.DH)**(1/3)
+
+        self.dA    = self.DM/(1+self.zcalc)
+        self.DL_EM = eta_EM*(1+self.zcalc)**2*self.dA
+        self.DL_GW = eta_GW*(1+self.zcalc)**2*self.dA
+
+        if 'MB' in columns or SNmodel != None:
+            if 'MB' in columns:
+                MB = columns['MB'][:,None]
+            elif SNmodel['model'] == 'constant':
+                MB = SNmodel['MB']
+            else:
+                sys.exit('UNKNOWN SN MODEL: {}'.format(SNmodel['model']))
+
+            #MM: ugly fix to avoid log10(0). To be fixed
+            eps_dL = 1.e-6
+            self.mB = 5*np.log10(self.DL_EM+eps_dL)+MB+25
+            self.MB = np.broadcast_to(MB,(self.Npoints,1))
+
+    def interpolate(self,node_values,z):
+
+        #As RedshiftTheory.store_products, the observable is computed on the
+        #grid nodes around z (node_values gives one row per point) and then
+        #interpolated, so that ratios and alphas are the same as in Cobaya
+        idx,w = interpolation_weights(self.zcalc,np.asarray(z,dtype=float))
+        nodes  = np.unique(np.concatenate([np.ravel(idx),np.ravel(idx)+1]))
+        pos    = np.searchsorted(nodes,idx)
+        values = node_values(nodes)
+
+        return values[:,pos]*(1-w)+values[:,pos+1]*w
+
+    def get_result(self,name,z=None):
+
+        #Same names as the products of CalcDist, CalcDDR and CalcMagnitude
+        if name in ['DM','DH','DV','dA','DL_EM','DL_GW']:
+            grid = getattr(self,name)
+            return self.interpolate(lambda nodes: grid[:,nodes],z)
+        elif name == 'mB':
+            #From DL_EM at z, as CalcMagnitude
+            eps_dL = 1.e-6
+            return 5*np.log10(self.get_result('DL_EM',z)+eps_dL)+self.MB+25
+        elif name in ['DV_rd','DM_rd','DH_rd']:
+            return self.get_result(name[:2],z)/self.rdrag[:,None]
+        elif name == 'DM_DH':
+            return self.interpolate(lambda nodes: self.DM[:,nodes]/self.DH[:,nodes],z)
+        elif name == 'alpha_iso':
+            return self.interpolate(lambda nodes: (self.DV[:,nodes]/self.rdrag[:,None])/self.fiducial.get('DV_rd',self.zcalc[nodes]),z)
+        elif name == 'alpha_AP':
+            return self.interpolate(lambda nodes: (self.DH[:,nodes]/self.DM[:,nodes])/self.fiducial.get('DH_DM',self.zcalc[nodes]),z)
+        elif name == 'abs_mag':
+            return np.broadcast_to(self.MB,(self.Npoints,len(z)))
+        elif name == 'rdrag':
+            return self.rdrag
+        else:
+            sys.exit('Unknown observable: {}'.format(name))
+
+    def get_vectorized_background(self,cosmo_module,cosmo_params):
+
+        #Parameters as columns, so that the functions of the module
+        #return one row per point
+        params = {par: val[:,None] for par,val in cosmo_params.items()}
+        try:
+            cosmo_results = cosmo_module.get_cosmology(params,self.settings)
+        except Exception as e:
+            #Some point of the batch makes the module fail,
+            #so the points are computed one by one to find it
+            return self.get_pooled_background(cosmo_module.label,cosmo_params,None)
+
+        if 'comoving' in cosmo_results:
+            comoving = cosmo_results['comoving'](self.zcalc)
+        else:
+            comoving = cumulative_integral(lambda x: 1/cosmo_results['H_Mpc'](x),self.zcalc)
+
+        background = {'H_Mpc': np.broadcast_to(cosmo_results['H_Mpc'](self.zcalc),(self.Npoints,len(self.zcalc))),
+                      'comoving': np.broadcast_to(comoving,(self.Npoints,len(self.zcalc)))}
+        if 'eta_EM' in cosmo_results and 'eta_GW' in cosmo_results:
+            background['eta_EM'] = np.broadcast_to(cosmo_results['eta_EM'](self.zcalc),(self.Npoints,len(self.zcalc)))
+            background['eta_GW'] = np.broadcast_to(cosmo_results['eta_GW'](self.zcalc),(self.Npoints,len(self.zcalc)))
+        for par in cosmo_module.derived_params:
+            background[par] = np.ravel(cosmo_results[par])
+
+        self.valid  = np.ones(self.Npoints,dtype=bool)
+        self.errors = {}
+
+        return background
+
+    def get_pooled_background(self,cosmology,cosmo_params,pool):
+
+        args = [(cosmology,{par: float(val[i]) for par,val in cosmo_params.items()},self.settings) for i in range(self.Npoints)]
+
+        try:
+            if hasattr(pool,'map'):
+                results = pool.map(get_background_point,args)
+            elif pool != None and pool > 1:
+                import multiprocessing
+                with multiprocessing.get_context('fork').Pool(pool) as workers:
+                    results = workers.map(get_background_point,args,chunksize=max(1,self.Npoints//(4*pool)))
+            else:
+                results = [get_background_point(arg) for arg in args]
+        except Exception as e:
+            sys.exit('COSMOLOGY CALCULATIONS FAILED!!\n {}'.format(e))
+
+        #Failed points (error message instead of the background) are NaN
+        self.valid  = np.array([type(res) == dict for res in results])
+        self.errors = {i: res for i,res in enumerate(results) if type(res) != dict}
+        if np.any(self.valid):
+            template = results[np.argmax(self.valid)]
+        else:
+            template = {'H_Mpc': self.zcalc,'comoving': self.zcalc}
+        failed = {k: np.full(np.shape(val),np.nan) for k,val in template.items()}
+        results = [res if type(res) == dict else failed for res in results]
 
-        # Clean up sys.path
-        if folder_path in sys.path:
-            sys.path.remove(folder_path)
+        background = {k: np.array([res[k] for res in results]) for k in template}
+        for par in get_expansion_module(cosmology).derived_params:
+            if par not in background:
+                background[par] = np.full(self.Npoints,np.nan)
 
-        return classes
-    
-    
+        return background
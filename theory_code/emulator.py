@@ -0,0 +1,376 @@
+import sys,os
+import argparse
+import inspect
+
+import numpy  as np
+
+from bios import read
+from copy import deepcopy
+from time import time
+
+from scipy.linalg   import cho_factor,cho_solve
+from scipy.optimize import minimize
+from scipy.stats    import qmc
+
+from theory_code.distance_theory import get_zgrid,get_grid_key
+
+
+#Inputs of the emulator, computed from the expansion module parameters.
+#The log of the total matter fraction and of h make H/H0 and H0*D_M
+#smooth functions over wide priors (e.g. 0.001 < omegam < 0.99, 20 < H0 < 100)
+feature_names = ['log_omegam','ombh2','log_h','omk','w','wa','omnuh2','nnu']
+
+def get_features(params):
+
+    full = {'omk': 0., 'w': -1., 'wa': 0., 'omnuh2': 0., 'nnu': 3.044}
+    full.update(params)
+    h = full['H0']/100
+
+    return np.array([np.log((full['omch2']+full['ombh2']+full['omnuh2'])/h**2),
+                     full['ombh2'],
+                     np.log(h),
+                     full['omk'],
+                     full['w'],
+                     full['wa'],
+                     full['omnuh2'],
+                     full['nnu']])
+
+def rbf_kernel(x1,x2,lengths,amplitude):
+
+    #lengths can have a leading axis, one set for each output
+    return amplitude*np.exp(-0.5*np.sum(((x1[:,None,:]-x2[None,:,:])/lengths[...,None,None,:])**2,axis=-1))
+
+
+class BackgroundEmulator:
+    #Emulator of the StandardExpansion background (H(z), comoving distance
+    #on the zcalc grid, rdrag and omegaL). log(H/H0) and log(H0*D_M) are
+    #compressed with PCA and each component, as well as the scalars, is
+    #interpolated with a Gaussian process with an RBF kernel.
+    #Trained with python -m theory_code.emulator (see main below)
+
+    def __init__(self,filename):
+
+        stored = np.load(filename,allow_pickle=False)
+
+        self.params   = list(stored['params'])
+        self.fixed    = dict(zip(stored['fixed_names'],stored['fixed_values']))
+        self.features = stored['features']
+        self.feature_values = stored['feature_values']
+        #Emulators trained before the grid spacing option are on a linear grid
+        self.grid_settings = {'zmin': float(stored['grid'][0]),
+                              'zmax': float(stored['grid'][1]),
+                              'Nz': int(stored['grid'][2]),
+                              'spacing': str(stored['spacing']) if 'spacing' in stored.files else 'linear',
+                              'zscale': float(stored['zscale']) if 'zscale' in stored.files else 0.001}
+        self.grid     = get_grid_key(self.grid_settings)
+        self.version  = str(stored['version'])
+        self.xmin     = stored['xmin']
+        self.xmax     = stored['xmax']
+        self.xtrain   = stored['xtrain']
+        self.zcalc    = get_zgrid(self.grid_settings)
+
+        self.outputs = {}
+        for out in ['H_Mpc','comoving','rdrag','omegaL']:
+            self.outputs[out] = {k: stored[out+'_'+k] for k in ['mean','components','scale','alpha','lengths','amplitude']}
+
+        #Points outside the convex hull of the training set go to CAMB.
+        #If the hull cannot be built (e.g. degenerate inputs) the box is used
+        try:
+            from scipy.spatial import Delaunay
+            self.hull = Delaunay(self.xtrain)
+        except Exception:
+            self.hull = None
+
+    def get_inputs(self,params):
+
+        x = get_features(params)[self.features]
+
+        return (x-self.xmin)/(self.xmax-self.xmin)
+
+    def get_params(self,x):
+
+        #Expansion module parameters of a point of the (normalized) inputs,
+        #used to validate the emulator against CAMB
+        features = dict(zip(feature_names,self.feature_values))
+        for i,val in zip(self.features,self.xmin+x*(self.xmax-self.xmin)):
+            features[feature_names[i]] = val
+
+        params = {par: float(features[par]) for par in ['ombh2','omk','w','wa','omnuh2','nnu'] if par in self.params}
+        h = np.exp(features['log_h'])
+        params['H0']    = 100*h
+        params['omch2'] = np.exp(features['log_omegam'])*h**2-features['ombh2']-features['omnuh2']
+
+        return params
+
+    def covers(self,params,settings):
+
+        #Same grid, same fixed parameters and inside the training hull
+        if get_grid_key(settings) != self.grid:
+            return False
+        if set(params.keys()) != set(self.params):
+            return False
+        if any([params[par] != val for par,val in self.fixed.items()]):
+            return False
+
+        x = self.get_inputs(params)
+        if np.any(x < 0) or np.any(x > 1):
+            return False
+        if self.hull != None and self.hull.find_simplex(x) < 0:
+            return False
+
+        return True
+
+    def predict(self,params):
+
+        x = self.get_inputs(params)
+
+        results = {}
+        for out,gp in self.outputs.items():
+            k = rbf_kernel(x[None,:],self.xtrain,gp['lengths'],gp['amplitude'][:,:,None])[:,0,:]
+            coeffs = np.sum(k*gp['alpha'],axis=1)*gp['scale']
+            results[out] = gp['mean']+np.dot(coeffs,gp['components'])
+
+        logH0  = np.log(params['H0'])
+        stored = {'z': self.zcalc,
+                  'H_Mpc': np.exp(results['H_Mpc']+logH0),
+                  'comoving': np.exp(results['comoving']-logH0),
+                  'rdrag': np.exp(results['rdrag'][0]),
+                  'omegaL': results['omegaL'][0]}
+        stored['H_kmsMpc'] = stored['H_Mpc']*299792.458
+
+        return stored
+
+
+def get_training_box(settings_file,nsigma=5.):
+
+    #Sampled parameters of the settings file, with their prior range,
+    #and the recipe to get the expansion module parameters from them
+    info = read(settings_file)
+
+    sampled = {}
+    fixed   = {}
+    derived = {}
+    for par,val in info['params'].items():
+        if type(val) == dict and 'prior' in val:
+            prior = val['prior']
+            if 'dist' in prior and prior['dist'] == 'norm':
+                sampled[par] = [prior['loc']-nsigma*prior['scale'],prior['loc']+nsigma*prior['scale']]
+            else:
+                sampled[par] = [prior['min'],prior['max']]
+        elif type(val) == dict and 'value' in val:
+            derived[par] = eval(val['value'])
+        elif type(val) != dict:
+            fixed[par] = val
+
+    return sampled,fixed,derived
+
+def get_module_params(point,fixed,derived,module):
+
+    values = deepcopy(fixed)
+    values.update(point)
+    for par,func in derived.items():
+        args = inspect.signature(func).parameters.keys()
+        values[par] = func(*[values[a] for a in args])
+
+    return {par: float(values[par]) for par in module.recognized_params if par in values}
+
+def camb_point(args):
+
+    #Background of one training point, None if CAMB fails
+    params,settings = args
+
+    import camb
+
+    zcalc = get_zgrid(settings)
+    try:
+        results = camb.get_background(camb.set_params(**params))
+        return {'H_Mpc': np.log(results.h_of_z(zcalc)),
+                'comoving': np.log(results.comoving_radial_distance(zcalc)),
+                'rdrag': np.log([results.get_derived_params()['rdrag']]),
+                'omegaL': np.array([results.get_Omega('de',z=0)])}
+    except Exception:
+        return None
+
+def gp_nll(logpars,x,y,dist2):
+
+    #Negative log marginal likelihood of an RBF Gaussian process and its
+    #gradient with respect to the log of the hyperparameters.
+    #dist2 are the squared distances between training points, one per input
+    lengths   = np.exp(logpars[:-2])
+    amplitude = np.exp(logpars[-2])
+    noise     = np.exp(logpars[-1])
+
+    E = np.exp(-0.5*np.sum(dist2/lengths**2,axis=-1))
+    K = amplitude*E+(noise+1.e-10)*np.eye(len(x))
+    try:
+        L = cho_factor(K,lower=True)
+    except np.linalg.LinAlgError:
+        return 1.e25,np.zeros(len(logpars))
+    alpha = cho_solve(L,y)
+
+    nll = 0.5*np.dot(y,alpha)+np.sum(np.log(np.diag(L[0])))
+
+    W    = cho_solve(L,np.eye(len(x)))-np.outer(alpha,alpha)
+    AE   = amplitude*E
+    grad = [0.5*np.sum(W*AE*dist2[:,:,j])/lengths[j]**2 for j in range(len(lengths))]
+    grad.append(0.5*np.sum(W*AE))
+    grad.append(0.5*noise*np.trace(W))
+
+    return nll,np.array(grad)
+
+def train_gp(x,y):
+
+    dist2  = (x[:,None,:]-x[None,:,:])**2
+    start  = np.concatenate([np.log(0.3*np.ones(x.shape[1])),[0.,np.log(1.e-8)]])
+    bounds = [(np.log(1.e-2),np.log(1.e2))]*x.shape[1]+[(np.log(1.e-3),np.log(1.e3)),(np.log(1.e-12),np.log(1.e-2))]
+    best   = minimize(gp_nll,start,args=(x,y,dist2),jac=True,method='L-BFGS-B',bounds=bounds)
+
+    lengths   = np.exp(best.x[:-2])
+    amplitude = np.exp(best.x[-2])
+    noise     = np.exp(best.x[-1])
+
+    K = rbf_kernel(x,x,lengths,amplitude)+(noise+1.e-10)*np.eye(len(x))
+    alpha = cho_solve(cho_factor(K,lower=True),y)
+
+    return lengths,amplitude,alpha
+
+def train_output(x,y,pca_tol):
+
+    #PCA of the training arrays, keeping the components needed to
+    #reconstruct them within pca_tol, then one GP per component
+    mean = np.mean(y,axis=0)
+    if y.shape[1] > 1:
+        u,s,vt = np.linalg.svd(y-mean,full_matrices=False)
+        for ncomp in range(1,len(s)+1):
+            recon = mean+np.dot(np.dot(y-mean,vt[:ncomp].T),vt[:ncomp])
+            if np.max(np.abs(recon-y)) < pca_tol:
+                break
+        components = vt[:ncomp]
+    else:
+        components = np.ones((1,1))
+
+    coeffs = np.dot(y-mean,components.T)
+    scale  = np.std(coeffs,axis=0)+1.e-30
+
+    lengths,amplitude,alpha = [],[],[]
+    for i in range(components.shape[0]):
+        l,a,al = train_gp(x,coeffs[:,i]/scale[i])
+        lengths.append(l)
+        amplitude.append(a)
+        alpha.append(al)
+
+    return {'mean': mean,
+            'components': components,
+            'scale': scale,
+            'alpha': np.array(alpha),
+            'lengths': np.array(lengths),
+            'amplitude': np.array(amplitude)[:,None]}
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Train the StandardExpansion emulator on the prior box of a settings file')
+    parser.add_argument('settings',help='settings YAML file (e.g. settings/standard/DESI.yaml)')
+    parser.add_argument('output',help='emulator file (.npz), theory_emulator: path in the settings')
+    parser.add_argument('--ntrain',type=int,default=400,help='number of training points')
+    parser.add_argument('--ntest',type=int,default=100,help='number of validation points')
+    parser.add_argument('--pool',type=int,default=1,help='number of processes running CAMB')
+    parser.add_argument('--nsigma',type=float,default=5.,help='range of Gaussian priors in standard deviations')
+    parser.add_argument('--pca-tol',type=float,default=1.e-5,help='maximum PCA reconstruction error (in log)')
+    parser.add_argument('--threshold',type=float,default=1.,help='maximum emulator error in percent (as in testing/run_test.py)')
+    args = parser.parse_args()
+
+    import camb
+    from theory_code.expansion_models.standard_cosmology import StandardExpansion
+
+    module   = StandardExpansion('Standard')
+    settings = read('theory_code/basic_parameters.yaml')['settings']
+
+    sampled,fixed,derived = get_training_box(args.settings,nsigma=args.nsigma)
+    print('Sampled parameters: {}'.format(sampled))
+
+    lower = np.array([v[0] for v in sampled.values()])
+    upper = np.array([v[1] for v in sampled.values()])
+    draws = qmc.scale(qmc.LatinHypercube(d=len(sampled),seed=0).random(args.ntrain+args.ntest),lower,upper)
+    points = [get_module_params(dict(zip(sampled.keys(),d)),fixed,derived,module) for d in draws]
+
+    print('Running CAMB on {} points with {} process(es)'.format(len(points),args.pool))
+    tini = time()
+    if args.pool > 1:
+        import multiprocessing
+        with multiprocessing.get_context('fork').Pool(args.pool) as pool:
+            results = pool.map(camb_point,[(p,settings) for p in points])
+    else:
+        results = [camb_point((p,settings)) for p in points]
+    print('Done in {:.1f} s'.format(time()-tini))
+
+    #Points where CAMB fails (e.g. negative omch2) are not used
+    good   = [i for i,r in enumerate(results) if r != None and np.all(np.isfinite(r['comoving']))]
+    print('Failed CAMB points: {}'.format(len(points)-len(good)))
+    ntrain = len([i for i in good if i < args.ntrain])
+
+    #Inputs are the features that change over the training set, the
+    #parameters that never change must have the same value at run time
+    features = np.array([get_features(points[i]) for i in good])
+    varying  = np.where(np.ptp(features[:ntrain],axis=0) > 0)[0]
+    fixed_names = [par for par in points[0] if np.ptp([points[i][par] for i in good]) == 0]
+    print('Emulator inputs: {}'.format([feature_names[i] for i in varying]))
+
+    x = features[:,varying]
+    xmin,xmax = x[:ntrain].min(axis=0),x[:ntrain].max(axis=0)
+    x = (x-xmin)/(xmax-xmin)
+
+    tosave = {'params': np.array(list(points[0].keys())),
+              'fixed_names': np.array(fixed_names),
+              'fixed_values': np.array([points[0][par] for par in fixed_names]),
+              'features': varying,
+              'feature_values': features[0],
+              'grid': np.array([settings['zmin'],settings['zmax'],settings['Nz']]),
+              'spacing': settings.get('spacing','linear'),
+              'zscale': settings.get('zscale',0.001),
+              'version': camb.__version__,
+              'xmin': xmin,
+              'xmax': xmax,
+              'xtrain': x[:ntrain]}
+
+    logH0 = np.log([points[i]['H0'] for i in good])[:,None]
+    targets = {'H_Mpc': np.array([results[i]['H_Mpc'] for i in good])-logH0,
+               'comoving': np.array([results[i]['comoving'] for i in good])+logH0,
+               'rdrag': np.array([results[i]['rdrag'] for i in good]),
+               'omegaL': np.array([results[i]['omegaL'] for i in good])}
+
+    tini = time()
+    for out,y in targets.items():
+        gp = train_output(x[:ntrain],y[:ntrain],args.pca_tol)
+        print('{}: {} PCA component(s)'.format(out,gp['components'].shape[0]))
+        for k,v in gp.items():
+            tosave[out+'_'+k] = v
+    print('Trained in {:.1f} s'.format(time()-tini))
+
+    np.savez(args.output,**tosave)
+
+    #Validation on the points not used for the training
+    emulator = BackgroundEmulator(args.output)
+    maxdiff  = {'H_Mpc': 0., 'comoving': 0., 'rdrag': 0., 'omegaL': 0.}
+    ntest    = 0
+    for i in good[ntrain:]:
+        if not emulator.covers(points[i],settings):
+            continue
+        ntest += 1
+        pred = emulator.predict(points[i])
+        for out in maxdiff:
+            truth = results[i][out] if out == 'omegaL' else np.exp(results[i][out])
+            maxdiff[out] = max(maxdiff[out],np.max(np.abs(pred[out]/truth-1)))
+
+    print('Validation on {} points inside the training hull'.format(ntest))
+    if ntest == 0:
+        print('\033[1;31m'+'No validation points inside the training hull, increase --ntest'+'\033[0m')
+        return
+    for out,diff in maxdiff.items():
+        if 100*diff < args.threshold:
+            print('\033[0;32m'+'Emulator {} within {}% (max relative difference {:.1e})'.format(out,args.threshold,diff)+'\033[0m')
+        else:
+            print('\033[1;31m'+'Emulator {} above {}% (max relative difference {:.1e})'.format(out,args.threshold,diff)+'\033[0m')
+
+
+if __name__ == '__main__':
+    main()
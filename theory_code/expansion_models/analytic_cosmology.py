@@ -0,0 +1,207 @@
+import sys,os
+
+import numpy  as np
+
+from math      import prod
+from itertools import combinations_with_replacement
+
+from scipy.interpolate import interp1d
+from scipy.integrate   import trapezoid
+
+from theory_code.distance_theory import cumulative_integral,get_zgrid,get_grid_key
+
+clight = 299792.458
+
+#Same conventions as CAMB: CMB temperature, photon density
+#and N_eff of the three standard neutrinos
+TCMB       = 2.7255
+omgh2      = 4.48162687719e-7*TCMB**4
+nu_factor  = 7./8.*(4./11.)**(4./3.)
+standard_neff = 3.044
+
+#Coefficients of the log of the correction to the rdrag integral on the
+#terms of get_rdrag_features (orders 0 to 3), fitted on 120 CAMB points
+#by fit_rdrag_calibration in testing/testing_functions.py.
+#Residuals are below 0.003% for 0.019 < ombh2 < 0.025,
+#0.08 < omch2 < 0.16, 2.8 < nnu < 3.6, any w0, wa and omk
+rdrag_calibration = np.array([
+                              -0.024516242500809648,
+                              0.0046065820655707525,0.002864914247613735,-0.000923681566875747,5.332519857306504e-05,
+                              -0.007657240170048381,0.00028556679146730024,0.00014509444616487627,-0.0001284974420892298,-0.0011243772496778868,
+                              0.0003575998741897105,-1.4339645141797095e-05,3.177734706058418e-05,2.0662309862434756e-07,-1.3998081224013595e-06,
+                              -0.005044579619473068,0.0009313237935337278,-0.00010758974642394753,3.4735451963988398e-06,-3.425598460861376e-05,
+                              -9.53199227579792e-05,1.2887507536983853e-05,-1.9869791730385766e-05,-4.0316667683996693e-07,-1.4292456778011015e-06,
+                              -8.728385615738317e-05,-4.37998737932905e-05,-3.190444207537244e-05,-2.2857485976700717e-05,1.0386426785676376e-06,
+                              -4.00130753291039e-07,-1.1053125802403127e-06,-2.786161029348549e-07,1.0437547937567033e-07,1.2905566380045533e-07])
+
+
+class AnalyticExpansion:
+    #CAMB-free background for LCDM, wCDM and w0waCDM with curvature.
+    #Same parameters as the Standard (CAMB) module, so that settings
+    #can switch between the two by changing the cosmology label only.
+    #Massive neutrinos follow CAMB (one massive eigenstate carrying
+    #standard_neff/3, the rest massless) with the exact Fermi-Dirac
+    #energy density. rdrag is the sound horizon at the fitted drag redshift,
+    #with a correction calibrated on CAMB (see rdrag_calibration).
+    #Checked against CAMB by test_analytic_expansion in testing/testing_functions.py
+
+    def __init__(self,call_name):
+
+        self.label = 'Analytic'
+
+        self.recognized_params = {'H0': None,
+                                  'omch2': None,
+                                  'ombh2': None,
+                                  'omk': None,
+                                  'w': None,
+                                  'wa': None,
+                                  'omnuh2': None,
+                                  'nnu': None}
+
+        self.derived_params = ['rdrag','omegaL']
+
+        #Correction to the rdrag integral, see rdrag_calibration
+        self.rdrag_terms = [comb for order in range(4) for comb in combinations_with_replacement(range(4),order)]
+        self.rdrag_nodes,self.rdrag_weights = np.polynomial.legendre.leggauss(64)
+
+        if call_name == self.label:
+            self.used = True
+            self.get_neutrino_table()
+
+        else:
+            self.used = False
+
+
+    def get_neutrino_table(self):
+
+        #Energy density of a massive neutrino relative to a massless one,
+        #as a function of y = m/T_nu. Tabulated once in log-log
+        x = np.linspace(0.,60.,6001)[1:]
+        y = np.logspace(-3,5,401)
+
+        massless = trapezoid(x**3/(np.exp(x)+1),x)
+        massive  = trapezoid(x[None,:]**2*np.sqrt(x[None,:]**2+y[:,None]**2)/(np.exp(x[None,:])+1),x,axis=1)
+
+        self.log_y   = np.log(y)
+        self.log_rho = np.log(massive/massless)
+
+    def neutrino_density(self,y):
+
+        #Below the table the neutrino is relativistic, above it is
+        #non-relativistic and the density grows linearly with y
+        log_y = np.log(np.maximum(y,np.exp(self.log_y[0])))
+        slope = np.where(log_y > self.log_y[-1],log_y-self.log_y[-1],0.)
+
+        return np.exp(np.interp(log_y,self.log_y,self.log_rho)+slope)
+
+    def get_densities(self,params):
+
+        h = params['H0']/100
+
+        #Neutrinos split as in CAMB
+        if params['omnuh2'] > 0:
+            massive_deg  = standard_neff/3
+            massless_deg = params['nnu']-massive_deg
+            #m/T_nu today from the present density
+            target = params['omnuh2']/(massive_deg*nu_factor*omgh2)
+            y0 = np.exp(np.interp(np.log(target),self.log_rho,self.log_y))
+            if target > np.exp(self.log_rho[-1]):
+                y0 = np.exp(self.log_y[-1])*target/np.exp(self.log_rho[-1])
+        else:
+            massive_deg  = 0.
+            massless_deg = params['nnu']
+            y0 = 0.
+
+        dens = {'m': (params['omch2']+params['ombh2'])/h**2,
+                'r': omgh2*(1+massless_deg*nu_factor)/h**2,
+                'nu': massive_deg*nu_factor*omgh2/h**2,
+                'y0': y0,
+                'k': params['omk']}
+        dens['de'] = 1-dens['k']-dens['m']-dens['r']-dens['nu']*self.neutrino_density(y0)
+
+        return dens
+
+    def get_E(self,z,dens,w,wa):
+
+        ia = 1+z
+        a  = 1/ia
+
+        #Powers and exponentials only when needed, LCDM is the common case
+        if wa != 0:
+            rho_de = a**(-3*(1+w+wa))*np.exp(-3*wa*(1-a))
+        elif w != -1:
+            rho_de = a**(-3*(1+w))
+        else:
+            rho_de = 1.
+        rad = dens['r']
+        if dens['y0'] > 0:
+            rad = rad+dens['nu']*self.neutrino_density(dens['y0']*a)
+
+        E2 = ((rad*ia+dens['m'])*ia+dens['k'])*ia**2+dens['de']*rho_de
+
+        return np.sqrt(E2)
+
+    def get_rdrag(self,params,dens):
+
+        #Sound horizon integral with the full H(z) (dark energy and
+        #curvature included), up to the Eisenstein & Hu (1998) drag redshift
+        omm = params['omch2']+params['ombh2']+params['omnuh2']
+        b1  = 0.313*omm**(-0.419)*(1+0.607*omm**0.674)
+        b2  = 0.238*omm**0.223
+        zdrag = 1291*omm**0.251/(1+0.659*omm**0.828)*(1+b1*params['ombh2']**b2)
+
+        adrag = 1/(1+zdrag)
+        a  = 0.5*adrag*(self.rdrag_nodes+1)
+        Ha = params['H0']*self.get_E(1/a-1,dens,params['w'],params['wa'])
+        cs = clight/np.sqrt(3*(1+3*params['ombh2']/(4*omgh2)*a))
+
+        return 0.5*adrag*np.sum(self.rdrag_weights*cs/(a**2*Ha))
+
+    def get_rdrag_features(self,params):
+
+        #Third order polynomial around Planck in the variables below,
+        #used for the log of the correction to the sound horizon integral
+        x = [np.log((params['omch2']+params['ombh2'])/0.14237),
+             np.log(params['ombh2']/0.02237),
+             params['nnu']-standard_neff,
+             params['omnuh2']/0.001]
+
+        return np.array([prod([x[i] for i in comb]) for comb in self.rdrag_terms])
+
+    def get_cosmology(self,params,settings):
+
+        #Grid built again only if the settings change
+        if get_grid_key(settings) != getattr(self,'grid',None):
+            self.zmin      = settings['zmin']
+            self.zmax      = settings['zmax']
+            self.Nz        = settings['Nz']
+            self.grid      = get_grid_key(settings)
+
+            self.zcalc = get_zgrid(settings)
+            self.zint  = np.concatenate([[0.],self.zcalc])
+
+        unknown = [par for par in params.keys() if par not in self.recognized_params]
+
+        if unknown != []:
+            sys.exit('Error in {} cosmology code!\n Unknown parameters: {}'.format(self.label,unknown))
+
+        #Same defaults as camb.set_params (mnu = 0.06 eV)
+        pars = {'omk': 0., 'w': -1., 'wa': 0., 'omnuh2': 0.000644899, 'nnu': standard_neff}
+        pars.update(params)
+
+        dens = self.get_densities(pars)
+        H0   = pars['H0']
+        w,wa = pars['w'],pars['wa']
+
+        Hz = lambda x: H0*self.get_E(x,dens,w,wa)
+
+        #Comoving distance from z=0 on the zcalc grid
+        comoving = cumulative_integral(lambda x: clight/Hz(x),self.zint)[1:]
+
+        theory = {'H_Mpc': lambda x: Hz(x)/clight,
+                  'H_kmsMpc': Hz,
+                  'comoving': interp1d(self.zcalc,comoving),
+                  'rdrag': self.get_rdrag(pars,dens)*np.exp(np.dot(rdrag_calibration,self.get_rdrag_features(pars))),
+                  'omegaL': dens['de']}
+
+        return theory
@@ -6,6 +6,9 @@ import pandas as pd
 from scipy.interpolate import interp1d
 from scipy.integrate   import trapezoid
 
+from theory_code.distance_theory import get_zgrid
+from theory_code.DDR_parametrizations import no_breaking
+
 clight = 299792.458
 
 class CustomExpansion:
@@ -25,6 +28,10 @@ class CustomExpansion:
 
         self.derived_params = ['rdrag','omegaL','Xi']
 
+        #get_cosmology also works with arrays of parameters with shape
+        #(Npoints,1), functions then return one row per point (see BatchTheoryCalcs)
+        self.vectorized = True
+
         if call_name == self.label:
             self.used = True
 
@@ -38,7 +45,7 @@ class CustomExpansion:
         self.zmax      = settings['zmax']
         self.Nz        = settings['Nz']
 
-        self.zcalc = np.linspace(self.zmin,self.zmax,self.Nz)
+        self.zcalc = get_zgrid(settings)
 
         unknown = [par for par in params.keys() if par not in self.recognized_params]
 
@@ -73,7 +80,7 @@ class CustomExpansion:
         if 'Gamma' in params:        
             eta_EM = interp1d(self.zcalc,1+params['Gamma']*Om)
         else:
-            eta_EM = lambda x: 1.
-        eta_GW = lambda x: 1.
+            eta_EM = no_breaking
+        eta_GW = no_breaking
 
         return eta_EM, eta_GW
@@ -0,0 +1,268 @@
+import sys,os
+
+import numpy  as np
+
+from time import time
+
+from scipy.interpolate import interp1d,CubicSpline
+from scipy.integrate   import odeint,solve_ivp
+
+from theory_code.distance_theory import get_zgrid,get_grid_key
+
+clight = 299792.458
+
+#Same conventions as the Analytic module
+TCMB       = 2.7255
+omgh2      = 4.48162687719e-7*TCMB**4
+nu_factor  = 7./8.*(4./11.)**(4./3.)
+standard_neff = 3.044
+
+
+class ODEExpansion:
+    #Base class for backgrounds that need an ODE, e.g. interacting or
+    #decaying dark matter. Subclasses set label, recognized_params and
+    #derived_params as the other modules, and provide
+    # - get_initial_conditions(params): (lna_ini, y_ini) for their variables
+    # - get_hubble(lna,y,params): H(lna) in km/s/Mpc, vectorized, y has shape (Nvar,k)
+    # - get_rhs(lna,y,H,params): dy/dlna, same shapes, with H from get_hubble
+    #Only Radau and BDF call these with k>1 (for their Jacobians), LSODA calls
+    #them point by point with y of shape (Nvar,) a few hundred times per
+    #integration, so they should avoid np.vstack and the like
+    # - get_derived(lna,y,params): rdrag and the derived parameters
+    #and optionally update_params(params,y_today), used to fix a parameter
+    #at z=0 (e.g. omega_Lambda from H0) by iterating the integration.
+    #H and distances come from the same integration in ln(a): H from its
+    #output on the fixed z grid, the comoving distance from the integral
+    #of a cubic spline of c/H through it, starting at z=0. Integrating it as
+    #one more variable would give it from z_ini instead, and distances at
+    #low z would lose digits in the difference. Solver calls and timing are
+    #collected in self.stats and printed by get_report (at the end of the
+    #runs by the samplers)
+
+    #LSODA switches to a stiff method when needed, Radau and BDF also work
+    #(see scipy.integrate.solve_ivp). On the DCDM module below, for the same
+    #accuracy, LSODA needs about 10 times less time than Radau or BDF.
+    #With these tolerances H and the distances of DCDM are within 1e-6 of a
+    #Radau integration with rtol=1e-11 (see test_ode_expansion), and a point
+    #takes about 3 ms (3 integrations) on a grid of 1000 redshifts
+    method         = 'LSODA'
+    rtol           = 1.e-7
+    atol           = 1.e-10
+    max_iterations = 20
+    #Relative change of the parameters that stops the update_params iterations
+    closure_tol    = 1.e-7
+    #Redshift above which the parameters fixed at z=0 do not change the
+    #solution (e.g. omega_Lambda is 1e-6 of the matter at z=100), so that the
+    #update_params iterations restart from there (or from zmax if higher).
+    #None starts all the iterations from the initial conditions
+    z_restart      = 100.
+
+    label = None
+
+    def __init__(self,call_name):
+
+        self.recognized_params = {}
+        self.derived_params    = []
+
+        self.used = call_name != None and call_name == self.label
+        self.reset_stats()
+
+    def reset_stats(self):
+
+        self.stats = {'points': 0, 'integrations': 0, 'nfev': 0, 'njev': 0, 'time': 0.}
+
+    def get_report(self,stats=None):
+
+        #Statistics of this process, or those given (e.g. added up over the
+        #processes of a run, see print_run_stats in cobaya_theory_wrapper.py)
+        stats  = self.stats if stats == None else stats
+        points = max(stats['points'],1)
+        return '{} ODE background: {} points, {:.2f} integrations, {:.1f} RHS calls, {:.1f} Jacobians and {:.2f} ms per point'.format(self.label,
+                                                                                                                                   stats['points'],
+                                                                                                                                   stats['integrations']/points,
+                                                                                                                                   stats['nfev']/points,
+                                                                                                                                   stats['njev']/points,
+                                                                                                                                   1.e3*stats['time']/points)
+
+    def update_params(self,params,y_today):
+
+        #Nothing to fix at z=0 by default
+        return params
+
+    def integrate(self,params,lna_start,y_start):
+
+        #Solution at the points of lna_out after lna_start, shape (Nvar,k)
+        lna_out = self.lna_out[self.lna_out > lna_start]
+
+        def rhs(lna,y):
+            return self.get_rhs(lna,y,self.get_hubble(lna,y,params),params)
+
+        if self.method == 'LSODA':
+            #Same solver as solve_ivp, without its Python layer at every
+            #step (4 times faster here). LSODA interpolates its solution
+            #at the output points, it does not stop there, and tcrit keeps
+            #it from stepping beyond z=0 (a**4 overflows at large steps)
+            y,info = odeint(rhs,y_start,np.append(lna_start,lna_out),tfirst=True,tcrit=[0.],
+                            rtol=self.rtol,atol=self.atol,full_output=True)
+            y,nfev,njev,success,message = y[1:].T,info['nfe'][-1],info['nje'][-1],info['message'] == 'Integration successful.',info['message']
+        else:
+            sol = solve_ivp(rhs,(lna_start,0.),y_start,method=self.method,t_eval=lna_out,
+                            vectorized=True,rtol=self.rtol,atol=self.atol)
+            y,nfev,njev,success,message = sol.y,sol.nfev,sol.njev,sol.success,sol.message
+
+        self.stats['integrations'] += 1
+        self.stats['nfev'] += nfev
+        self.stats['njev'] += njev
+
+        if not success:
+            raise ValueError('{} ODE integration failed: {}'.format(self.label,message))
+
+        return y
+
+    def solve(self,params):
+
+        #The first integration starts from the initial conditions, the
+        #update_params iterations from its state at lna_restart. Returns
+        #the converged parameters and their solution on [z=0]+zcalc
+        lna_ini,y_ini = self.get_initial_conditions(params)
+        lna_start,y_start = lna_ini,y_ini
+        last = None
+        for i in range(self.max_iterations):
+            y    = self.integrate(params,lna_start,y_start)
+            new  = self.update_params(params,y[:,-1])
+            step = {par: new[par]-params[par] for par in new if new[par] != params[par]}
+            change = max([abs(step[par]/params[par]) if params[par] != 0 else abs(step[par]) for par in step],default=0.)
+            if change < self.closure_tol:
+                break
+
+            #Secant step for each parameter fixed at z=0, from the last two
+            #iterations (plain fixed point iteration for the first one)
+            updated = dict(new)
+            if last != None:
+                for par,dx in step.items():
+                    if par in last[1] and last[1][par] != dx:
+                        updated[par] = params[par]-dx*(params[par]-last[0][par])/(dx-last[1][par])
+            last   = (params,step)
+            params = updated
+
+            if i == 0 and self.lna_restart > lna_ini:
+                #lna_restart is the first output point
+                lna_start,y_start = self.lna_restart,y[:,0]
+        else:
+            print('{} ODE background: parameters at z=0 not converged after {} iterations'.format(self.label,self.max_iterations))
+
+        return params,y[:,-len(self.zint):][:,::-1]
+
+    def get_cosmology(self,params,settings):
+
+        #Grid built again only if the settings change
+        if get_grid_key(settings) != getattr(self,'grid',None):
+            self.zmin      = settings['zmin']
+            self.zmax      = settings['zmax']
+            self.Nz        = settings['Nz']
+            self.grid      = get_grid_key(settings)
+
+            self.zcalc = get_zgrid(settings)
+            self.zint  = np.concatenate([[0.],self.zcalc])
+            #Output points of the integrations, increasing (z decreasing)
+            if self.z_restart != None:
+                self.lna_restart = -np.log1p(max(self.z_restart,self.zmax))
+                self.lna_out     = np.unique(np.append(-np.log1p(self.zint),self.lna_restart))
+            else:
+                self.lna_restart = -np.inf
+                self.lna_out     = np.unique(-np.log1p(self.zint))
+
+        unknown = [par for par in params.keys() if par not in self.recognized_params]
+
+        if unknown != []:
+            sys.exit('Error in {} cosmology code!\n Unknown parameters: {}'.format(self.label,unknown))
+
+        pars = {par: val for par,val in self.recognized_params.items() if val != None}
+        pars.update(params)
+
+        tini = time()
+        pars,y = self.solve(pars)
+
+        #y and H on [z=0]+zcalc
+        lna = -np.log1p(self.zint)
+        H   = self.get_hubble(lna,y,pars)
+        comoving = CubicSpline(self.zint,clight/H).antiderivative()(self.zcalc)
+        H   = H[1:]
+
+        theory = {'H_Mpc': interp1d(self.zcalc,H/clight),
+                  'H_kmsMpc': interp1d(self.zcalc,H),
+                  'comoving': interp1d(self.zcalc,comoving)}
+        theory.update(self.get_derived(0.,y[:,0],pars))
+
+        self.stats['points'] += 1
+        self.stats['time']   += time()-tini
+
+        return theory
+
+
+class DecayingDMExpansion(ODEExpansion):
+    #Flat LCDM where part of the dark matter (omdcdmh2, the density today
+    #if it did not decay) decays into dark radiation with rate Gamma_dcdm
+    #in km/s/Mpc. Variables are the comoving densities a^3*omega_dcdm and
+    #a^4*omega_dr, constant without decay. omega_Lambda is fixed by H0.
+    #Massless neutrinos only. rdrag from the fitting formula of the
+    #Custom module, with the dark matter before the decay
+
+    label = 'DCDM'
+
+    #Decay negligible before this redshift for any sensible Gamma
+    z_ini = 1.e4
+
+    def __init__(self,call_name):
+
+        super().__init__(call_name)
+
+        self.recognized_params = {'H0': None,
+                                  'ombh2': None,
+                                  'omch2': 0.,
+                                  'omdcdmh2': None,
+                                  'Gamma_dcdm': 0.,
+                                  'nnu': standard_neff}
+
+        self.derived_params = ['rdrag','omegaL','Omega_dr']
+
+    def get_initial_conditions(self,params):
+
+        #Radiation and the other matter are constant, stored once for get_hubble.
+        #First guess for omega_Lambda without decay
+        params['omrh2'] = omgh2*(1+params['nnu']*nu_factor)
+        params['ombch2'] = params['ombh2']+params['omch2']
+        if 'omlh2' not in params:
+            params['omlh2'] = (params['H0']/100)**2-params['ombch2']-params['omdcdmh2']-params['omrh2']
+
+        return -np.log1p(self.z_ini),np.array([params['omdcdmh2'],0.])
+
+    def get_hubble(self,lna,y,params):
+
+        a = np.exp(lna)
+        E2 = ((params['ombch2']+y[0])*a+params['omrh2']+y[1])/a**4+params['omlh2']
+
+        return 100*np.sqrt(E2)
+
+    def get_rhs(self,lna,y,H,params):
+
+        decay = params['Gamma_dcdm']*y[0]/H
+
+        return np.array([-decay,np.exp(lna)*decay])
+
+    def update_params(self,params,y_today):
+
+        new = dict(params)
+        new['omlh2'] = (params['H0']/100)**2-params['ombch2']-params['omrh2']-y_today[0]-y_today[1]
+
+        return new
+
+    def get_derived(self,lna,y,params):
+
+        h2   = (params['H0']/100)**2
+        omm  = params['ombh2']+params['omch2']+params['omdcdmh2']
+        rdrag = 147.05*(omm/0.1432)**(-0.23)*(params['nnu']/3.04)**(-0.1)*(params['ombh2']/0.02236)**(-0.13)
+
+        return {'rdrag': rdrag,
+                'omegaL': params['omlh2']/h2,
+                'Omega_dr': y[1]/h2}
@@ -5,6 +5,10 @@ import pandas as pd
 
 import camb
 
+from scipy.interpolate import interp1d
+
+from theory_code.distance_theory import get_zgrid
+
 class StandardExpansion:
 
     def __init__(self,call_name):
@@ -24,6 +28,12 @@ class StandardExpansion:
 
         self.derived_params = ['rdrag','omegaL']
 
+        #Optional on-disk cache of the CAMB results (see theory_code/disk_cache.py)
+        self.disk_cache = None
+
+        #Optional emulator of the CAMB results (see theory_code/emulator.py)
+        self.emulator = None
+
         if call_name == self.label:
             self.used = True
 
@@ -42,6 +52,27 @@ class StandardExpansion:
         if unknown != []:
             sys.exit('Error in {} cosmology code!\n Unknown parameters: {}'.format(self.label,unknown))
 
+        #The emulator is used inside its training hull, CAMB elsewhere
+        if settings.get('emulator') != None:
+            if self.emulator == None:
+                from theory_code.emulator import BackgroundEmulator
+                self.emulator = BackgroundEmulator(settings['emulator'])
+                if self.emulator.version != camb.__version__:
+                    print('WARNING! Emulator trained with CAMB {}, running with {}'.format(self.emulator.version,camb.__version__))
+
+            if self.emulator.covers(params,settings):
+                return self.get_stored_theory(self.emulator.predict(params))
+
+        if settings.get('disk_cache') != None:
+            if self.disk_cache == None:
+                from theory_code.disk_cache import DiskCache
+                self.disk_cache = DiskCache(**settings['disk_cache'])
+
+            key    = self.disk_cache.get_key(self.label,params,settings,camb.__version__)
+            stored = self.disk_cache.load(key)
+            if stored != None:
+                return self.get_stored_theory(stored)
+
         pars = camb.set_params(**params)
         results = camb.get_background(pars)
 
@@ -53,6 +84,26 @@ class StandardExpansion:
                   'rdrag': results.get_derived_params()['rdrag'],
                   'omegaL': results.get_Omega('de',z=0)}
 
+        if self.disk_cache != None:
+            zcalc = get_zgrid(settings)
+            self.disk_cache.save(key,{'z': zcalc,
+                                      'H_Mpc': Hz(zcalc),
+                                      'H_kmsMpc': results.hubble_parameter(zcalc),
+                                      'comoving': results.comoving_radial_distance(zcalc),
+                                      'rdrag': theory['rdrag'],
+                                      'omegaL': theory['omegaL']})
+
 
         return theory
 
+    def get_stored_theory(self,stored):
+
+        #Functions are interpolated on the zcalc grid, so they are
+        #the same as CAMB on the grid nodes
+        theory = {'H_Mpc': interp1d(stored['z'],stored['H_Mpc']),
+                  'H_kmsMpc': interp1d(stored['z'],stored['H_kmsMpc']),
+                  'comoving': interp1d(stored['z'],stored['comoving']),
+                  'rdrag': float(stored['rdrag']),
+                  'omegaL': float(stored['omegaL'])}
+
+        return theory
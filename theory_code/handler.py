@@ -5,19 +5,38 @@ import yaml
 from bios import read
 from copy import deepcopy
 
-from theory_code.cobaya_theory_wrapper import CalcDist
+from theory_code.cobaya_theory_wrapper import CalcDist,CalcDDR,CalcMagnitude
 from theory_code.distance_theory       import TheoryCalcs
 
 class TheoryHandler:
 
     def __init__(self,info):
 
+        #The theory is split in a slow background component and fast
+        #DDR and SN magnitude ones, each depending only on its own
+        #parameters, so that samplers can exploit the speed hierarchy
         self.theory_dict = {'CalcDist': {'external': CalcDist,
                                          'cosmology': info['cosmology'],
-                                         'fiducial': info['fiducial_path']}}
+                                         'fiducial': info['fiducial_path']},
+                            'CalcDDR': {'external': CalcDDR},
+                            'CalcMagnitude': {'external': CalcMagnitude}}
+
+        #Size of the cache of background results (see CalcDist)
+        if 'theory_cache' in info:
+            self.theory_dict['CalcDist']['cache'] = info['theory_cache']
+
+        #On-disk cache of the CAMB background, shared by runs and processes
+        #e.g. theory_disk_cache: {path: ./theory_cache, max_MB: 500}
+        #and emulator of the CAMB background (see theory_code/emulator.py)
+        #e.g. theory_emulator: emulators/LCDM_DESI.npz
+        settings = deepcopy(read('theory_code/basic_parameters.yaml')['settings'])
+        for option,setting in [('theory_disk_cache','disk_cache'),('theory_emulator','emulator')]:
+            if option in info and info[option] != None:
+                settings[setting] = info[option]
+                self.theory_dict['CalcDist']['settings'] = settings
 
         if 'DDR_options' in info:
-            self.theory_dict['CalcDist']['DDR_options'] = info['DDR_options']
+            self.theory_dict['CalcDDR']['DDR_options'] = info['DDR_options']
 
         self.theory_dict['CalcDist']['derived_pars'] = self.include_theory_params(info)
 